@@ -0,0 +1 @@
+""" Shared code for the scripts, mostly for reading the ACDSee catalog database files. """
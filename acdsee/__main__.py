@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# Query the ACDSee catalog from the command line, e.g.
+#   python3 -m acdsee --catalog DIR pending --rated        (Embed Pending and rated)
+#   python3 -m acdsee --catalog DIR query --where 'RATING>=4' --columns RATING,SIZE
+#   python3 -m acdsee --catalog DIR query --where 'FTMODIFIED>=2024-01-01 12:00' --columns FTMODIFIED
+#   python3 -m acdsee --catalog DIR folders
+#   python3 -m acdsee --catalog DIR snapshot               (rebuild the snapshot)
+# Queries use the snapshot of the catalog (see acdsee/catalog.py), which is
+# written the first time and whenever the .dbf files change.
+# Each command imports what it needs when it runs, so --help doesn't
+# import anything and a query using the snapshot doesn't import NumPy.
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+catalogdir = "c:\\Users\\arb\\AppData\\Local\\ACD Systems\\Catalogs\\170Ult\\Default"
+
+
+def parse_where(condition):
+    """ Convert e.g. 'RATING>=4' or 'NAME=a.jpg' to a (column, operator, value)
+    tuple, the value still a string as its type depends on the column,
+    see typed_where() """
+    match = re.match(r'^\s*(\w+)\s*(==|!=|<=|>=|<|>|=)\s*(.*?)\s*$', condition)
+    if not match:
+        raise argparse.ArgumentTypeError('expected COLUMN OPERATOR VALUE, not %s' % condition)
+    name, op, value = match.groups()
+    return name, '==' if op == '=' else op, value
+
+def column_value(column, text):
+    """ Convert the text to the type the records have for the column, a
+    dict with its type and length like the snapshot header. ACDSee dates
+    are written YYYY-MM-DD [HH:MM[:SS]]. Raises ValueError with a message. """
+    kind = column['type']
+    try:
+        if kind == '7':
+            from acdsee.dates import parse_acdsee_date
+            return parse_acdsee_date(text)
+        if kind == 'D':
+            return datetime.date.fromisoformat(text)
+        if kind == 'L':
+            return {'t': True, 'true': True, 'y': True, 'f': False, 'false': False, 'n': False}[text.lower()]
+        if kind in 'NFIOY+' or (kind == 'B' and column['length'] == 8):
+            try:
+                return int(text)
+            except ValueError:
+                return float(text)
+    except (ValueError, KeyError):
+        expected = {'7': 'a date YYYY-MM-DD [HH:MM[:SS]]', 'D': 'a date YYYY-MM-DD', 'L': 'T or F'}.get(kind, 'a number')
+        raise ValueError('%s is %s, not %r' % (column['name'], expected, text))
+    return text
+
+def typed_where(catalog, where):
+    """ Return the conditions from parse_where() with each value converted
+    by column_value() for its column in Asset.dbf """
+    columns = dict(catalog.snapshot.columns) if catalog.snapshot else {}
+    if any(name not in columns for name, op, value in where):
+        from acdsee.dbf import DBFTable
+        with DBFTable(os.path.join(catalog.catalogdir, 'Asset.dbf')) as table:
+            for field in table.fields:
+                columns.setdefault(field.name, dict(name=field.name, type=field.type, length=field.length))
+    for name, op, value in where:
+        if name not in columns:
+            raise ValueError('there is no column %s in Asset.dbf' % name)
+    return [(name, op, column_value(columns[name], value)) for name, op, value in where]
+
+def test_parse_where():
+    assert(parse_where('RATING>=4') == ('RATING', '>=', '4'))
+    assert(parse_where('NAME = a.jpg') == ('NAME', '==', 'a.jpg'))
+    column = dict(name='SIZE', type='N', length=10)
+    assert(column_value(column, '4') == 4 and column_value(column, '1.5') == 1.5)
+    assert(column_value(dict(name='NAME', type='C', length=20), '1') == '1')
+    assert(column_value(dict(name='FTMODIFIED', type='7', length=8), '2020-01-01') > bytes(8))
+    try:
+        column_value(dict(name='FTMODIFIED', type='7', length=8), '2020-13-01')
+        assert(False)
+    except ValueError as e:
+        assert(str(e) == "FTMODIFIED is a date YYYY-MM-DD [HH:MM[:SS]], not '2020-13-01'")
+
+
+def open_catalog(args, rebuild=False):
+    from acdsee.catalog import Catalog
+    return Catalog(args.catalog, snapshot=args.snapshot, rebuild=rebuild, jobs=args.jobs)
+
+def print_assets(catalog, columns, where):
+    """ Print the path of each asset matching where, and the columns """
+    folders = catalog.folders
+    for record in catalog.records(['NAME', 'FOLDER_ID'] + columns, where=where):
+        values = [record[name] for name in columns]
+        if any(isinstance(value, bytes) for value in values):
+            from acdsee.dates import format_acdsee_date
+            values = [format_acdsee_date(value) if isinstance(value, bytes) else value for value in values]
+        print('\t'.join([folders.join(record['FOLDER_ID'], record['NAME'])] + [str(value) for value in values]))
+
+def pending(args):
+    """ The files flagged Embed Pending """
+    where = [('ACDDBUPOFF', '>', 0)] + ([('RATING', '!=', 0)] if args.rated else [])
+    with open_catalog(args) as catalog:
+        print_assets(catalog, ['ACDDBUPOFF', 'RATING'], where)
+
+def query(args):
+    """ The files matching all the --where conditions """
+    with open_catalog(args) as catalog:
+        try:
+            where = typed_where(catalog, args.where)
+        except ValueError as e:
+            sys.exit('python3 -m acdsee query: error: %s' % e)
+        print_assets(catalog, args.columns.split(',') if args.columns else [], where)
+
+def folders(args):
+    """ The path of every folder """
+    with open_catalog(args) as catalog:
+        for problem in catalog.folders.problems():
+            print('WARNING: %s' % problem, file=sys.stderr)
+        for path in sorted(catalog.folders.paths.values()):
+            print(path)
+
+def snapshot(args):
+    """ Rebuild the snapshot """
+    start = time.time()
+    with open_catalog(args, rebuild=True) as catalog:
+        print('Wrote %s with %d assets and %d folders in %f seconds' % (args.snapshot,
+            catalog.snapshot.count, len(catalog.folders.paths), time.time() - start))
+
+
+# ---------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m acdsee', description='query the ACDSee catalog')
+    parser.add_argument('--catalog', action="store", default=catalogdir, help=f'directory containing the catalog .dbf files (default {catalogdir})')
+    parser.add_argument('--snapshot', action="store", default='acdsee_catalog.snapshot', help='snapshot of the catalog to use or write (default acdsee_catalog.snapshot)')
+    parser.add_argument('--no-snapshot', action="store_const", const=None, dest='snapshot', help='read the .dbf files every time')
+    parser.add_argument('--jobs', action="store", default=os.cpu_count(), type=int, help='number of processes reading Asset.dbf when there\'s no up to date snapshot (default one per CPU)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('pending', help='list the files flagged Embed Pending')
+    command.add_argument('--rated', action="store_true", help='only those with a rating (not face embeds)')
+    command.set_defaults(function=pending)
+    command = commands.add_parser('query', help='list the files matching conditions')
+    command.add_argument('--where', action="append", default=[], type=parse_where, help='a condition such as RATING>=4 or FTMODIFIED>=2024-01-01 (repeatable, all must match)')
+    command.add_argument('--columns', action="store", help='comma-separated Asset columns to print after the path')
+    command.set_defaults(function=query)
+    command = commands.add_parser('folders', help='list the folder paths')
+    command.set_defaults(function=folders)
+    command = commands.add_parser('snapshot', help='rebuild the snapshot of the catalog')
+    command.set_defaults(function=snapshot)
+    args = parser.parse_args()
+    if args.command == 'snapshot' and not args.snapshot:
+        parser.error('snapshot needs --snapshot')
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
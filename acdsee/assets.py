@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# A compact store of catalog assets, for scripts which keep many of them
+# in memory, e.g. the files restore.py plans to restore.
+#
+# A dict or a full path string per asset costs a few hundred bytes in
+# Python objects. AssetStore keeps each column in an array instead: the
+# folder as the index of its FOLDER_ID in a list of the distinct ids,
+# the names as UTF-8 in one bytearray, and numbers as doubles. An asset
+# then costs the bytes of its name plus 12, plus 8 per number column.
+# The full path of an asset is only made when it's needed, e.g. printed,
+# from the FolderTree.
+
+import array
+
+
+class AssetStore:
+    """ Assets with a FOLDER_ID, a NAME and the given number columns (such
+    as SIZE and CRC, None is stored as NaN), each known by its index in
+    the order they were added. folder_ids is the list of distinct FOLDER_IDs
+    and folders the index in it of the folder of each asset.
+    """
+    def __init__(self, columns=()):
+        self.columns = list(columns)
+        self.folder_ids = []
+        self.folder_index = {} # FOLDER_ID: index in folder_ids
+        self.folders = array.array('i')
+        self.names = bytearray()
+        self.offsets = array.array('q', [0]) # of each name in names
+        self.values = {column: array.array('d') for column in self.columns}
+
+    @classmethod
+    def from_records(cls, records, columns=()):
+        """ Store the FOLDER_ID, NAME and the columns of each record (a dict
+        like those from DBFTable.records()) """
+        store = cls(columns)
+        for record in records:
+            store.add(record['FOLDER_ID'], record['NAME'], *[record[column] for column in columns])
+        return store
+
+    def __len__(self):
+        return len(self.folders)
+
+    def add(self, folder_id, name, *values):
+        """ Add an asset with the values of the columns and return its index """
+        folder = self.folder_index.get(folder_id)
+        if folder is None:
+            folder = self.folder_index[folder_id] = len(self.folder_ids)
+            self.folder_ids.append(folder_id)
+        self.folders.append(folder)
+        self.names.extend(name.encode('utf-8'))
+        self.offsets.append(len(self.names))
+        for column, value in zip(self.columns, values):
+            self.values[column].append(float('nan') if value is None else value)
+        return len(self.folders) - 1
+
+    def folder_id(self, index):
+        return self.folder_ids[self.folders[index]]
+
+    def name(self, index):
+        return self.names[self.offsets[index]:self.offsets[index+1]].decode('utf-8')
+
+    def value(self, column, index):
+        """ Return the number in the column, as an int if it's whole, or None """
+        value = self.values[column][index]
+        if value != value:
+            return None
+        return int(value) if value.is_integer() else value
+
+    def path(self, index, folders):
+        """ Return the full path of the asset in the FolderTree folders """
+        return folders.join(self.folder_id(index), self.name(index))
+
+    def sorted(self, indexes, folders):
+        """ Return an array of the indexes sorted by the path of their folder
+        and then by name, so the assets in a folder are together. Only the
+        paths of the folders and the names of one folder at a time are made,
+        not the full path of every asset. """
+        by_folder = {}
+        for index in indexes:
+            by_folder.setdefault(self.folders[index], array.array('q')).append(index)
+        result = array.array('q')
+        for folder in sorted(by_folder, key=lambda folder: folders.path(self.folder_ids[folder])):
+            result.extend(sorted(by_folder[folder], key=self.name))
+        return result
+
+
+def test_asset_store():
+    from acdsee.folders import FolderTree
+    folders = FolderTree({1.0: 'C:', 2.0: 'Pictures'}, {1.0: 0.0, 2.0: 1.0})
+    store = AssetStore.from_records([
+        {'FOLDER_ID': 2.0, 'NAME': 'café.jpg', 'SIZE': 5000, 'CRC': -12345},
+        {'FOLDER_ID': 1.0, 'NAME': 'b.jpg', 'SIZE': None, 'CRC': 0},
+        {'FOLDER_ID': 2.0, 'NAME': 'a.jpg', 'SIZE': 1.5, 'CRC': 1}], ['SIZE', 'CRC'])
+    assert(len(store) == 3 and store.folder_ids == [2.0, 1.0] and store.folders.tolist() == [0, 1, 0])
+    assert(store.name(0) == 'café.jpg' and store.name(2) == 'a.jpg')
+    assert(store.path(0, folders) == 'C:\\Pictures\\café.jpg')
+    assert([store.value('SIZE', index) for index in range(3)] == [5000, None, 1.5])
+    assert(store.value('CRC', 0) == -12345)
+    assert(store.sorted(range(3), folders).tolist() == [1, 2, 0])
+    folders = FolderTree({1.0: 'C:', 2.0: 'Pictures', 3.0: 'Pictures x'}, {1.0: 0.0, 2.0: 1.0, 3.0: 1.0})
+    store = AssetStore.from_records([{'FOLDER_ID': id, 'NAME': name} for id, name in
+        [(2.0, 'b.jpg'), (3.0, 'a.jpg'), (1.0, 'z.jpg'), (2.0, 'a.jpg'), (42.0, 'lost.jpg')]])
+    assert([store.path(index, folders) for index in store.sorted(range(len(store)), folders)]
+        == ['lost.jpg', 'C:\\z.jpg', 'C:\\Pictures\\a.jpg', 'C:\\Pictures\\b.jpg', 'C:\\Pictures x\\a.jpg'])
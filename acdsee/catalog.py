@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+#
+# The ACDSee catalog as one object, the folder tree and the assets.
+#
+# Decoding Asset.dbf takes a while for a big catalog, so after the first
+# read the columns the scripts use are written to a snapshot file which
+# later runs memory-map instead of reading the .dbf files. Each column is
+# stored contiguously, numbers as doubles (NaN for None), text as offsets
+# into UTF-8 and ACDSee dates as the raw 8 bytes, so a query only reads
+# and decodes the columns and records it needs. The snapshot is rebuilt
+# when the mtime or size of Asset.dbf or Folder.dbf changes.
+#
+# Using a snapshot doesn't import acdsee.dbf (or NumPy), only reading the
+# .dbf files does, so a query starts quickly.
+
+import array
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+import tempfile
+from acdsee.folders import FolderTree
+
+snapshot_file = 'acdsee_catalog.snapshot'
+snapshot_magic = b'ACDSNAP1'
+snapshot_columns = ['NAME', 'FOLDER_ID', 'SIZE', 'CRC', 'RATING', 'ACDDBUPOFF', 'FTMODIFIED']
+source_tables = ['Asset.dbf', 'Folder.dbf'] # the snapshot is rebuilt if these change
+
+# The operators of DBFTable.records(), here so a snapshot can be used
+# without importing acdsee.dbf
+operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def column_kind(field):
+    """ Return how a field is stored in the snapshot, 's' text, 'd' a
+    double, 'b' the raw bytes, or None if it isn't stored """
+    if field.type == 'C':
+        return 's'
+    if field.type in 'NFIO+LY' or (field.type == 'B' and field.length == 8):
+        return 'd'
+    if field.type == '7':
+        return 'b'
+    return None
+
+def column_type(column):
+    """ Return the function converting a double from the snapshot back
+    to the type FieldParser returns for the field """
+    if column['type'] == 'L':
+        return bool
+    if column['type'] in 'I+' or (column['type'] in 'NF' and column['decimals'] == 0):
+        return int
+    return float
+
+def aligned(position):
+    return (position + 7) & ~7
+
+
+# ---------------------------------------------------------------------
+def write_snapshot(filename, catalogdir, columns=snapshot_columns, jobs=1):
+    """ Read the folders and the given columns of the assets (those in
+    Asset.dbf which can be stored) from the .dbf files into a snapshot,
+    reading Asset.dbf with jobs processes. """
+    from acdsee.dbf import DBFTable
+    # Before reading, so a change while reading makes it out of date
+    sources = {}
+    for name in source_tables:
+        filestat = os.stat(os.path.join(catalogdir, name))
+        sources[name] = [filestat.st_mtime, filestat.st_size]
+    with DBFTable(os.path.join(catalogdir, 'Folder.dbf')) as table:
+        folders = [[record['FOLDER_ID'], record['NAME'], record['PRNT_ID']]
+            for record in table.records(['FOLDER_ID', 'NAME', 'PRNT_ID'])]
+    with DBFTable(os.path.join(catalogdir, 'Asset.dbf')) as table:
+        fields = [table.field_by_name[name] for name in columns
+            if name in table.field_by_name and column_kind(table.field_by_name[name])]
+        kinds = [column_kind(field) for field in fields]
+        data = [array.array('d') if kind == 'd' else bytearray() for kind in kinds]
+        offsets = [array.array('q', [0]) if kind == 's' else None for kind in kinds]
+        count = 0
+        for record in table.parallel_records([field.name for field in fields], jobs=jobs):
+            count += 1
+            for field, kind, column, column_offsets in zip(fields, kinds, data, offsets):
+                value = record[field.name]
+                if kind == 'd':
+                    column.append(float('nan') if value is None else float(value))
+                elif kind == 's':
+                    column.extend(value.encode('utf-8'))
+                    column_offsets.append(len(column))
+                else:
+                    column.extend(value)
+
+    header = dict(catalogdir=os.path.abspath(catalogdir), byteorder=sys.byteorder,
+        sources=sources, snapshot_columns=list(columns), count=count, folders=folders, columns=[])
+    sections = []
+    position = 0 # from the end of the header
+    for field, kind, column, column_offsets in zip(fields, kinds, data, offsets):
+        info = dict(name=field.name, type=field.type, length=field.length, decimals=field.decimals, kind=kind)
+        if kind == 's':
+            info['offsets'] = position
+            sections.append((position, column_offsets.tobytes()))
+            position = aligned(position + len(sections[-1][1]))
+        info['data'] = position
+        sections.append((position, bytes(column)))
+        position = aligned(position + len(sections[-1][1]))
+        header['columns'].append(info)
+    header = json.dumps(header).encode('utf-8')
+    start = aligned(len(snapshot_magic) + 4 + len(header))
+    with open(filename + '.tmp', 'wb') as fd:
+        fd.write(snapshot_magic + struct.pack('<I', len(header)) + header)
+        for offset, section in sections:
+            fd.seek(start + offset)
+            fd.write(section)
+        fd.truncate(start + position)
+    return filename + '.tmp'
+
+
+class Snapshot:
+    """ A memory-mapped snapshot file written by write_snapshot() """
+    def __init__(self, filename, in_memory=False):
+        with open(filename, 'rb') as fd:
+            if in_memory:
+                self.mmap = fd.read()
+            else:
+                self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(snapshot_magic)] != snapshot_magic:
+            self.close()
+            raise ValueError('%s is not a catalog snapshot' % filename)
+        length = struct.unpack_from('<I', self.mmap, len(snapshot_magic))[0]
+        self.header = json.loads(self.mmap[len(snapshot_magic)+4:len(snapshot_magic)+4+length])
+        self.start = aligned(len(snapshot_magic) + 4 + length)
+        self.count = self.header['count']
+        self.columns = {column['name']: column for column in self.header['columns']}
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+
+    def is_current(self, catalogdir, columns=snapshot_columns):
+        """ Return True if the snapshot was made from the catalog as it is now """
+        if (self.header['catalogdir'] != os.path.abspath(catalogdir)
+                or self.header['byteorder'] != sys.byteorder
+                or self.header['snapshot_columns'] != list(columns)):
+            return False
+        for name, (mtime, size) in self.header['sources'].items():
+            try:
+                filestat = os.stat(os.path.join(catalogdir, name))
+            except OSError:
+                return False
+            if filestat.st_mtime != mtime or filestat.st_size != size:
+                return False
+        return True
+
+    def folder_tree(self, sep='\\'):
+        """ Return the FolderTree of the folders in the snapshot """
+        names = {id: name for id, name, parent in self.header['folders']}
+        parents = {id: parent for id, name, parent in self.header['folders']}
+        return FolderTree(names, parents, sep)
+
+    def values(self, name, indexes=None):
+        """ Return a list of the values of the column in the records
+        numbered indexes (default all) """
+        column = self.columns[name]
+        start = self.start + column['data']
+        if indexes is None:
+            indexes = range(self.count)
+        if column['kind'] == 'd':
+            if len(indexes) == self.count:
+                values = array.array('d', self.mmap[start:start + 8 * self.count]).tolist()
+            else:
+                values = [struct.unpack_from('d', self.mmap, start + 8 * index)[0] for index in indexes]
+            convert = column_type(column)
+            return [None if value != value else convert(value) for value in values]
+        if column['kind'] == 'b':
+            length = column['length']
+            return [self.mmap[start + length * index:start + length * (index + 1)] for index in indexes]
+        offsets_start = self.start + column['offsets']
+        if len(indexes) == self.count:
+            offsets = array.array('q', self.mmap[offsets_start:offsets_start + 8 * (self.count + 1)])
+            bounds = zip(offsets, offsets[1:])
+        else:
+            bounds = [struct.unpack_from('qq', self.mmap, offsets_start + 8 * index) for index in indexes]
+        return [self.mmap[start + begin:start + end].decode('utf-8') for begin, end in bounds]
+
+    def records(self, columns=None, where=None):
+        """ Yield a dict of the given columns (default all in the snapshot)
+        for each record matching where, like DBFTable.records() """
+        columns = list(self.columns) if columns is None else columns
+        indexes = range(self.count)
+        for name, op, value in (where or []):
+            compare = operators[op]
+            indexes = [index for index, actual in zip(indexes, self.values(name, indexes))
+                if (op == '!=' if actual is None else compare(actual, value))]
+        values = [self.values(name, indexes) for name in columns]
+        for row in zip(*values):
+            yield dict(zip(columns, row))
+
+
+def open_snapshot(filename, catalogdir, rebuild=False, jobs=1):
+    """ Return the Snapshot of the catalog, first writing it if it doesn't
+    exist, is out of date or rebuild is True, and whether it was written """
+    if not rebuild and os.path.exists(filename):
+        try:
+            snapshot = Snapshot(filename)
+        except ValueError:
+            pass
+        else:
+            if snapshot.is_current(catalogdir):
+                return snapshot, False
+            snapshot.close() # so it can be replaced on Windows
+    tmpfile = write_snapshot(filename, catalogdir, jobs=jobs)
+    try:
+        os.replace(tmpfile, filename)
+    except OSError:
+        # Still mapped by another process on Windows, so use this one for now
+        snapshot = Snapshot(tmpfile, in_memory=True)
+        os.remove(tmpfile)
+        return snapshot, True
+    return Snapshot(filename), True
+
+
+# ---------------------------------------------------------------------
+class Catalog:
+    """ The folders and assets of the ACDSee catalog in catalogdir, from
+    the snapshot file if given (writing it if necessary), otherwise from
+    the .dbf files. folders is the FolderTree (paths using sep) and
+    records() queries Asset.dbf like DBFTable.records(). A query needing
+    a column which isn't in the snapshot reads Asset.dbf, as does writing
+    the snapshot, using jobs processes (see DBFTable.parallel_records()).
+    """
+    def __init__(self, catalogdir, snapshot=snapshot_file, sep='\\', rebuild=False, jobs=1):
+        self.catalogdir = catalogdir
+        self.sep = sep
+        self.jobs = jobs
+        self.snapshot = None
+        self.rebuilt = False
+        self._folders = None
+        if snapshot:
+            self.snapshot, self.rebuilt = open_snapshot(snapshot, catalogdir, rebuild, jobs)
+
+    def close(self):
+        if self.snapshot:
+            self.snapshot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def folders(self):
+        if self._folders is None:
+            if self.snapshot:
+                self._folders = self.snapshot.folder_tree(self.sep)
+            else:
+                self._folders = FolderTree.from_dbf(os.path.join(self.catalogdir, 'Folder.dbf'), self.sep)
+        return self._folders
+
+    def records(self, columns=None, where=None):
+        """ Yield a dict for each asset matching where, a list of (column,
+        operator, value) tuples, containing only the given columns (default
+        all those in the snapshot, or in Asset.dbf if there's no snapshot) """
+        needed = set(columns or []) | set(name for name, op, value in (where or []))
+        if self.snapshot and needed <= set(self.snapshot.columns):
+            yield from self.snapshot.records(columns, where)
+            return
+        from acdsee.dbf import DBFTable
+        with DBFTable(os.path.join(self.catalogdir, 'Asset.dbf')) as table:
+            yield from table.parallel_records(columns, where, self.jobs)
+
+
+def test_catalog_snapshot():
+    from acdsee.dbf import DBFTable, write_dbf, test_fields, test_records
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_dbf(os.path.join(tmpdir, 'Folder.dbf'), [('NAME', 'C', 20, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)],
+            [['C:', 0.0, 1.0], ['Pictures', 1.0, 2.0]])
+        assetfile = os.path.join(tmpdir, 'Asset.dbf')
+        write_dbf(assetfile, test_fields, test_records, deleted={3})
+        snapshot = os.path.join(tmpdir, 'catalog.snapshot')
+        with DBFTable(assetfile) as table:
+            expected = list(table.records(['NAME', 'FOLDER_ID', 'RATING', 'FTMODIFIED']))
+            expected_rated = list(table.records(['NAME', 'RATING'], where=[('RATING', '!=', 0)]))
+        with Catalog(tmpdir, snapshot) as catalog:
+            assert(catalog.rebuilt)
+            assert(list(catalog.records(['NAME', 'FOLDER_ID', 'RATING', 'FTMODIFIED'])) == expected)
+        with Catalog(tmpdir, snapshot) as catalog:
+            assert(not catalog.rebuilt)
+            assert(catalog.folders.join(2.0, 'a.jpg') == 'C:\\Pictures\\a.jpg')
+            assert(list(catalog.records(['NAME', 'RATING'], where=[('RATING', '!=', 0)])) == expected_rated)
+            assert([record['NAME'] for record in catalog.records(['NAME'], where=[('RATING', '>', 0), ('NAME', '<', 'd')])]
+                == ['café.jpg', 'c.jpg'])
+            assert(list(catalog.records(['NAME'], where=[('FTMODIFIED', '==', bytes(8))]))
+                == [{'NAME': 'b.jpg'}, {'NAME': 'c.jpg'}, {'NAME': 'e.jpg'}])
+        write_dbf(assetfile, test_fields, test_records[:2])
+        os.utime(assetfile, (1, 1))
+        with Catalog(tmpdir, snapshot) as catalog:
+            assert(catalog.rebuilt)
+            assert(len(list(catalog.records())) == 2)
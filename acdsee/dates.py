@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Decode the ACDSee date fields (dBase field type 7), e.g. FTMODIFIED,
+# FTCREATED, FTACCESSED, ACDDATE, EXIFDATE, RECCREDATE and RAWDATE.
+#
+# The 8 bytes are two little-endian integers, the Julian Date Number and
+# the number of milliseconds since the start of the day. Thanks to
+# @jh724186 in #1 for decoding it, see the README.
+# Zero means no date.
+
+import datetime
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+jdn_unix_epoch = 2440588  # Julian Date Number of 1970-01-01
+jdn_ordinal_offset = 1721425  # Julian Date Number minus date.toordinal()
+
+
+def acdsee_timestamp(data):
+    """ Return the date as a Unix timestamp (whole seconds, UTC)
+    or None if it's zero """
+    jdn, msec = struct.unpack('<II', data)
+    if jdn == 0:
+        return None
+    return (jdn - jdn_unix_epoch) * 86400 + msec // 1000
+
+def format_acdsee_date(data):
+    """ Return the date as a string dd/mm/YYYY HH:MM:SS, or '' if it's zero.
+    Same result as the parse7 in the README but without the conversions
+    to hex and back, and without datetime arithmetic for modern dates. """
+    jdn, msec = struct.unpack('<II', data)
+    if jdn == 0:
+        return ''  # prevent the csv filling up with 0 dates
+    days, seconds = divmod(msec // 1000, 86400)
+    ordinal = jdn - jdn_ordinal_offset + days
+    if ordinal < 365243: # before year 1000 strftime doesn't pad %Y
+        dt = datetime.datetime(1858, 11, 17) + datetime.timedelta(jdn - 2400001) + datetime.timedelta(seconds=msec // 1000)
+        return dt.strftime('%d/%m/%Y %H:%M:%S')
+    date = datetime.date.fromordinal(ordinal)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return '%02d/%02d/%04d %02d:%02d:%02d' % (date.day, date.month, date.year, hour, minute, second)
+
+def iso_acdsee_date(data):
+    """ Return the date as a string YYYY-MM-DD HH:MM:SS.mmm (UTC), the
+    format SQLite understands, or None if it's zero """
+    jdn, msec = struct.unpack('<II', data)
+    if jdn == 0:
+        return None
+    days, msec = divmod(msec, 86400000)
+    date = datetime.date.fromordinal(jdn - jdn_ordinal_offset + days)
+    seconds, msec = divmod(msec, 1000)
+    minutes, second = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    return '%04d-%02d-%02d %02d:%02d:%02d.%03d' % (date.year, date.month, date.day, hour, minute, second, msec)
+
+def parse_acdsee_date(text):
+    """ Return the ACDSee date (an AcdseeDate) of a string YYYY-MM-DD,
+    optionally followed by HH:MM[:SS[.mmm]] (UTC), or zero for ''.
+    Raises ValueError if it isn't a date. """
+    if not text:
+        return AcdseeDate(bytes(8))
+    dt = datetime.datetime.fromisoformat(text)
+    msec = ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000 + dt.microsecond // 1000
+    return AcdseeDate(struct.pack('<II', dt.toordinal() + jdn_ordinal_offset, msec))
+
+def acdsee_date_key(data):
+    """ Return a number which sorts the dates in order, as the bytes don't
+    because they're little-endian """
+    jdn, msec = struct.unpack('<II', data)
+    return (jdn << 32) | msec
+
+class AcdseeDate(bytes):
+    """ The 8 bytes of an ACDSee date to compare with the dates from the
+    catalog, which are bytes, in a where condition. == compares the bytes
+    but <, <=, > and >= compare the dates (even with the AcdseeDate on the
+    right, as Python tries a subclass's reflected comparison first). """
+    def _compare(self, other, compare):
+        if not isinstance(other, bytes) or len(other) != 8:
+            return NotImplemented
+        return compare(acdsee_date_key(self), acdsee_date_key(other))
+
+    def __lt__(self, other):
+        return self._compare(other, lambda a, b: a < b)
+
+    def __le__(self, other):
+        return self._compare(other, lambda a, b: a <= b)
+
+    def __gt__(self, other):
+        return self._compare(other, lambda a, b: a > b)
+
+    def __ge__(self, other):
+        return self._compare(other, lambda a, b: a >= b)
+
+def date_keys(column):
+    """ acdsee_date_key() of each date in a NumPy array of the 8 byte dates
+    (any 8 byte dtype), as uint64 """
+    column = numpy.ascontiguousarray(column).view('<u4').reshape(-1, 2)
+    return (column[:, 0].astype(numpy.uint64) << numpy.uint64(32)) | column[:, 1].astype(numpy.uint64)
+
+def decode_dates(column):
+    """ Convert a NumPy array of the 8 byte dates (any 8 byte dtype, e.g. as
+    viewed from the file) into a datetime64[ms] array with NaT for zero. """
+    column = numpy.ascontiguousarray(column).view('<u4').reshape(-1, 2)
+    jdn = column[:, 0].astype(numpy.int64)
+    msec = column[:, 1].astype(numpy.int64)
+    dates = ((jdn - jdn_unix_epoch) * 86400000 + msec).astype('datetime64[ms]')
+    dates[jdn == 0] = numpy.datetime64('NaT')
+    return dates
+
+
+def readme_parse7(data):
+    """ The parse7 from the README, to test against """
+    from datetime import datetime, timedelta, timezone
+    b = bytearray(data)
+    jdn = int.from_bytes(bytearray.fromhex(b.hex()[:8]), byteorder='little', signed=False)
+    if jdn == 0: return ''
+    msec = int.from_bytes(bytearray.fromhex(b.hex()[8:]), byteorder='little', signed=False)
+    dt_Offset = 2400001.000
+    dt = datetime(1858, 11, 17, tzinfo=timezone.utc) + timedelta(jdn-dt_Offset) + timedelta(seconds=msec // 1000)
+    return dt.strftime('%d/%m/%Y %H:%M:%S')
+
+test_dates = [bytes(8)] + [struct.pack('<II', jdn, msec)
+    for jdn in (2400001, 2440588, 2451545, 2460964, 2087000, 1900000)
+    for msec in (0, 999, 1000, 45296789, 86399999, 86400000, 90000000)]
+
+def test_format_acdsee_date():
+    for data in test_dates:
+        assert(format_acdsee_date(data) == readme_parse7(data))
+
+def test_acdsee_timestamp():
+    assert(acdsee_timestamp(bytes(8)) == None)
+    assert(acdsee_timestamp(struct.pack('<II', 2440588, 3600*1000+999)) == 3600)
+
+def test_iso_acdsee_date():
+    assert(iso_acdsee_date(bytes(8)) == None)
+    assert(iso_acdsee_date(struct.pack('<II', 2440588, 45296789)) == '1970-01-01 12:34:56.789')
+    assert(iso_acdsee_date(struct.pack('<II', 2440588, 90000000)) == '1970-01-02 01:00:00.000')
+
+def test_parse_acdsee_date():
+    assert(parse_acdsee_date('1970-01-01 12:34:56.789') == struct.pack('<II', 2440588, 45296789))
+    assert(parse_acdsee_date('2025-10-15') == struct.pack('<II', 2460964, 0) and parse_acdsee_date('') == bytes(8))
+    later = struct.pack('<II', 2440589, 0)
+    assert(later > parse_acdsee_date('1970-01-01 12:34') and not later < parse_acdsee_date('1970-01-01'))
+    assert(struct.pack('<II', 2440588, 256) < struct.pack('<II', 2440588, 1)) # as bytes
+    assert(struct.pack('<II', 2440588, 256) > AcdseeDate(struct.pack('<II', 2440588, 1)))
+    assert(sorted(test_dates[1:], key=acdsee_date_key) == sorted(test_dates[1:], key=AcdseeDate))
+    try:
+        parse_acdsee_date('yesterday')
+        assert(False)
+    except ValueError:
+        pass
+
+def test_decode_dates():
+    if numpy is None:
+        return
+    column = numpy.frombuffer(b''.join(test_dates), dtype='V8')
+    dates = decode_dates(column)
+    assert(numpy.isnat(dates[0]))
+    for data, date in zip(test_dates[1:], dates[1:]):
+        assert(date.astype('datetime64[s]').astype(datetime.datetime).strftime('%d/%m/%Y %H:%M:%S')
+            == readme_parse7(data))
+        assert(date.astype('datetime64[s]').astype(numpy.int64) == acdsee_timestamp(data))
+        if date.astype(object).year >= 1000:
+            assert(str(date) == iso_acdsee_date(data).replace(' ', 'T'))
+    assert(date_keys(column).tolist() == [acdsee_date_key(data) for data in test_dates])
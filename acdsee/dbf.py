@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+#
+# Read the dBase (.dbf) files of the ACDSee catalog, e.g. Asset.dbf.
+#
+# The records are fixed width after the header so the file is memory-mapped
+# and only the requested columns of each record are decoded. Simple filters
+# such as [('ACDDBUPOFF', '>', 0), ('RATING', '!=', 0)] are applied before
+# the rest of the record is decoded, and if NumPy is installed they are
+# applied to whole columns at once, as is read_columns().
+#
+# Handles the non-standard field types used by ACDSee, 7 (a date, returned
+# as the raw 8 bytes, or as a string by DateFieldParser, or as datetime64
+# by read_columns) and B (a double), and defaults to Code Page 437.
+# Memo fields are returned as Memo objects which only read the text from
+# the .fpt or .dbt memo file when it's used, so a scan which doesn't use
+# them doesn't read the memo file at all, or as None if it's blank or there
+# is no memo file (like ignore_missing_memo in dbfread).
+
+import collections
+import concurrent.futures
+import datetime
+import functools
+import itertools
+import mmap
+import operator
+import os
+import struct
+import tempfile
+from acdsee.dates import AcdseeDate, acdsee_date_key, date_keys, decode_dates, format_acdsee_date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Field = collections.namedtuple('Field', 'name type offset length decimals')
+memo_types = 'MGP' # and B unless it's 8 bytes, see is_memo()
+memo_cache_size = 1024 # memo blocks kept in memory by each MemoFile
+shard_size = 262144 # fewest records read by each process in parallel_records()
+
+operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<':  operator.lt,
+    '<=': operator.le,
+    '>':  operator.gt,
+    '>=': operator.ge,
+}
+
+
+# ---------------------------------------------------------------------
+def is_memo(field):
+    """ Return True if the field is the block number of a memo: M, G and P
+    fields, and B fields other than the 8 byte Visual FoxPro double """
+    return field.type in memo_types or (field.type == 'B' and field.length != 8)
+
+
+class MemoFile:
+    """ A .fpt (FoxPro) or .dbt (dBase III or IV) memo file, memory-mapped,
+    with the most recently read memo_cache_size memos cached. """
+    def __init__(self, filename, cache_size=memo_cache_size):
+        self.filename = filename
+        self.foxpro = filename.lower().endswith('.fpt')
+        with open(filename, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        if self.foxpro:
+            self.block_size = struct.unpack('>H', self.mmap[6:8])[0] or 512
+        else:
+            self.block_size = struct.unpack('<H', self.mmap[20:22])[0] or 512
+        self.read = functools.lru_cache(maxsize=cache_size)(self._read)
+
+    def _read(self, block):
+        """ Return the bytes of the memo starting at block """
+        start = block * self.block_size
+        head = self.mmap[start:start+8]
+        if len(head) < 8:
+            return None # past the end
+        if self.foxpro:
+            memo_type, length = struct.unpack('>II', head)
+            return self.mmap[start+8:start+8+length]
+        if head[:4] == b'\xff\xff\x08\x00': # dBase IV, the length includes the header
+            length = struct.unpack('<I', head[4:8])[0]
+            return self.mmap[start+8:start+length]
+        end = self.mmap.find(b'\x1a', start) # dBase III, ends with 1A 1A
+        return self.mmap[start:end if end >= 0 else len(self.mmap)]
+
+    def close(self):
+        self.read.cache_clear()
+        if self.mmap:
+            self.mmap.close()
+
+
+class Memo:
+    """ A memo field, read from the memo file when value() is called (or it
+    is converted to a string or compared). Text memos (type M) are decoded. """
+    __slots__ = ('memofile', 'block', 'encoding')
+
+    def __init__(self, memofile, block, encoding=None):
+        self.memofile = memofile
+        self.block = block
+        self.encoding = encoding
+
+    def value(self):
+        data = self.memofile.read(self.block)
+        if data is None or self.encoding is None:
+            return data
+        return data.decode(self.encoding, errors='replace')
+
+    def __str__(self):
+        value = self.value()
+        return '' if value is None else value if isinstance(value, str) else repr(value)
+
+    def __repr__(self):
+        return 'Memo(%r, %d)' % (self.memofile.filename, self.block)
+
+    def __eq__(self, other):
+        if isinstance(other, Memo):
+            return (self.memofile, self.block) == (other.memofile, other.block)
+        return self.value() == other
+
+    __hash__ = None # equal to its value, which may not be hashable the same way
+
+
+def find_memo_file(filename):
+    """ Return the name of the .fpt or .dbt memo file for a .dbf file, or None """
+    base = os.path.splitext(filename)[0]
+    for extension in ('.fpt', '.FPT', '.dbt', '.DBT'):
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+
+class FieldParser:
+    """ Convert the bytes of a field into a Python value. Like dbfread the
+    method parseX is called for field type X (or parseXX with the hex code
+    if X is not a letter or digit) so a subclass can add or replace types.
+    memofile is set by DBFTable if the table has a memo file.
+    """
+    def __init__(self, encoding='cp437'):
+        self.encoding = encoding
+        self.memofile = None
+
+    def parse(self, field, data):
+        name = 'parse' + (field.type if field.type.isalnum() else '%02X' % ord(field.type))
+        return getattr(self, name, self.parse_unknown)(field, data)
+
+    def parse_unknown(self, field, data):
+        return data
+
+    def parseC(self, field, data):
+        return data.rstrip(b'\0 ').decode(self.encoding)
+
+    def parseN(self, field, data):
+        data = data.strip().strip(b'*')
+        try:
+            return int(data)
+        except ValueError:
+            if not data.strip():
+                return None
+            return float(data.replace(b',', b'.'))
+
+    parseF = parseN
+
+    def parseL(self, field, data):
+        if data in b'TtYy':
+            return True
+        if data in b'FfNn':
+            return False
+        return None # '?' or blank
+
+    def parseD(self, field, data):
+        try:
+            return datetime.date(int(data[:4]), int(data[4:6]), int(data[6:8]))
+        except ValueError:
+            return None # blank or zero
+
+    def parseI(self, field, data):
+        return struct.unpack('<i', data)[0]
+
+    parse2B = parseI # autoincrement
+
+    def parseO(self, field, data):
+        return struct.unpack('<d', data)[0]
+
+    def parseB(self, field, data):
+        if field.length == 8:
+            return struct.unpack('<d', data)[0] # Visual FoxPro double
+        return self.parseM(field, data) # binary memo
+
+    def parseY(self, field, data):
+        return struct.unpack('<q', data)[0] / 10000
+
+    def parseM(self, field, data):
+        """ Return a Memo, or None if blank or there's no memo file. The block
+        number is 4 bytes in FoxPro, otherwise 10 digits. """
+        if self.memofile is None:
+            return None
+        if len(data) == 4:
+            block = struct.unpack('<I', data)[0]
+        else:
+            try:
+                block = int(data.strip(b' \0') or 0)
+            except ValueError:
+                return None
+        if not block:
+            return None
+        return Memo(self.memofile, block, self.encoding if field.type == 'M' else None)
+
+    parseG = parseM
+    parseP = parseM
+
+    def parse7(self, field, data):
+        return data # ACDSee date, see the README
+
+
+class DateFieldParser(FieldParser):
+    """ A FieldParser which returns the ACDSee dates as strings
+    dd/mm/YYYY HH:MM:SS (or '' if zero) like parse7 in the README """
+    def parse7(self, field, data):
+        return format_acdsee_date(data)
+
+
+# ---------------------------------------------------------------------
+def numpy_format(field):
+    """ Return the NumPy format used to view the bytes of a field. """
+    if field.type in 'I+' and field.length == 4:
+        return '<i4'
+    if (field.type == 'O' or field.type == 'B') and field.length == 8:
+        return '<f8'
+    if field.type == 'Y' and field.length == 8:
+        return '<i8'
+    if field.type in 'CNFL':
+        return 'S%d' % field.length
+    return 'V%d' % field.length
+
+def object_mask(values, op, value):
+    """ Return a boolean array of which of the values (as the parser returns
+    them) match op value, None only matching != like DBFTable._matches() """
+    return numpy.array([(op == '!=') if actual is None else bool(operators[op](actual, value))
+        for actual in values], dtype=bool)
+
+def decode_column(field, column, parser):
+    """ Decode a NumPy column of raw field values as viewed by numpy_format()
+    into a NumPy array of values, vectorised for the common types and
+    using the parser one value at a time for the others. ACDSee dates
+    become datetime64[ms] with NaT for zero. """
+    if field.type == 'C':
+        return numpy.char.rstrip(numpy.char.decode(column, parser.encoding), ' ')
+    if field.type in 'NF':
+        stripped = numpy.char.strip(column)
+        blank = (stripped == b'')
+        try:
+            values = numpy.where(blank, b'nan', stripped).astype(numpy.float64)
+        except ValueError:
+            return numpy.array([parser.parse(field, bytes(value)) for value in column], dtype=object)
+        if field.decimals == 0 and not blank.any() and (values == numpy.floor(values)).all():
+            return values.astype(numpy.int64)
+        return values
+    if field.type == 'L':
+        return numpy.isin(column, [b'T', b't', b'Y', b'y'])
+    if field.type == '7' and field.length == 8:
+        return decode_dates(column)
+    if field.type == 'Y' and column.dtype == numpy.dtype('<i8'):
+        return column / 10000
+    if column.dtype.kind in 'if':
+        return column.copy()
+    return numpy.array([parser.parse(field, value.tobytes()) for value in column], dtype=object)
+
+
+# ---------------------------------------------------------------------
+class DBFTable:
+    """ A memory-mapped dBase table. Use records() to iterate over dicts of
+    selected columns, or read_columns() to get whole columns as NumPy arrays.
+    The where argument of both is a list of (column, operator, value) tuples
+    which must all be true, the operator being one of == != < <= > >=.
+    Deleted records are skipped.
+    """
+    def __init__(self, filename, encoding='cp437', parser_class=FieldParser):
+        self.filename = filename
+        self.parser = parser_class(encoding)
+        with open(filename, 'rb') as fd:
+            header = fd.read(32)
+            numrecords, self.header_length, self.record_length = struct.unpack('<IHH', header[4:12])
+            self.fields = []
+            offset = 1 # after the deleted flag
+            while True:
+                descriptor = fd.read(32)
+                if len(descriptor) < 32 or descriptor[0] == 0x0d:
+                    break
+                name = descriptor[:11].split(b'\0')[0].decode('ascii', errors='replace')
+                length, decimals = descriptor[16], descriptor[17]
+                self.fields.append(Field(name, chr(descriptor[11]), offset, length, decimals))
+                offset += length
+            size = os.fstat(fd.fileno()).st_size
+            self.numrecords = max(0, min(numrecords, (size - self.header_length) // max(self.record_length, 1)))
+            self.mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.field_names = [field.name for field in self.fields]
+        self.field_by_name = {field.name: field for field in self.fields}
+        self.memofile = None
+        if any(is_memo(field) for field in self.fields):
+            memo_filename = find_memo_file(filename)
+            if memo_filename:
+                self.memofile = self.parser.memofile = MemoFile(memo_filename)
+
+    def __len__(self):
+        return self.numrecords
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.mmap:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass # a NumPy view still uses it, it's closed when that's freed
+        if self.memofile:
+            self.memofile.close()
+
+    def _fields(self, columns):
+        if columns is None:
+            return self.fields
+        return [self.field_by_name[name] for name in columns]
+
+    def _record(self, index):
+        start = self.header_length + index * self.record_length
+        return self.mmap[start:start+self.record_length]
+
+    def _matches(self, record, where):
+        for field, op, value in where:
+            actual = self.parser.parse(field, record[field.offset:field.offset+field.length])
+            if actual is None:
+                if op != '!=':
+                    return False
+            elif not operators[op](actual, value):
+                return False
+        return True
+
+    def _range(self, start, stop):
+        """ Clip the range of record numbers start:stop to the table """
+        stop = self.numrecords if stop is None else min(stop, self.numrecords)
+        return min(start, stop), stop
+
+    def _numpy_view(self, fields, start=0, stop=None):
+        """ Return a NumPy structured array viewing the given fields
+        (plus the deleted flag as _deleted) of records start:stop. """
+        start, stop = self._range(start, stop)
+        fields = list({field.name: field for field in fields}.values())
+        dtype = numpy.dtype({
+            'names': ['_deleted'] + [field.name for field in fields],
+            'formats': ['S1'] + [numpy_format(field) for field in fields],
+            'offsets': [0] + [field.offset for field in fields],
+            'itemsize': self.record_length})
+        return numpy.frombuffer(self.mmap, dtype=dtype, count=stop-start,
+            offset=self.header_length + start * self.record_length)
+
+    def _numpy_mask(self, view, where):
+        """ Return a boolean array of the records not deleted and matching where. """
+        mask = (view['_deleted'] != b'*')
+        for field, op, value in where:
+            if field.type == '7':
+                # Compared as the parser returns them, like _matches(), not as datetime64
+                if type(self.parser).parse7 is FieldParser.parse7 and field.length == 8:
+                    if isinstance(value, AcdseeDate) and op not in ('==', '!='):
+                        mask &= operators[op](date_keys(view[field.name]), numpy.uint64(acdsee_date_key(value)))
+                    else:
+                        mask &= operators[op](view[field.name].view('S8'), value)
+                else:
+                    mask &= object_mask([self.parser.parse(field, data.tobytes()) for data in view[field.name]], op, value)
+                continue
+            column = decode_column(field, view[field.name], self.parser)
+            if column.dtype.kind == 'f':
+                mask &= operators[op](column, value) | ((op == '!=') & numpy.isnan(column))
+            elif column.dtype.kind == 'O': # decoded by the parser, so may contain None
+                mask &= object_mask(column, op, value)
+            else:
+                mask &= operators[op](column, value)
+        return mask
+
+    def record(self, index, columns=None):
+        """ Return a dict of the given columns (default all) of record
+        number index, or None if it has been deleted. """
+        record = self._record(index)
+        if record[0] == 0x2a: # '*' deleted
+            return None
+        return {field.name: self.parser.parse(field, record[field.offset:field.offset+field.length])
+            for field in self._fields(columns)}
+
+    def records(self, columns=None, where=None, start=0, stop=None):
+        """ Yield a dict for each record (not deleted) matching where,
+        containing only the given columns (default all). Only records
+        numbered start:stop are read, so a table can be read in chunks. """
+        fields = self._fields(columns)
+        where = [(self.field_by_name[name], op, value) for name, op, value in (where or [])]
+        start, stop = self._range(start, stop)
+        if numpy is not None and stop > start and where:
+            view = self._numpy_view([field for field, op, value in where], start, stop)
+            indexes = (numpy.nonzero(self._numpy_mask(view, where))[0] + start).tolist()
+            del view # so the mmap can be closed
+            where = []
+        else:
+            indexes = range(start, stop)
+        parse = self.parser.parse
+        for index in indexes:
+            record = self._record(index)
+            if record[0] == 0x2a: # '*' deleted
+                continue
+            if where and not self._matches(record, where):
+                continue
+            yield {field.name: parse(field, record[field.offset:field.offset+field.length]) for field in fields}
+
+    def parallel_records(self, columns=None, where=None, jobs=None, min_shard=shard_size):
+        """ Like records() but the table is split into shards of at least
+        min_shard records, each read by one of jobs processes (default one
+        per CPU) which only returns the matching records, and they are
+        yielded in the same order as records(). Memo fields are read by the
+        process so they are values (strings or bytes) rather than Memo objects,
+        also when a table with too few records for two shards is read by
+        this process. Only one shard more than there are processes is read
+        ahead of the records yielded, so memory use doesn't grow with the
+        size of the table when they're used more slowly than they're read. """
+        jobs = jobs or os.cpu_count() or 1
+        shards = min(jobs * 4, self.numrecords // max(min_shard, 1))
+        if jobs <= 1 or shards <= 1:
+            for record in self.records(columns, where):
+                yield memo_values(record)
+            return
+        bounds = [self.numrecords * shard // shards for shard in range(shards + 1)]
+        ranges = zip(bounds, bounds[1:])
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, shards)) as pool:
+            def submit(start, stop):
+                return pool.submit(read_shard, self.filename, self.parser.encoding, type(self.parser),
+                    columns, where, start, stop)
+            futures = collections.deque(submit(start, stop) for start, stop in itertools.islice(ranges, jobs + 1))
+            while futures:
+                records = futures.popleft().result()
+                shard = next(ranges, None)
+                if shard:
+                    futures.append(submit(*shard))
+                yield from records
+
+    def read_columns(self, columns=None, where=None, start=0, stop=None):
+        """ Return a dict of NumPy arrays, one per column (default all), of
+        the records (not deleted) matching where, only reading the records
+        numbered start:stop. Requires NumPy. """
+        if numpy is None:
+            raise ImportError('read_columns requires numpy')
+        fields = self._fields(columns)
+        where = [(self.field_by_name[name], op, value) for name, op, value in (where or [])]
+        start, stop = self._range(start, stop)
+        if stop <= start:
+            return {field.name: numpy.array([]) for field in fields}
+        view = self._numpy_view(fields + [field for field, op, value in where], start, stop)
+        mask = self._numpy_mask(view, where)
+        result = {field.name: decode_column(field, view[field.name][mask], self.parser) for field in fields}
+        del view
+        return result
+
+
+def memo_values(record):
+    """ Replace the Memo objects in a record with their values """
+    for name, value in record.items():
+        if isinstance(value, Memo):
+            record[name] = value.value()
+    return record
+
+def read_shard(filename, encoding, parser_class, columns, where, start, stop):
+    """ Return a list of the records numbered start:stop matching where,
+    in a process started by DBFTable.parallel_records() """
+    with DBFTable(filename, encoding, parser_class) as table:
+        # A Memo can't be sent back as it refers to the memo file
+        return [memo_values(record) for record in table.records(columns, where, start, stop)]
+
+
+# ---------------------------------------------------------------------
+def encode_field(field, value, encoding='cp437'):
+    """ Return the bytes for a value in a field of the given type. """
+    if value is None:
+        return b' ' * field.length
+    if field.type == 'C':
+        return value.encode(encoding)[:field.length].ljust(field.length, b' ')
+    if field.type in 'NF':
+        text = ('%.*f' % (field.decimals, value)) if field.decimals else str(int(value))
+        return text.encode('ascii').rjust(field.length, b' ')
+    if field.type == 'L':
+        return b'T' if value else b'F'
+    if field.type == 'D':
+        return value.strftime('%Y%m%d').encode('ascii')
+    if field.type in 'I+':
+        return struct.pack('<i', value)
+    if field.type in 'OB' and field.length == 8:
+        return struct.pack('<d', value)
+    if field.type == 'Y':
+        return struct.pack('<q', round(value * 10000))
+    if is_memo(field): # block number
+        return struct.pack('<I', value) if field.length == 4 else str(value).encode('ascii').rjust(field.length, b' ')
+    return bytes(value)[:field.length].ljust(field.length, b'\0')
+
+def write_dbf(filename, fields, records, encoding='cp437', deleted=()):
+    """ Write a dBase table. fields is a list of (name, type, length, decimals)
+    and records an iterable of lists of values in the same order. Records
+    whose index is in deleted are marked as deleted. Used to make test data.
+    """
+    fields = [Field(name, type, 0, length, decimals) for name, type, length, decimals in fields]
+    header_length = 32 + 32 * len(fields) + 1
+    record_length = 1 + sum(field.length for field in fields)
+    with open(filename, 'wb') as fd:
+        fd.write(b'\0' * header_length) # rewritten when the number of records is known
+        numrecords = 0
+        for record in records:
+            flag = b'*' if numrecords in deleted else b' '
+            fd.write(flag + b''.join(encode_field(field, value, encoding) for field, value in zip(fields, record)))
+            numrecords += 1
+        fd.write(b'\x1a')
+        today = datetime.date.today()
+        header = struct.pack('<BBBBIHH20x', 0x03, today.year - 1900, today.month, today.day,
+            numrecords, header_length, record_length)
+        for field in fields:
+            header += struct.pack('<11sc4xBB14x', field.name.encode('ascii'), field.type.encode('ascii'),
+                field.length, field.decimals)
+        fd.seek(0)
+        fd.write(header + b'\x0d')
+
+def write_fpt(filename, memos, block_size=64):
+    """ Write a FoxPro memo file of the memos (bytes) and return the block
+    number of each, for write_dbf. Used to make test data. """
+    blocks = []
+    data = b''
+    next_block = max(1, 512 // block_size)
+    for memo in memos:
+        blocks.append(next_block)
+        entry = struct.pack('>II', 1, len(memo)) + memo
+        entry += b'\0' * (-len(entry) % block_size)
+        data += entry
+        next_block += len(entry) // block_size
+    with open(filename, 'wb') as fd:
+        fd.write(struct.pack('>IHH', next_block, 0, block_size).ljust(next_block * block_size - len(data), b'\0') + data)
+    return blocks
+
+
+# ---------------------------------------------------------------------
+test_fields = [('NAME', 'C', 20, 0), ('FOLDER_ID', 'B', 8, 0), ('RATING', 'N', 3, 0),
+    ('ACDDBUPOFF', 'I', 4, 0), ('FTMODIFIED', '7', 8, 0), ('NOTES', 'M', 10, 0)]
+test_records = [
+    ['café.jpg', 1.0, 3, 1, struct.pack('<II', 2460964, 45296789), None],
+    ['b.jpg', 1.0, 0, 2, bytes(8), None],
+    ['c.jpg', 2.0, 5, 0, bytes(8), None],
+    ['deleted.jpg', 2.0, 5, 1, bytes(8), None],
+    ['e.jpg', 2.0, None, 1, bytes(8), None],
+]
+
+def test_dbf_records():
+    global numpy
+    saved_numpy = numpy
+    try:
+        for numpy in set([None, saved_numpy]):
+            check_dbf_records()
+    finally:
+        numpy = saved_numpy
+
+def check_dbf_records():
+    """ The tests of test_dbf_records(), run with and without NumPy """
+    from acdsee.dates import parse_acdsee_date
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'Asset.dbf')
+        write_dbf(filename, test_fields, test_records, deleted={3})
+        with DBFTable(filename) as table:
+            assert(len(table) == 5)
+            assert(table.field_names == ['NAME', 'FOLDER_ID', 'RATING', 'ACDDBUPOFF', 'FTMODIFIED', 'NOTES'])
+            records = list(table.records())
+            assert(len(records) == 4)
+            assert(records[0] == {'NAME': 'café.jpg', 'FOLDER_ID': 1.0, 'RATING': 3, 'ACDDBUPOFF': 1,
+                'FTMODIFIED': struct.pack('<II', 2460964, 45296789), 'NOTES': None})
+            assert(records[3]['RATING'] == None)
+            records = list(table.records(['NAME'], where=[('ACDDBUPOFF', '>', 0), ('RATING', '!=', 0)]))
+            assert(records == [{'NAME': 'café.jpg'}, {'NAME': 'e.jpg'}])
+            records = list(table.records(['NAME'], where=[('ACDDBUPOFF', '>', 0), ('ACDDBUPOFF', '<', 2)]))
+            assert(records == [{'NAME': 'café.jpg'}, {'NAME': 'e.jpg'}])
+            records = list(table.records(['NAME'], where=[('ACDDBUPOFF', '>', 0)], start=1, stop=10))
+            assert(records == [{'NAME': 'b.jpg'}, {'NAME': 'e.jpg'}])
+            assert(table.record(1, ['NAME', 'RATING']) == {'NAME': 'b.jpg', 'RATING': 0})
+            records = list(table.records(['NAME'], where=[('FTMODIFIED', '==', bytes(8))]))
+            assert(records == [{'NAME': 'b.jpg'}, {'NAME': 'c.jpg'}, {'NAME': 'e.jpg'}])
+            assert(list(table.records(['NAME'], where=[('FTMODIFIED', '>', bytes(8))])) == [{'NAME': 'café.jpg'}])
+            records = list(table.records(['NAME'], where=[('FTMODIFIED', '<', parse_acdsee_date('2025-10-15 12:35'))]))
+            assert(records == [{'NAME': 'café.jpg'}, {'NAME': 'b.jpg'}, {'NAME': 'c.jpg'}, {'NAME': 'e.jpg'}])
+            assert(list(table.records(['NAME'], where=[('FTMODIFIED', '>=', parse_acdsee_date('2025-10-16'))])) == [])
+            assert(table.record(3) == None)
+        with DBFTable(filename, parser_class=DateFieldParser) as table:
+            assert([record['FTMODIFIED'] for record in table.records(['FTMODIFIED'])][:2]
+                == [format_acdsee_date(test_records[0][4]), ''])
+            assert(list(table.records(['NAME'], where=[('FTMODIFIED', '!=', '')])) == [{'NAME': 'café.jpg'}])
+        # Decoded by the parser one value at a time, with blanks as None
+        datefile = os.path.join(tmpdir, 'Dates.dbf')
+        write_dbf(datefile, [('NAME', 'C', 10, 0), ('DT', 'D', 8, 0)],
+            [['a.jpg', datetime.date(2020, 1, 1)], ['b.jpg', None], ['c.jpg', datetime.date(2018, 1, 1)]])
+        with DBFTable(datefile) as table:
+            assert(list(table.records(['NAME'], where=[('DT', '>', datetime.date(2019, 1, 1))])) == [{'NAME': 'a.jpg'}])
+            assert(list(table.records(['NAME'], where=[('DT', '!=', datetime.date(2018, 1, 1))]))
+                == [{'NAME': 'a.jpg'}, {'NAME': 'b.jpg'}])
+
+def test_dbf_memo():
+    fields = [('NAME', 'C', 10, 0), ('NOTES', 'M', 10, 0), ('RSVDMEMO1', 'M', 4, 0)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'Asset.dbf')
+        blocks = write_fpt(os.path.join(tmpdir, 'Asset.fpt'), ['café notes'.encode('cp437'), b'x' * 100, b'more'])
+        write_dbf(filename, fields, [['a.jpg', blocks[0], blocks[1]], ['b.jpg', None, blocks[2]], ['c.jpg', 0, 0]])
+        with DBFTable(filename) as table:
+            records = list(table.records())
+            assert(isinstance(records[0]['NOTES'], Memo))
+            assert(table.memofile.read.cache_info().currsize == 0) # not read until used
+            assert(records[0]['NOTES'] == 'café notes' and str(records[0]['RSVDMEMO1']) == 'x' * 100)
+            assert(records[1] == {'NAME': 'b.jpg', 'NOTES': None, 'RSVDMEMO1': 'more'})
+            assert(records[2]['NOTES'] == None and records[2]['RSVDMEMO1'] == None)
+            assert(list(table.records(['NAME'])) == [{'NAME': 'a.jpg'}, {'NAME': 'b.jpg'}, {'NAME': 'c.jpg'}])
+            records[0]['NOTES'].value()
+            assert(table.memofile.read.cache_info().hits == 1)
+        os.remove(os.path.join(tmpdir, 'Asset.fpt'))
+        with DBFTable(filename) as table:
+            assert(next(table.records())['NOTES'] == None) # no memo file
+        # dBase III memo file, 512 byte blocks ending 1A 1A
+        with open(os.path.join(tmpdir, 'Asset.DBT'), 'wb') as fd:
+            fd.write(bytes(512) + b'dbase notes\x1a\x1a'.ljust(512, b'\0') + b'second\x1a\x1a')
+        write_dbf(filename, fields[:2], [['a.jpg', 1], ['b.jpg', 2]])
+        with DBFTable(filename) as table:
+            assert([str(record['NOTES']) for record in table.records()] == ['dbase notes', 'second'])
+
+def test_dbf_parallel_records():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'Asset.dbf')
+        blocks = write_fpt(os.path.join(tmpdir, 'Asset.fpt'), [b'notes'])
+        records = [test_records[index % 5][:5] + [blocks[0] if index == 997 else None] for index in range(1000)]
+        write_dbf(filename, test_fields, records, deleted=set(range(3, 1000, 5)))
+        with DBFTable(filename) as table:
+            where = [('ACDDBUPOFF', '>', 0), ('RATING', '!=', 0)]
+            expected = list(table.records(['NAME', 'RATING', 'NOTES'], where=where))
+            assert(len(expected) == 400)
+            assert(list(table.parallel_records(['NAME', 'RATING', 'NOTES'], where=where, jobs=3, min_shard=70)) == expected)
+            assert(list(table.parallel_records(jobs=3, min_shard=70))[-2]['NOTES'] == 'notes')
+            assert(list(table.parallel_records(['NAME'], jobs=3)) == list(table.records(['NAME'])))
+            assert(type(list(table.parallel_records(['NOTES'], jobs=1))[-2]['NOTES']) == str) # as from the processes
+
+def test_dbf_read_columns():
+    if numpy is None:
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'Asset.dbf')
+        write_dbf(filename, test_fields, test_records, deleted={3})
+        with DBFTable(filename) as table:
+            columns = table.read_columns(['NAME', 'FOLDER_ID', 'RATING', 'FTMODIFIED'], where=[('RATING', '>', 0)])
+            assert(columns['NAME'].tolist() == ['café.jpg', 'c.jpg'])
+            assert(columns['FTMODIFIED'].dtype == numpy.dtype('datetime64[ms]'))
+            assert(numpy.isnat(columns['FTMODIFIED'][1]))
+            assert(table.read_columns(['NAME'], start=1, stop=4)['NAME'].tolist() == ['b.jpg', 'c.jpg'])
+            assert(columns['FOLDER_ID'].tolist() == [1.0, 2.0])
+            assert(columns['RATING'].tolist() == [3, 5])
+            view = table._numpy_view(table.fields[:1])
+        del view # close() didn't raise BufferError although the view was in use
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+#
+# The folder tree of the ACDSee catalog, from Folder.dbf.
+#
+# Each folder has a NAME and the FOLDER_ID of its parent (PRNT_ID), so to
+# get the full path of a file you need to follow the parents up to the root.
+# FolderTree does that once for every folder, so looking up the path of an
+# asset is a dictionary lookup rather than a walk up the tree.
+
+import os
+import tempfile
+
+root_ids = (None, '', 0, '0.0') # PRNT_ID of a root folder (0 == 0.0)
+
+
+class FolderTree:
+    """ The full path of every folder, resolved once, given dicts of
+    the folder name and parent id indexed by folder id. Paths use the
+    given separator. A folder whose parent doesn't exist is treated as
+    a root and remembered in orphans. A loop of parents is broken where
+    it was found and the folders in it are remembered in cycles.
+    """
+    def __init__(self, names, parents, sep='\\'):
+        self.names = names
+        self.parents = parents
+        self.sep = sep
+        self.orphans = set()
+        self.cycles = set()
+        self.paths = {}
+        for id in names:
+            self._resolve(id)
+
+    @classmethod
+    def from_dbf(cls, filename, sep='\\'):
+        """ Read the folder tree from Folder.dbf """
+        from acdsee.dbf import DBFTable # not needed to use a snapshot, see acdsee/catalog.py
+        names = {}
+        parents = {}
+        with DBFTable(filename) as table:
+            for record in table.records(['FOLDER_ID', 'NAME', 'PRNT_ID']):
+                names[record['FOLDER_ID']] = record['NAME']
+                parents[record['FOLDER_ID']] = record['PRNT_ID']
+        return cls(names, parents, sep)
+
+    def problems(self):
+        """ Return a message for each folder in a loop of parents or without a parent """
+        return (['folder %s is in a loop of parent folders' % self.path(id) for id in sorted(self.cycles)]
+            + ['folder %s has no parent folder' % self.path(id) for id in sorted(self.orphans)])
+
+    def _resolve(self, id):
+        """ Find the path of id and of all its unresolved ancestors,
+        without recursion so deep trees are not a problem. """
+        chain = []
+        on_chain = set()
+        current = id
+        prefix = None
+        while current not in self.paths:
+            chain.append(current)
+            on_chain.add(current)
+            parent = self.parents[current]
+            if parent in root_ids:
+                break
+            if parent not in self.names:
+                self.orphans.add(current)
+                break
+            if parent in on_chain:
+                self.cycles.update(chain[chain.index(parent):])
+                break
+            current = parent
+        else:
+            prefix = self.paths[current]
+        for current in reversed(chain):
+            prefix = self.names[current] if prefix is None else prefix + self.sep + self.names[current]
+            self.paths[current] = prefix
+
+    def path(self, id):
+        """ Return the full path of the folder, or '' if it's not known """
+        return self.paths.get(id, '')
+
+    def join(self, id, name):
+        """ Return the full path of the file name in the folder """
+        path = self.paths.get(id)
+        return path + self.sep + name if path else name
+
+    def remapped(self, old_prefix, new_prefix, sep=None):
+        """ Return a new FolderTree where paths starting with old_prefix
+        (ignoring case, as on Windows) start with new_prefix instead,
+        optionally changing the separator in the rest of the path. """
+        tree = FolderTree.__new__(FolderTree)
+        tree.names = self.names
+        tree.parents = self.parents
+        tree.sep = sep or self.sep
+        tree.orphans = self.orphans
+        tree.cycles = self.cycles
+        tree.paths = {}
+        old_lower = old_prefix.lower()
+        for id, path in self.paths.items():
+            path += self.sep # so old_prefix ending in sep matches the folder itself
+            if path.lower().startswith(old_lower):
+                path = new_prefix + path[len(old_prefix):]
+            if tree.sep != self.sep:
+                path = path.replace(self.sep, tree.sep)
+            if path.endswith(tree.sep):
+                path = path[:-len(tree.sep)]
+            tree.paths[id] = path
+        return tree
+
+
+def test_folder_tree():
+    names = {1.0: 'C:', 2.0: 'Users', 3.0: 'Pictures', 4.0: 'lost', 5.0: 'loop1', 6.0: 'loop2', 7.0: 'in loop'}
+    parents = {1.0: 0.0, 2.0: 1.0, 3.0: 2.0, 4.0: 99.0, 5.0: 6.0, 6.0: 5.0, 7.0: 6.0}
+    tree = FolderTree(names, parents)
+    assert(tree.path(3.0) == 'C:\\Users\\Pictures')
+    assert(tree.join(3.0, 'a.jpg') == 'C:\\Users\\Pictures\\a.jpg')
+    assert(tree.join(42.0, 'a.jpg') == 'a.jpg')
+    assert(tree.path(4.0) == 'lost')
+    assert(tree.orphans == {4.0})
+    assert(tree.cycles == {5.0, 6.0})
+    assert(tree.path(7.0).endswith('\\in loop'))
+    assert(tree.problems()[-1] == 'folder lost has no parent folder')
+    archive = tree.remapped('c:\\users\\', '/mnt/archive/', sep='/')
+    assert(archive.join(3.0, 'a.jpg') == '/mnt/archive/Pictures/a.jpg')
+    assert(archive.path(4.0) == 'lost' and archive.path(2.0) == '/mnt/archive')
+
+def test_folder_tree_from_dbf():
+    from acdsee.dbf import write_dbf
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'Folder.dbf')
+        write_dbf(filename, [('NAME', 'C', 20, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)],
+            [['root', 0.0, 1.0], ['sub', 1.0, 2.0]])
+        tree = FolderTree.from_dbf(filename, sep='/')
+        assert(tree.path(2.0) == 'root/sub')
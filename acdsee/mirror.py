@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#
+# A local SQLite copy of the ACDSee catalog tables, so the scripts can use
+# indexed queries instead of reading the whole of Asset.dbf each time,
+# often from a backup on a CIFS share.
+#   python3 -m acdsee.mirror --catalog DIR --output catalog.sqlite
+# refreshes the copy. A table is only read if its .dbf file has changed
+# (mtime or size). Tables with an id column and TS (Asset, Folder) are
+# then updated incrementally: only the id and TS of each record are
+# decoded, and only the records which are new or have a different TS are
+# decoded in full and written. Other tables are copied again.
+#
+# Values are stored as by SQLiteFieldParser, so dates are ISO strings.
+
+import argparse
+import glob
+import os
+import sqlite3
+import tempfile
+from acdsee.dates import iso_acdsee_date
+from acdsee.dbf import DBFTable, FieldParser, is_memo, operators, write_dbf
+from acdsee.folders import FolderTree
+
+key_columns = {'Asset': 'ASSET_ID', 'Folder': 'FOLDER_ID'} # unique id of each record
+indexed_columns = ['FOLDER_ID', 'ACDDBUPOFF', 'RATING', 'NAME']
+chunk_size = 65536 # records written at a time
+
+
+class SQLiteFieldParser(FieldParser):
+    """ Convert the fields into values SQLite can store """
+    def parse7(self, field, data):
+        return iso_acdsee_date(data)
+
+    def parseD(self, field, data):
+        date = FieldParser.parseD(self, field, data)
+        return date.isoformat() if date else None
+
+    def parseM(self, field, data):
+        memo = FieldParser.parseM(self, field, data)
+        return memo.value() if memo else None
+
+    parseG = parseM
+    parseP = parseM
+
+
+def sqlite_type(field):
+    """ Return the SQLite column type for a DBF field """
+    if field.type in 'C7DM':
+        return 'TEXT'
+    if field.type == 'N' and field.decimals == 0:
+        return 'INTEGER'
+    if field.type in 'I+L':
+        return 'INTEGER'
+    if is_memo(field):
+        return 'BLOB'
+    if field.type in 'NFOBY':
+        return 'REAL'
+    return 'BLOB'
+
+
+# ---------------------------------------------------------------------
+class CatalogMirror:
+    """ The SQLite copy of the catalog. refresh() brings a table up to
+    date with its .dbf file, records() queries it like DBFTable.records().
+    """
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS _dbf (tbl TEXT PRIMARY KEY, mtime REAL, size INTEGER, columns TEXT)')
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _create(self, tablename, fields):
+        """ (Re)create the table and its indexes """
+        self.conn.execute('DROP TABLE IF EXISTS "%s"' % tablename)
+        self.conn.execute('CREATE TABLE "%s" (%s)' % (tablename,
+            ', '.join('"%s" %s' % (field.name, sqlite_type(field)) for field in fields)))
+        names = [field.name for field in fields]
+        key = key_columns.get(tablename)
+        if key in names:
+            self.conn.execute('CREATE UNIQUE INDEX "%s_%s" ON "%s" ("%s")' % (tablename, key, tablename, key))
+        for name in indexed_columns:
+            if name in names and name != key:
+                self.conn.execute('CREATE INDEX "%s_%s" ON "%s" ("%s")' % (tablename, name, tablename, name))
+
+    def refresh(self, dbffile):
+        """ Update the table from the .dbf file if it has changed and return
+        a tuple (number of records written, number of records deleted),
+        or None if it hadn't changed. """
+        tablename = os.path.splitext(os.path.basename(dbffile))[0]
+        filestat = os.stat(dbffile)
+        row = self.conn.execute('SELECT mtime, size, columns FROM _dbf WHERE tbl = ?', (tablename,)).fetchone()
+        if row and row[0] == filestat.st_mtime and row[1] == filestat.st_size:
+            return None
+        with DBFTable(dbffile, parser_class=SQLiteFieldParser) as table:
+            columns = ','.join('%s:%s' % (field.name, sqlite_type(field)) for field in table.fields)
+            key = key_columns.get(tablename)
+            incremental = bool(row) and row[2] == columns and key in table.field_names and 'TS' in table.field_names
+            if not incremental:
+                self._create(tablename, table.fields)
+                indexes = range(len(table))
+                deleted = []
+            else:
+                # Only decode the id and TS of each record to find what has changed
+                stored = dict(self.conn.execute('SELECT "%s", TS FROM "%s"' % (key, tablename)))
+                indexes = []
+                seen = set()
+                for index in range(len(table)):
+                    record = table.record(index, [key, 'TS'])
+                    if record is None:
+                        continue
+                    seen.add(record[key])
+                    if record[key] not in stored or stored[record[key]] != record['TS']:
+                        indexes.append(index)
+                deleted = [id for id in stored if id not in seen]
+                self.conn.executemany('DELETE FROM "%s" WHERE "%s" = ?' % (tablename, key), [(id,) for id in deleted])
+            insert = 'INSERT OR REPLACE INTO "%s" VALUES (%s)' % (tablename, ', '.join('?' * len(table.fields)))
+            written = 0
+            for start in range(0, len(indexes), chunk_size):
+                records = [table.record(index) for index in indexes[start:start+chunk_size]]
+                records = [tuple(record.values()) for record in records if record is not None]
+                self.conn.executemany(insert, records)
+                written += len(records)
+        self.conn.execute('INSERT OR REPLACE INTO _dbf VALUES (?, ?, ?, ?)',
+            (tablename, filestat.st_mtime, filestat.st_size, columns))
+        self.conn.commit()
+        return written, len(deleted)
+
+    def records(self, tablename, columns=None, where=None):
+        """ Yield a dict for each record matching where, a list of
+        (column, operator, value) tuples like DBFTable.records() """
+        sql = 'SELECT %s FROM "%s"' % (', '.join('"%s"' % name for name in columns) if columns else '*', tablename)
+        conditions = []
+        for name, op, value in (where or []):
+            if op not in operators: # it's put in the SQL as it is
+                raise ValueError('unknown operator %r' % op)
+            # NULL is != anything, as in DBFTable
+            conditions.append('("%s" %s ?%s)' % (name, op, ' OR "%s" IS NULL' % name if op == '!=' else ''))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        cursor = self.conn.execute(sql, [value for name, op, value in (where or [])])
+        names = [description[0] for description in cursor.description]
+        for row in cursor:
+            yield dict(zip(names, row))
+
+    def folder_tree(self, sep='\\'):
+        """ Return the FolderTree of the Folder table """
+        names = {}
+        parents = {}
+        for record in self.records('Folder', ['FOLDER_ID', 'NAME', 'PRNT_ID']):
+            names[record['FOLDER_ID']] = record['NAME']
+            parents[record['FOLDER_ID']] = record['PRNT_ID']
+        return FolderTree(names, parents, sep)
+
+
+def test_catalog_mirror():
+    fields = [('NAME', 'C', 20, 0), ('FOLDER_ID', 'B', 8, 0), ('RATING', 'N', 3, 0),
+        ('ACDDBUPOFF', 'I', 4, 0), ('ASSET_ID', 'B', 8, 0), ('TS', 'I', 4, 0)]
+    records = [['a.jpg', 1.0, 3, 1, 1.0, 10], ['b.jpg', 1.0, 0, 1, 2.0, 10], ['c.jpg', 1.0, None, 0, 3.0, 10]]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbffile = os.path.join(tmpdir, 'Asset.dbf')
+        write_dbf(dbffile, fields, records)
+        write_dbf(os.path.join(tmpdir, 'Folder.dbf'), [('NAME', 'C', 20, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)],
+            [['root', 0.0, 1.0]])
+        with CatalogMirror(os.path.join(tmpdir, 'catalog.sqlite')) as mirror:
+            assert(mirror.refresh(dbffile) == (3, 0))
+            assert(mirror.refresh(dbffile) == None)
+            assert(mirror.refresh(os.path.join(tmpdir, 'Folder.dbf')) == (1, 0))
+            assert(mirror.folder_tree().join(1.0, 'a.jpg') == 'root\\a.jpg')
+            # b changed, c deleted, d added
+            records[1][2], records[1][5] = 4, 11
+            write_dbf(dbffile, fields, records + [['d.jpg', 1.0, 2, 1, 4.0, 11]], deleted={2})
+            os.utime(dbffile, (1, 1))
+            assert(mirror.refresh(dbffile) == (2, 1))
+            assert([record['NAME'] for record in mirror.records('Asset', ['NAME'], where=[('ACDDBUPOFF', '>', 0), ('RATING', '!=', 0)])]
+                == ['a.jpg', 'b.jpg', 'd.jpg'])
+            assert(list(mirror.records('Asset', ['RATING'], where=[('NAME', '==', 'b.jpg')])) == [{'RATING': 4}])
+            try:
+                list(mirror.records('Asset', ['NAME'], where=[('RATING', '= 0 OR 1 =', 1)]))
+                assert(False)
+            except ValueError:
+                pass
+
+
+# ---------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='refresh the SQLite copy of the ACDSee catalog')
+    parser.add_argument('--catalog', action="store", required=True, help='directory containing the catalog .dbf files')
+    parser.add_argument('--output', action="store", default='catalog.sqlite', help='SQLite database to update (default catalog.sqlite)')
+    parser.add_argument('--tables', action="store", default='Asset,Folder', help='comma-separated tables to copy, or all (default Asset,Folder)')
+    args = parser.parse_args()
+
+    if args.tables == 'all':
+        dbffiles = sorted(glob.glob(os.path.join(args.catalog, '*.dbf')))
+    else:
+        dbffiles = [os.path.join(args.catalog, table + '.dbf') for table in args.tables.split(',')]
+    with CatalogMirror(args.output) as mirror:
+        for dbffile in dbffiles:
+            result = mirror.refresh(dbffile)
+            if result is None:
+                print('Unchanged %s' % dbffile)
+            else:
+                print('Refreshed %s: %d records written, %d deleted' % (dbffile, *result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# Instrumentation for the scripts: the time spent in each phase of a run,
+# counters (e.g. of the reason each file was skipped, and bytes read and
+# copied) and the slowest directories, written as a JSON summary or as a
+# Prometheus textfile (for the node_exporter textfile collector).
+# profiled() optionally runs the code under cProfile and/or tracemalloc.
+
+import cProfile
+import collections
+import contextlib
+import io
+import json
+import os
+import pickle
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+class RunStats:
+    """ Counters, the time spent in each phase and the time spent in each
+    directory. Times are summed over threads, so with several threads a
+    phase can take longer than the run. Can be used from several threads,
+    and pickled to be merged from several processes with merge().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = collections.Counter()
+        self.counters = collections.Counter()
+        self.dirs = collections.Counter()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Add the time taken by the body of the with statement to the phase """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def add_dir_time(self, dirpath, seconds):
+        with self.lock:
+            self.dirs[dirpath] += seconds
+
+    def merge(self, other):
+        """ Add the times and counters from another RunStats """
+        with self.lock:
+            self.phases.update(other.phases)
+            self.counters.update(other.counters)
+            self.dirs.update(other.dirs)
+
+    def summary(self, slowest=10):
+        """ Return a dict of the elapsed time, phases, counters, files per
+        second (of the files_checked counter) and the slowest directories """
+        elapsed = time.time() - self.start
+        return dict(elapsed=round(elapsed, 3),
+            phases={name: round(seconds, 3) for name, seconds in sorted(self.phases.items())},
+            counters=dict(sorted(self.counters.items())),
+            files_per_second=round(self.counters['files_checked'] / elapsed, 1) if elapsed else 0,
+            slowest_dirs=[dict(path=path, seconds=round(seconds, 3)) for path, seconds in self.dirs.most_common(slowest)])
+
+    def write_json(self, filename):
+        """ Write the summary as JSON to the file, or stdout if '-' """
+        if filename == '-':
+            print(json.dumps(self.summary(), indent=1))
+            return
+        with open(filename, 'w') as fd:
+            json.dump(self.summary(), fd, indent=1)
+
+    def write_prometheus(self, filename, job):
+        """ Write the phases and counters in the Prometheus text format, to a
+        temporary file which is renamed so a partial file is never scraped """
+        summary = self.summary()
+        lines = ['# TYPE %s_elapsed_seconds gauge' % job,
+            '%s_elapsed_seconds %s' % (job, summary['elapsed']),
+            '# TYPE %s_phase_seconds gauge' % job]
+        lines += ['%s_phase_seconds{phase="%s"} %s' % (job, name, seconds) for name, seconds in summary['phases'].items()]
+        lines.append('# TYPE %s_count gauge' % job)
+        lines += ['%s_count{counter="%s"} %s' % (job, name, count) for name, count in summary['counters'].items()]
+        lines += ['# TYPE %s_files_per_second gauge' % job, '%s_files_per_second %s' % (job, summary['files_per_second'])]
+        with open(filename + '.tmp', 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+class CountingFileIO(io.FileIO):
+    """ A file opened for reading which counts the bytes actually read from
+    it (not those skipped with seek), e.g. io.BufferedReader(CountingFileIO(name)) """
+    bytes_read = 0
+
+    def readinto(self, buffer):
+        count = super().readinto(buffer)
+        self.bytes_read += count or 0
+        return count
+
+
+@contextlib.contextmanager
+def profiled(profile_file=None, trace_memory=False, top=20):
+    """ Run the body of the with statement under cProfile (main thread only),
+    saving the profile to profile_file and printing the top functions, and/or
+    under tracemalloc, printing the peak memory and the top allocations. """
+    profiler = None
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(top)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('Memory peak %f MB' % (peak / 1024 / 1024))
+            for stat in snapshot.statistics('lineno')[:top]:
+                print(stat)
+
+
+def test_run_stats():
+    stats = RunStats()
+    with stats.phase('walk'):
+        stats.count('files_checked', 3)
+    stats.add_time('stat', 1.5)
+    stats.add_dir_time('/a', 2.0)
+    stats.add_dir_time('/b', 1.0)
+    stats.merge(pickle.loads(pickle.dumps(stats)))
+    summary = stats.summary(slowest=1)
+    assert(summary['counters'] == {'files_checked': 6})
+    assert(summary['phases']['stat'] == 3.0)
+    assert(summary['slowest_dirs'] == [{'path': '/a', 'seconds': 4.0}])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'syncthing.prom')
+        stats.write_prometheus(filename, 'syncthing')
+        with open(filename) as fd:
+            lines = fd.read().splitlines()
+        assert('syncthing_count{counter="files_checked"} 6' in lines)
+        assert('syncthing_phase_seconds{phase="stat"} 3.0' in lines)
+        assert(os.listdir(tmpdir) == ['syncthing.prom'])
+
+def test_counting_file_io():
+    with tempfile.NamedTemporaryFile() as tmp:
+        tmp.write(b'x' * 100000)
+        tmp.flush()
+        raw = CountingFileIO(tmp.name)
+        with io.BufferedReader(raw) as fd:
+            fd.read(10)
+            fd.seek(90000)
+            fd.read(10)
+        assert(0 < raw.bytes_read < 50000)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+# Generate a synthetic ACDSee catalog and photo tree and time the slow parts
+# of the scripts on them, so performance changes can be judged.
+# e.g.
+#   ./benchmark.py --scales 10000,100000,1000000 --results benchmark.json
+# For each scale (the number of assets in the catalog) it writes, if not
+# already there, Asset.dbf and Folder.dbf with type 7 dates and a deep
+# folder tree, and a matching directory tree with one file for every
+# tree_ratio assets: JPEGs with EXIF dates and old or new style XMP
+# ratings, and .mp4.xmp sidecars. Then it times each benchmark (the best
+# of --repeat runs) and compares it with the best time recorded in the
+# results file, reporting REGRESSION (and exiting with status 1) if it is
+# more than regression_factor slower. The results file keeps the best time
+# and the last run.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import datecheck
+import syncthing
+from acdsee.dbf import DBFTable, numpy, write_dbf
+from acdsee.folders import FolderTree
+
+workdir = os.path.join(tempfile.gettempdir(), 'acdsee_benchmark')
+scales = [10000, 100000]
+tree_ratio = 10 # assets in the catalog for each file in the photo tree
+folder_size = 50 # average assets in each folder
+folder_depth = 6 # maximum depth of subfolders below the dated folders
+regression_factor = 1.2
+regression_min_seconds = 0.05 # smaller differences are noise
+jdn_unix_epoch = 2440588
+
+asset_fields = [('NAME', 'C', 60, 0), ('FOLDER_ID', 'B', 8, 0), ('SIZE', 'N', 10, 0),
+    ('WIDTH', 'I', 4, 0), ('HEIGHT', 'I', 4, 0), ('RATING', 'N', 3, 0), ('FTMODIFIED', '7', 8, 0),
+    ('EXIFDATE', '7', 8, 0), ('CRC', 'I', 4, 0), ('ACDDBUPOFF', 'I', 4, 0), ('ASSET_ID', 'B', 8, 0),
+    ('TS', 'I', 4, 0)]
+folder_fields = [('NAME', 'C', 60, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)]
+
+
+# ---------------------------------------------------------------------
+def acdsee_date(timestamp):
+    """ Return the 8 bytes of a type 7 date for a Unix timestamp """
+    days, seconds = divmod(int(timestamp), 86400)
+    return struct.pack('<II', days + jdn_unix_epoch, seconds * 1000)
+
+def dated_dirs(rng, count):
+    """ Return a list of count (timestamp, 'YYYY-MM-DD event') in the last 5 years """
+    now = time.time()
+    dirs = []
+    for i in range(count):
+        timestamp = now - rng.randrange(5 * 365 * 86400)
+        dirs.append((timestamp, time.strftime('%Y-%m-%d', time.localtime(timestamp)) + ' event%d' % i))
+    return dirs
+
+def make_catalog(catalogdir, numassets, seed=0):
+    """ Write Asset.dbf and Folder.dbf with numassets assets in dated folders
+    (and subfolders up to folder_depth deep) under the root which is
+    syncthing.catalog_prefix, so catalog_files() maps them to srcdir. """
+    rng = random.Random(seed)
+    os.makedirs(catalogdir, exist_ok=True)
+    folders = [[syncthing.catalog_prefix.rstrip('\\'), 0.0, 1.0]]
+    leaves = []
+    for timestamp, name in dated_dirs(rng, max(1, numassets // folder_size // 2)):
+        parent = float(len(folders) + 1)
+        folders.append([name, 1.0, parent])
+        leaves.append((parent, timestamp))
+        for depth in range(rng.randrange(folder_depth + 1)):
+            folders.append(['[Originals]' if rng.random() < 0.05 else 'sub%d' % depth, parent, float(len(folders) + 1)])
+            parent = float(len(folders))
+            leaves.append((parent, timestamp))
+    write_dbf(os.path.join(catalogdir, 'Folder.dbf'), folder_fields, folders)
+
+    def assets():
+        for id in range(1, numassets + 1):
+            folder_id, timestamp = rng.choice(leaves)
+            timestamp += rng.randrange(86400)
+            name = 'IMG_%07d.%s' % (id, rng.choice(['jpg', 'jpg', 'jpg', 'JPG', 'mp4']))
+            yield [name, folder_id, rng.randrange(500, 8000000), 4000, 3000, rng.choice([0, 0, 1, 2, 3, 4, 5, None]),
+                acdsee_date(timestamp), acdsee_date(timestamp), rng.randrange(-2**31, 2**31),
+                rng.choice([0, 0, 0, 1, -1]), float(id), rng.randrange(2**31)]
+    write_dbf(os.path.join(catalogdir, 'Asset.dbf'), asset_fields, assets())
+
+def make_jpeg(exif_date, xmp):
+    """ Return the bytes of a JPEG with the EXIF dates and the XMP packet """
+    data = datecheck.make_test_exif_jpeg(exif_date, exif_date, exif_date)
+    payload = syncthing.xmp_ns + xmp
+    segment = syncthing.jpeg_app1 + (len(payload) + 2).to_bytes(2, 'big') + payload
+    sos = data.index(syncthing.jpeg_sos)
+    return data[:sos] + segment + data[sos:]
+
+def make_xmp(rng, rating):
+    """ Return an XMP packet with the rating in the old or new style, or none """
+    if rating is None:
+        return b'<x:xmpmeta xmlns:x="adobe:ns:meta/"></x:xmpmeta>'
+    if rng.random() < 0.5:
+        return b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><acdsee:rating>%d</acdsee:rating></x:xmpmeta>' % rating
+    return b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:Description acdsee:rating="%d"/></x:xmpmeta>' % rating
+
+def make_photo_tree(rootdir, numfiles, seed=0):
+    """ Write numfiles JPEGs and MP4s with .mp4.xmp sidecars in dated directories
+    with subdirectories, some with EXIF dates not matching the directory """
+    rng = random.Random(seed)
+    dirs = dated_dirs(rng, max(1, numfiles // folder_size))
+    for i in range(numfiles):
+        timestamp, dirname = rng.choice(dirs)
+        dirpath = os.path.join(rootdir, dirname, *['sub%d' % depth for depth in range(rng.randrange(3))])
+        if rng.random() < 0.02:
+            dirpath = os.path.join(dirpath, '[Originals]')
+        os.makedirs(dirpath, exist_ok=True)
+        if rng.random() < 0.05:
+            timestamp += rng.choice([-1, 1]) * 30 * 86400
+        xmp = make_xmp(rng, rng.choice([None, 0, 1, 2, 3, 4, 5]))
+        if rng.random() < 0.1:
+            with open(os.path.join(dirpath, 'VID_%07d.mp4' % i), 'wb') as fd:
+                fd.write(b'\0' * rng.randrange(syncthing.min_size, 4 * syncthing.min_size))
+            with open(os.path.join(dirpath, 'VID_%07d.mp4.xmp' % i), 'wb') as fd:
+                fd.write(xmp)
+            continue
+        data = make_jpeg(time.strftime('%Y:%m:%d %H:%M:%S', time.localtime(timestamp)), xmp)
+        with open(os.path.join(dirpath, 'IMG_%07d.jpg' % i), 'wb') as fd:
+            fd.write(data + b'\0' * rng.randrange(syncthing.min_size, 4 * syncthing.min_size))
+
+def generate(scale):
+    """ Generate the catalog and photo tree for the scale, unless they
+    already exist, and return (catalogdir, photodir) """
+    scaledir = os.path.join(workdir, str(scale))
+    catalogdir = os.path.join(scaledir, 'catalog')
+    photodir = os.path.join(scaledir, 'photos')
+    if not os.path.exists(os.path.join(catalogdir, 'Asset.dbf')):
+        print('Generating catalog of %d assets in %s' % (scale, catalogdir))
+        make_catalog(catalogdir, scale)
+    if not os.path.exists(photodir):
+        print('Generating %d files in %s' % (scale // tree_ratio, photodir))
+        make_photo_tree(photodir + '.tmp', scale // tree_ratio)
+        os.rename(photodir + '.tmp', photodir)
+    return catalogdir, photodir
+
+
+# ---------------------------------------------------------------------
+def benchmarks(catalogdir, photodir, jobs):
+    """ Return a dict of name: function to time, for the generated data """
+    asset_dbf = os.path.join(catalogdir, 'Asset.dbf')
+    folder_dbf = os.path.join(catalogdir, 'Folder.dbf')
+    jpegs = [os.path.join(root, name) for root, dirs, files in os.walk(photodir) for name in files if name.endswith('.jpg')]
+    dated = sorted(os.path.join(photodir, name) for name in os.listdir(photodir))
+
+    def dbf_records():
+        with DBFTable(asset_dbf) as table:
+            for record in table.records(['NAME', 'FOLDER_ID', 'RATING'], where=[('RATING', '>', 0)]):
+                pass
+
+    def dbf_parallel_records():
+        with DBFTable(asset_dbf) as table:
+            for record in table.parallel_records(['NAME', 'FOLDER_ID', 'RATING'], where=[('RATING', '>', 0)], jobs=jobs):
+                pass
+
+    def dbf_read_columns():
+        with DBFTable(asset_dbf) as table:
+            table.read_columns(['NAME', 'FOLDER_ID', 'RATING', 'FTMODIFIED'], where=[('RATING', '>', 0)])
+
+    def folder_path():
+        folders = FolderTree.from_dbf(folder_dbf)
+        with DBFTable(asset_dbf) as table:
+            for record in table.records(['NAME', 'FOLDER_ID']):
+                folders.join(record['FOLDER_ID'], record['NAME'])
+
+    def catalog_files():
+        list(syncthing.catalog_files(catalogdir))
+
+    def find_files_to_copy():
+        with contextlib.redirect_stdout(io.StringIO()):
+            syncthing.find_files_to_copy(syncthing.SyncLedger(':memory:'), jobs=jobs)
+
+    def image_rating():
+        for filename in jpegs:
+            syncthing.image_rating(filename)
+
+    def process_dir():
+        for dirpath in dated:
+            datecheck.process_dir(dirpath)
+
+    tests = dict(dbf_records=dbf_records, dbf_parallel_records=dbf_parallel_records, dbf_read_columns=dbf_read_columns, folder_path=folder_path,
+        catalog_files=catalog_files, find_files_to_copy=find_files_to_copy, image_rating=image_rating,
+        process_dir=process_dir)
+    if numpy is None:
+        del tests['dbf_read_columns']
+    return tests
+
+def run(scale, repeat, jobs, only=None):
+    """ Time the benchmarks at the scale and return a dict of name: seconds """
+    catalogdir, photodir = generate(scale)
+    syncthing.srcdir = photodir
+    times = {}
+    for name, function in benchmarks(catalogdir, photodir, jobs).items():
+        if only and name not in only:
+            continue
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+    return times
+
+def test_benchmarks():
+    global workdir
+    saved = workdir, syncthing.srcdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            workdir = tmpdir
+            catalogdir, photodir = generate(500)
+            syncthing.srcdir = photodir
+            assert(len(os.listdir(photodir)) == 1)
+            with DBFTable(os.path.join(catalogdir, 'Asset.dbf')) as table:
+                assert(len(table) == 500)
+            assert(len(list(syncthing.catalog_files(catalogdir))) > 0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                files_to_copy, bytes_to_copy = syncthing.find_files_to_copy(syncthing.SyncLedger(':memory:'))
+            assert(0 < len(files_to_copy) < 50)
+            assert(all('[Originals]' not in path for path in files_to_copy))
+            times = run(500, 1, 2)
+            assert(set(times) >= {'dbf_records', 'folder_path', 'catalog_files', 'find_files_to_copy', 'image_rating', 'process_dir'})
+    finally:
+        workdir, syncthing.srcdir = saved
+
+
+# ---------------------------------------------------------------------
+def main():
+    global workdir
+    parser = argparse.ArgumentParser(description='benchmark the scripts on a synthetic catalog and photo tree')
+    parser.add_argument('--workdir', action="store", default=workdir, help=f'where to generate the data (default {workdir})')
+    parser.add_argument('--scales', action="store", default=','.join(map(str, scales)), help=f'comma-separated numbers of assets (default {",".join(map(str, scales))})')
+    parser.add_argument('--only', action="store", help='comma-separated benchmarks to run (default all)')
+    parser.add_argument('--repeat', action="store", type=int, default=3, help='run each benchmark this many times and keep the best (default 3)')
+    parser.add_argument('--jobs', action="store", type=int, default=syncthing.jobs, help='threads for find_files_to_copy, processes for dbf_parallel_records')
+    parser.add_argument('--results', action="store", help='JSON file of the best times, to report regressions')
+    args = parser.parse_args()
+    workdir = args.workdir
+    only = args.only.split(',') if args.only else None
+
+    results = dict(best={}, last={})
+    if args.results and os.path.exists(args.results):
+        with open(args.results) as fd:
+            results = json.load(fd)
+    regressions = 0
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        times = run(scale, args.repeat, args.jobs, only)
+        best = results['best'].setdefault(str(scale), {})
+        for name, seconds in times.items():
+            status = ''
+            if name in best and seconds > best[name] * regression_factor and seconds - best[name] > regression_min_seconds:
+                status = 'REGRESSION, best %.3f' % best[name]
+                regressions += 1
+            elif name in best and seconds < best[name]:
+                status = 'improved from %.3f' % best[name]
+            print('%8d %-20s %8.3f s  %s' % (scale, name, seconds, status))
+            best[name] = min(seconds, best.get(name, seconds))
+        results['last'][str(scale)] = times
+    if args.results:
+        with open(args.results, 'w') as fd:
+            json.dump(results, fd, indent=1, sort_keys=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
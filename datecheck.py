@@ -7,88 +7,367 @@
 # e.g. 2025-10-31 halloween party/bob's photos/image.jpg has to be 2025:10:31
 # If they are not exact but within X days then it's ok
 # e.g. 2025-12-31 hogmanay/new year/firstfooter.jpg can be 2026:01:01
+# Several directories are checked in parallel, e.g.
+#   ./datecheck.py --json report.jsonl --tolerance 2 /pictures/2025-*
 
+# The dates are read directly from the EXIF segment at the start of the file,
+# only falling back to the exif library if that can't be parsed.
 # Bugs:
 # Due to bugs in the exif library it might ignore some files as having no EXIF when in fact they do
 
-import exif
 import argparse
+import concurrent.futures
 from datetime import datetime, timedelta
-import sys
+import io
+import json
+import struct
 import os
 import re
+import tempfile
+import time
+from acdsee.stats import CountingFileIO, RunStats, profiled
 
 debug = False
 report_if_ok = False
 warn_non_jpeg = False
 warn_within_date_range = False
+tolerance_days = 3
+stats = RunStats() # time in each phase and the number of files with each result, see --stats
 
 ignored_files = ['Thumbs.db', 'ZbThumbnail.info', 'breezebrowser.dat']
 
+# EXIF tags, the IFD0 DateTime and the Exif IFD pointer, and in the Exif IFD
+exif_tag_datetime = 0x0132
+exif_tag_exif_ifd = 0x8769
+exif_tag_datetime_original = 0x9003
+exif_tag_datetime_digitized = 0x9004
+
+
+def jpeg_exif_segment(fd):
+    """ Return the TIFF data from the APP1 Exif segment of the JPEG file fd,
+    or None if there isn't one. Only the segment headers and the Exif
+    segment itself are read, other segments are skipped with a seek. """
+    if fd.read(2) != b'\xff\xd8':
+        raise ValueError('not a JPEG')
+    while True:
+        marker = fd.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            raise ValueError('bad JPEG marker')
+        while marker[1] == 0xff: # fill bytes
+            marker = b'\xff' + fd.read(1)
+            if len(marker) < 2:
+                raise ValueError('truncated JPEG')
+        if marker[1] in (0xda, 0xd9): # start of image data, or end
+            return None
+        if 0xd0 <= marker[1] <= 0xd8 or marker[1] == 0x01:
+            continue # standalone markers have no length
+        length = fd.read(2)
+        if len(length) < 2:
+            raise ValueError('truncated JPEG')
+        length = int.from_bytes(length, 'big') - 2
+        if length < 0:
+            raise ValueError('bad JPEG segment length')
+        if marker[1] == 0xe1:
+            payload = fd.read(length)
+            if payload.startswith(b'Exif\0\0'):
+                return payload[6:]
+        else:
+            fd.seek(length, os.SEEK_CUR)
+
+def read_ifd(tiff, offset, byteorder):
+    """ Return a dict of the IFD entries at offset in the TIFF data,
+    indexed by tag, each a tuple (type, count, value or offset bytes) """
+    count, = struct.unpack(byteorder + 'H', tiff[offset:offset+2])
+    entries = {}
+    for entry in range(offset + 2, offset + 2 + count * 12, 12):
+        tag, type, count = struct.unpack(byteorder + 'HHI', tiff[entry:entry+8])
+        entries[tag] = (type, count, tiff[entry+8:entry+12])
+    return entries
+
+def ifd_ascii(tiff, entry, byteorder):
+    """ Return the value of an ASCII IFD entry as a string """
+    type, count, value = entry
+    if type != 2:
+        raise ValueError('EXIF date is not ASCII')
+    if count > 4:
+        offset, = struct.unpack(byteorder + 'I', value)
+        value = tiff[offset:offset+count]
+        if len(value) < count:
+            raise ValueError('EXIF date outside the segment')
+    return value[:count].rstrip(b'\0 ').decode('ascii', errors='replace')
+
+def exif_dates(tiff):
+    """ Return a dict of datetime, datetime_digitized and datetime_original
+    (like the exif library, '' if not present) from the TIFF data. """
+    if tiff[:2] not in (b'II', b'MM'):
+        raise ValueError('bad TIFF byte order')
+    byteorder = '<' if tiff[:2] == b'II' else '>'
+    try:
+        magic, ifd0 = struct.unpack(byteorder + 'HI', tiff[2:8])
+        if magic != 42:
+            raise ValueError('bad TIFF header')
+        dates = {'datetime': '', 'datetime_digitized': '', 'datetime_original': ''}
+        entries = read_ifd(tiff, ifd0, byteorder)
+        if exif_tag_datetime in entries:
+            dates['datetime'] = ifd_ascii(tiff, entries[exif_tag_datetime], byteorder)
+        if exif_tag_exif_ifd in entries:
+            exif_ifd, = struct.unpack(byteorder + 'I', entries[exif_tag_exif_ifd][2])
+            entries = read_ifd(tiff, exif_ifd, byteorder)
+            if exif_tag_datetime_original in entries:
+                dates['datetime_original'] = ifd_ascii(tiff, entries[exif_tag_datetime_original], byteorder)
+            if exif_tag_datetime_digitized in entries:
+                dates['datetime_digitized'] = ifd_ascii(tiff, entries[exif_tag_datetime_digitized], byteorder)
+    except struct.error as e:
+        raise ValueError('truncated EXIF: %s' % e)
+    return dates
+
+def read_exif_dates(filepath):
+    """ Return a dict of the EXIF dates (see exif_dates) in the JPEG file,
+    or None if it has no EXIF. Only reads the start of the file, up to
+    the Exif segment (at most 64KB). Raises ValueError if it can't be parsed. """
+    raw = CountingFileIO(filepath)
+    try:
+        with io.BufferedReader(raw) as fd:
+            tiff = jpeg_exif_segment(fd)
+    finally:
+        stats.count('bytes_read', raw.bytes_read)
+    if tiff is None:
+        return None
+    return exif_dates(tiff)
+
+def read_exif_dates_library(filepath):
+    """ Same as read_exif_dates but using the exif library, which reads
+    the whole file, for files which read_exif_dates can't parse. """
+    import exif
+    with open(filepath, 'rb') as fd:
+        # Catch exception ValueError caused by bug https://gitlab.com/TNThieding/exif/-/issues/36
+        # (it can't find the real EXIF data, have to assume there isn't any)
+        try:
+            exif_image = exif.Image(fd)
+        except:
+            return None
+        if not exif_image.has_exif:
+            return None
+        if debug: print('EXIF tags: %s' % dir(exif_image))
+        return {
+            'datetime': exif_image.get('datetime', ''),
+            'datetime_digitized': exif_image.get('datetime_digitized', ''),
+            'datetime_original': exif_image.get('datetime_original', ''),
+        }
+
+def make_test_exif_jpeg(datetime='', datetime_original='', datetime_digitized='', byteorder='<'):
+    """ Return the bytes of a minimal JPEG with the given EXIF dates """
+    def ifd(entries, offset):
+        # entries are (tag, type, count, value), strings are put after the IFD
+        data = struct.pack(byteorder + 'H', len(entries))
+        extra = b''
+        extra_offset = offset + 2 + 12 * len(entries) + 4
+        for tag, type, count, value in entries:
+            if isinstance(value, bytes):
+                data += struct.pack(byteorder + 'HHII', tag, type, count, extra_offset + len(extra))
+                extra += value
+            else:
+                data += struct.pack(byteorder + 'HHII', tag, type, count, value)
+        return data + b'\0\0\0\0' + extra
+    exif_entries = [(tag, 2, len(value) + 1, value.encode() + b'\0')
+        for tag, value in ((exif_tag_datetime_original, datetime_original), (exif_tag_datetime_digitized, datetime_digitized)) if value]
+    ifd0_entries = [(exif_tag_datetime, 2, len(datetime) + 1, datetime.encode() + b'\0')] if datetime else []
+    ifd0_length = len(ifd(ifd0_entries + [(exif_tag_exif_ifd, 4, 1, 0)], 8))
+    ifd0 = ifd(ifd0_entries + [(exif_tag_exif_ifd, 4, 1, 8 + ifd0_length)], 8)
+    tiff = (b'II' if byteorder == '<' else b'MM') + struct.pack(byteorder + 'HI', 42, 8) + ifd0 + ifd(exif_entries, 8 + ifd0_length)
+    app0 = b'\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 9
+    app1 = b'\xff\xe1' + (len(tiff) + 8).to_bytes(2, 'big') + b'Exif\0\0' + tiff
+    return b'\xff\xd8' + app0 + app1 + b'\xff\xda\x00\x02' + b'\x00' * 1000 + b'\xff\xd9'
+
+def test_read_exif_dates():
+    with tempfile.NamedTemporaryFile() as fd:
+        for byteorder in '<>':
+            fd.seek(0)
+            fd.truncate()
+            fd.write(make_test_exif_jpeg('2025:10:31 20:00:00', '2025:10:30 19:00:00', byteorder=byteorder))
+            fd.flush()
+            assert(read_exif_dates(fd.name) == {'datetime': '2025:10:31 20:00:00',
+                'datetime_digitized': '', 'datetime_original': '2025:10:30 19:00:00'})
+        fd.seek(0)
+        fd.truncate()
+        fd.write(b'\xff\xd8\xff\xda\x00\x02')
+        fd.flush()
+        assert(read_exif_dates(fd.name) == None)
+    try:
+        jpeg_exif_segment(io.BytesIO(b'\xff\xd8\xff\xe0\x00\x01'))
+        assert(False)
+    except ValueError as e:
+        assert(str(e) == 'bad JPEG segment length')
+
 def process_dir(dirpath):
-    dirname = os.path.basename(dirpath)
-    if debug: print('Looking in directory: %s' % dirname)
-    for root, dirs, files in os.walk(dirpath):
-        #print(root,dirs,files)
-        currdirname = os.path.basename(root)
-        match = re.search('^(2[012][0-9][0-9]-[012][0-9]-[0-3][0-9])', dirname)
-        if not match:
-            print('ERROR: Not a dated directory: %s' % root)
-            continue
-        dir_date_as_exif = match[1].replace('-',':')
-        if debug: print('Directory name decodes as date: %s' % dir_date_as_exif)
-        for filename in files:
+    """ Check the dates of the JPEG files in a dated directory and its
+    subdirectories and return a list of the results, each a tuple
+    (level, message, details) where level is FIX, ERROR, WARNING, OK or
+    DEBUG and details is a dict for the JSON report (None for DEBUG).
+    Nothing is printed so it can be run in a separate process. """
+    results = []
+    def report(level, message, **details):
+        results.append((level, message, dict(level=level, **details) if level != 'DEBUG' else None))
+        if level != 'DEBUG': stats.count(level.lower())
+    dirname = os.path.basename(os.path.normpath(dirpath))
+    if debug: report('DEBUG', 'Looking in directory: %s' % dirname)
+    # The date only depends on the top-level directory name
+    match = re.search('^(2[012][0-9][0-9]-[012][0-9]-[0-3][0-9])', dirname)
+    if not match:
+        report('ERROR', 'ERROR: Not a dated directory: %s' % dirpath, path=dirpath, error='not a dated directory')
+        return results
+    dir_date_as_exif = match[1].replace('-',':')
+    if debug: report('DEBUG', 'Directory name decodes as date: %s' % dir_date_as_exif)
+    walker = os.walk(dirpath)
+    while True:
+        with stats.phase('walk'):
+            root, dirs, files = next(walker, (None, None, None))
+        if root is None:
+            break
+        dirs.sort() # so the results are always in the same order
+        for filename in sorted(files):
             if filename in ignored_files:
+                stats.count('ignored_files')
                 continue
             filepath = os.path.join(root, filename)
             if not filename.endswith('.jpg') and not filename.endswith('.JPG'):
-                if warn_non_jpeg: print('WARNING: Not a JPEG: %s' % (filepath))
+                stats.count('not_jpeg')
+                if warn_non_jpeg: report('WARNING', 'WARNING: Not a JPEG: %s' % (filepath), path=filepath, warning='not a JPEG')
                 continue
-            if debug: print('Found filename: %s' % filename)
-            with open(filepath, 'rb') as fd:
-                # Catch exception ValueError caused by bug https://gitlab.com/TNThieding/exif/-/issues/36
-                # (it can't find the real EXIF data, have to assume there isn't any)
+            if debug: report('DEBUG', 'Found filename: %s' % filename)
+            stats.count('files_checked')
+            try:
+                with stats.phase('exif_read'):
+                    exif_dates = read_exif_dates(filepath)
+            except ValueError as e:
+                if debug: report('DEBUG', 'EXIF not parsed (%s), trying exif library: %s' % (e, filepath))
+                stats.count('exif_library')
+                with stats.phase('exif_library'):
+                    exif_dates = read_exif_dates_library(filepath)
+            if not exif_dates:
+                report('ERROR', 'ERROR: No EXIF in %s' % filepath, path=filepath, error='no EXIF')
+                continue
+            # Get EXIF dates, e.g. "2013:04:08 22:58:01"
+            exif_datetime = exif_dates['datetime']
+            exif_datetime_digitized = exif_dates['datetime_digitized']
+            exif_datetime_original = exif_dates['datetime_original']
+            if debug: report('DEBUG', 'EXIF datetime: %s' % exif_datetime)
+            if debug: report('DEBUG', 'EXIF datetime digitized: %s' % exif_datetime_digitized)
+            if debug: report('DEBUG', 'EXIF datetime original: %s' % exif_datetime_original)
+            # Pick a single date, with Original as preferred date
+            if exif_datetime_original:
+                exif_datetime = exif_datetime_original
+            elif exif_datetime_digitized:
+                exif_datetime = exif_datetime_digitized
+            if not exif_datetime:
+                report('ERROR', 'ERROR: No EXIF date in file %s' % filepath, path=filepath, error='no EXIF date')
+                continue
+            exif_datetime = exif_datetime.split()[0] # get only date not time
+            if not exif_datetime.startswith(dir_date_as_exif):
                 try:
-                    exif_image = exif.Image(fd)
-                except:
-                    print('ERROR: No EXIF in %s' % filepath)
-                    continue
-                if not exif_image.has_exif:
-                    print('ERROR: No EXIF in %s' % filepath)
+                    difference = datetime.strptime(exif_datetime, '%Y:%m:%d') - datetime.strptime(dir_date_as_exif, '%Y:%m:%d')
+                except ValueError:
+                    report('ERROR', 'ERROR: Bad EXIF date %s in file %s' % (exif_datetime, filepath),
+                        path=filepath, exif_date=exif_datetime, error='bad EXIF date')
                     continue
-                if debug: print('EXIF tags: %s' % dir(exif_image))
-                # Get EXIF dates, e.g. "2013:04:08 22:58:01"
-                exif_datetime = exif_image.get('datetime', '')
-                exif_datetime_digitized = exif_image.get('datetime_digitized', '')
-                exif_datetime_original = exif_image.get('datetime_original', '')
-                if debug: print('EXIF datetime: %s' % exif_datetime)
-                if debug: print('EXIF datetime digitized: %s' % exif_datetime_digitized)
-                if debug: print('EXIF datetime original: %s' % exif_datetime_original)
-                # Pick a single date, with Original as preferred date
-                if exif_datetime_original:
-                    exif_datetime = exif_datetime_original
-                elif exif_datetime_digitized:
-                    exif_datetime = exif_datetime_digitized
-                if not exif_datetime:
-                    print('ERROR: No EXIF date in file %s' % filepath)
+                if abs(difference) < timedelta(days=tolerance_days):
+                    stats.count('within_tolerance')
+                    if warn_within_date_range: report('WARNING', 'WARNING: date %s not exact but within %d days of: %s' % (exif_datetime, tolerance_days, filepath),
+                        path=filepath, exif_date=exif_datetime, dir_date=dir_date_as_exif, warning='within %d days' % tolerance_days)
                     continue
-                exif_datetime = exif_datetime.split()[0] # get only date not time
-                if not exif_datetime.startswith(dir_date_as_exif):
-                    if datetime.strptime(exif_datetime, '%Y:%m:%d') - datetime.strptime(dir_date_as_exif, '%Y:%m:%d') < timedelta(days=3):
-                        if warn_within_date_range: print('WARNING: date %s not exact but within 3 days of: %s' % (exif_datetime, filepath))
-                        continue
-                    print('FIX: Wrong date %s not %s in file %s' % (exif_datetime, dir_date_as_exif, filepath))
-                    continue
-                if report_if_ok: print('EXIF date OK in %s' % filepath)
+                report('FIX', 'FIX: Wrong date %s not %s in file %s' % (exif_datetime, dir_date_as_exif, filepath),
+                    path=filepath, exif_date=exif_datetime, dir_date=dir_date_as_exif)
+                continue
+            if report_if_ok: report('OK', 'EXIF date OK in %s' % filepath, path=filepath, exif_date=exif_datetime, dir_date=dir_date_as_exif)
+    return results
+
+def test_process_dir():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dirpath = os.path.join(tmpdir, '2025-10-31 party')
+        os.makedirs(os.path.join(dirpath, 'sub'))
+        for filename, exif_datetime in (('a.jpg', '2025:10:31 10:00:00'), ('sub/b.jpg', '2025:01:01 10:00:00'),
+                ('c.jpg', '2025:11:01 10:00:00'), ('d.jpg', '')):
+            with open(os.path.join(dirpath, filename), 'wb') as fd:
+                fd.write(make_test_exif_jpeg(exif_datetime))
+        with open(os.path.join(dirpath, 'Thumbs.db'), 'wb') as fd:
+            fd.write(b'')
+        results = process_dir(dirpath)
+        assert([(level, details['path']) for level, message, details in results] == [
+            ('ERROR', os.path.join(dirpath, 'd.jpg')), ('FIX', os.path.join(dirpath, 'sub', 'b.jpg'))])
+        assert(results[1][2]['exif_date'] == '2025:01:01')
+        assert(process_dir(tmpdir)[0][0] == 'ERROR')
+
+
+def configure(options):
+    """ Set the global options, in this process or a worker process """
+    globals().update(options)
+
+def timed_process_dir(dirpath):
+    """ process_dir adding the time taken to the directory in stats """
+    start = time.perf_counter()
+    try:
+        return process_dir(dirpath)
+    finally:
+        stats.add_dir_time(dirpath, time.perf_counter() - start)
+
+def process_dir_stats(dirpath):
+    """ timed_process_dir in a worker process, returning the results and the stats """
+    global stats
+    stats = RunStats()
+    return timed_process_dir(dirpath), stats
 
+def check_dirs(dirs, jobs=None, jsonfd=None):
+    """ Run process_dir on each directory, in parallel in a pool of 'jobs'
+    processes, and print the results in the same order as the directories,
+    also writing them as JSON lines to jsonfd if given. """
+    options = dict(debug=debug, report_if_ok=report_if_ok, warn_non_jpeg=warn_non_jpeg,
+        warn_within_date_range=warn_within_date_range, tolerance_days=tolerance_days, ignored_files=ignored_files)
+    if jobs == 1 or len(dirs) == 1:
+        all_results = map(timed_process_dir, dirs)
+        pool = None
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=configure, initargs=(options,))
+        all_results = pool.map(process_dir_stats, dirs)
+    for results in all_results:
+        if pool:
+            results, worker_stats = results
+            stats.merge(worker_stats)
+        for level, message, details in results:
+            print(message)
+            if jsonfd and details:
+                print(json.dumps(details), file=jsonfd)
+    if pool:
+        pool.shutdown()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check the EXIF dates of JPEG files match their dated directory')
+    parser.add_argument('dirs', nargs='*', help='dated directories to check (default current directory)')
+    parser.add_argument('-d', '--debug', action="store_true", help='debug')
+    parser.add_argument('--jobs', action="store", type=int, help='number of directories to check in parallel (default number of CPUs)')
+    parser.add_argument('--json', action="store", help='also write the results as JSON lines to this file')
+    parser.add_argument('--tolerance', action="store", type=int, default=tolerance_days, help=f'dates within this many days of the directory date are OK (default {tolerance_days})')
+    parser.add_argument('--ignore', action="store", default=','.join(ignored_files), help=f'comma-separated filenames to ignore (default {",".join(ignored_files)})')
+    parser.add_argument('--stats', action="store", help='write the time taken by each phase and the number of files with each result to this JSON file (- for stdout)')
+    parser.add_argument('--prometheus', action="store", help='write the same as a Prometheus textfile, e.g. /var/lib/node_exporter/datecheck.prom')
+    parser.add_argument('--profile', action="store", help='run under cProfile, saving the profile to this file (only profiles this process)')
+    parser.add_argument('--tracemalloc', action="store_true", help='trace memory allocations and print the largest')
+    args = parser.parse_args()
+    debug = args.debug
+    tolerance_days = args.tolerance
+    ignored_files = args.ignore.split(',') if args.ignore else []
     # List of directories given as arguments
-    dirs = sys.argv[1:]
+    dirs = args.dirs
     # Current directory, if none given
     if not dirs:
         dirs = [os.getcwd()]
-    # Process each directory in turn
-    for dirpath in dirs:
-        process_dir(dirpath)
+    # Process the directories in parallel but report in the same order
+    jsonfd = open(args.json, 'w') if args.json else None
+    with profiled(args.profile, args.tracemalloc):
+        check_dirs(dirs, args.jobs, jsonfd)
+    if jsonfd:
+        jsonfd.close()
+    if args.stats:
+        stats.write_json(args.stats)
+    if args.prometheus:
+        stats.write_prometheus(args.prometheus, 'datecheck')
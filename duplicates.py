@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Find duplicate files in the ACDSee catalog, e.g. the same photo in a
+# laptop backup, in the ixus share and in Pixel_Camera_Sync.
+# e.g.
+#   ./duplicates.py                                   (report from the catalog only)
+#   ./duplicates.py --verify --remap '\\saucy2\arb_pictures=/mnt/pictures'
+#   ./duplicates.py --verify --plan dedupe.sh --prefer '\\saucy2\arb_pictures\ixus'
+# Candidates are assets with the same SIZE and CRC in Asset.dbf, found
+# with one pass over the catalog using a dictionary, so it's linear in
+# the number of assets and never compares pairs of files.
+# With --verify only the files in a group of candidates are read: first
+# the start of each file and then, if that matches another, the whole file.
+# With --plan it writes a shell script which replaces each verified
+# duplicate with a hard link to the copy that is kept, if they're on the
+# same filesystem.
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import shlex
+import tempfile
+from acdsee.dbf import DBFTable, write_dbf
+from acdsee.folders import FolderTree
+
+catalogdir='/mnt/cifs/documents/Backup/ACDSee/170Ult/Default'
+partial_size = 64*1024 # bytes hashed first to rule out most non-duplicates
+
+
+def catalog_duplicates(catalogdir):
+    """ Return a list of groups of assets with the same SIZE and CRC, each
+    a tuple (size, crc, [(folder_id, name, width, height), ...]).
+    Assets with no SIZE or CRC are ignored as they can't be compared. """
+    groups = {}
+    with DBFTable(os.path.join(catalogdir, 'Asset.dbf')) as table:
+        for record in table.records(['NAME', 'FOLDER_ID', 'SIZE', 'CRC', 'WIDTH', 'HEIGHT'],
+                where=[('SIZE', '>', 0), ('CRC', '!=', 0)]):
+            key = (record['SIZE'], record['CRC'])
+            groups.setdefault(key, []).append((record['FOLDER_ID'], record['NAME'], record['WIDTH'], record['HEIGHT']))
+    return sorted((size, crc, assets) for (size, crc), assets in groups.items() if len(assets) > 1)
+
+
+# ---------------------------------------------------------------------
+def file_hash(filename, size=None):
+    """ Return the SHA-256 of the first size bytes of the file (all if None),
+    or None if it can't be read. """
+    digest = hashlib.sha256()
+    try:
+        with open(filename, 'rb') as fd:
+            if size is not None:
+                digest.update(fd.read(size))
+            else:
+                while True:
+                    chunk = fd.read(1024*1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+def split_by_hash(paths, size, pool):
+    """ Split the paths into lists of files with the same hash of the first
+    size bytes (all if None), dropping unreadable files and single files """
+    by_hash = {}
+    for path, digest in zip(paths, pool.map(file_hash, paths, [size] * len(paths))):
+        if digest is not None:
+            by_hash.setdefault(digest, []).append(path)
+    return [same for same in by_hash.values() if len(same) > 1]
+
+def confirm_duplicates(paths, pool):
+    """ Return lists of the paths which really have the same content,
+    reading the whole file only when the start of it matches another. """
+    confirmed = []
+    for same_start in split_by_hash(paths, partial_size, pool):
+        confirmed.extend(split_by_hash(same_start, None, pool))
+    return confirmed
+
+def test_confirm_duplicates():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data = os.urandom(partial_size + 10)
+        contents = {'a': data, 'b': data, 'c': data[:-1] + b'x', 'd': data[:-1] + b'x', 'e': data[:-1] + b'y'}
+        for name, content in contents.items():
+            with open(os.path.join(tmpdir, name), 'wb') as fd:
+                fd.write(content)
+        paths = [os.path.join(tmpdir, name) for name in 'abcdez']
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            confirmed = confirm_duplicates(paths, pool)
+        assert(sorted(confirmed) == [paths[0:2], paths[2:4]])
+
+
+# ---------------------------------------------------------------------
+def keep_first(paths, prefer):
+    """ Sort the paths so the one to keep is first, preferring those
+    starting with one of the prefixes (in order, ignoring case) """
+    def priority(path):
+        for index, prefix in enumerate(prefer):
+            if path.lower().startswith(prefix.lower()):
+                return (index, path)
+        return (len(prefer), path)
+    return sorted(paths, key=priority)
+
+def link_commands(kept, duplicates):
+    """ Return the shell commands replacing each of the duplicates with a
+    hard link to kept, or a comment for those which can't be linked
+    because they're on a different filesystem (or can't be found) """
+    try:
+        device = os.stat(kept).st_dev
+    except OSError:
+        device = None
+    commands = []
+    for duplicate in duplicates:
+        try:
+            same_device = device is not None and os.stat(duplicate).st_dev == device
+        except OSError:
+            same_device = False
+        if same_device:
+            commands.append('ln -f %s %s' % (shlex.quote(kept), shlex.quote(duplicate)))
+        else:
+            commands.append('# not on the same filesystem as %s: %s' % (kept, duplicate))
+    return commands
+
+def test_link_commands():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, name) for name in ('a.jpg', "it's b.jpg")]
+        for path in paths:
+            open(path, 'w').close()
+        commands = link_commands(paths[0], paths[1:] + ['/nonexistent/c.jpg'])
+        assert(shlex.split(commands[0]) == ['ln', '-f', paths[0], paths[1]])
+        assert(commands[1].startswith('# not on the same filesystem'))
+
+def test_catalog_duplicates():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_dbf(os.path.join(tmpdir, 'Folder.dbf'),
+            [('NAME', 'C', 20, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)],
+            [['C:', 0.0, 1.0], ['laptop', 1.0, 2.0], ['ixus', 1.0, 3.0]])
+        write_dbf(os.path.join(tmpdir, 'Asset.dbf'),
+            [('NAME', 'C', 20, 0), ('FOLDER_ID', 'B', 8, 0), ('SIZE', 'N', 10, 0),
+             ('CRC', 'I', 4, 0), ('WIDTH', 'I', 4, 0), ('HEIGHT', 'I', 4, 0)],
+            [['a.jpg', 2.0, 5000, -12345, 40, 30], ['a.jpg', 3.0, 5000, -12345, 40, 30],
+             ['b.jpg', 2.0, 5000, 12345, 40, 30], ['c.jpg', 2.0, 0, 0, 0, 0], ['d.jpg', 3.0, 0, 0, 0, 0]])
+        folders = FolderTree.from_dbf(os.path.join(tmpdir, 'Folder.dbf'))
+        groups = catalog_duplicates(tmpdir)
+        assert(groups == [(5000, -12345, [(2.0, 'a.jpg', 40, 30), (3.0, 'a.jpg', 40, 30)])])
+        paths = [folders.join(id, name) for id, name, width, height in groups[0][2]]
+        assert(keep_first(paths, ['c:\\IXUS']) == ['C:\\ixus\\a.jpg', 'C:\\laptop\\a.jpg'])
+
+
+# ---------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='find duplicate files in the ACDSee catalog')
+    parser.add_argument('--catalog', action="store", default=catalogdir, help=f'directory containing the catalog .dbf files (default {catalogdir})')
+    parser.add_argument('--verify', action="store_true", help='read the files to confirm they really are the same')
+    parser.add_argument('--remap', action="append", default=[], help='OLD=NEW replace the catalog path prefix OLD with NEW to find the files (repeatable)')
+    parser.add_argument('--prefer', action="append", default=[], help='keep the copy whose catalog path starts with this prefix (repeatable, in order)')
+    parser.add_argument('--plan', action="store", help='write a shell script to hard link the verified duplicates to the copy kept')
+    parser.add_argument('--jobs', action="store", default=8, type=int, help='number of files to read in parallel (default 8)')
+    args = parser.parse_args()
+    if args.plan and not args.verify:
+        parser.error('--plan needs --verify')
+
+    folders = FolderTree.from_dbf(os.path.join(args.catalog, 'Folder.dbf'))
+    local_folders = folders
+    for remap in args.remap:
+        old, new = remap.split('=', 1)
+        local_folders = local_folders.remapped(old, new, sep=os.sep)
+    print('Reading %s' % os.path.join(args.catalog, 'Asset.dbf'))
+    groups = catalog_duplicates(args.catalog)
+
+    wasted = 0
+    planfd = open(args.plan, 'w') if args.plan else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for size, crc, assets in groups:
+            paths = keep_first([folders.join(id, name) for id, name, width, height in assets], args.prefer)
+            width, height = assets[0][2], assets[0][3]
+            if not args.verify:
+                print('DUPLICATES %d bytes %sx%s: %s' % (size, width, height, '  '.join(paths)))
+                wasted += size * (len(paths) - 1)
+                continue
+            # Read the files by their local path but report the catalog path
+            local = {local_folders.join(id, name): folders.join(id, name) for id, name, width, height in assets}
+            for same in confirm_duplicates(list(local), pool):
+                same = keep_first([local[path] for path in same], args.prefer)
+                print('VERIFIED DUPLICATES %d bytes %sx%s: %s' % (size, width, height, '  '.join(same)))
+                wasted += size * (len(same) - 1)
+                if planfd:
+                    by_catalog = {catalog: path for path, catalog in local.items()}
+                    for command in link_commands(by_catalog[same[0]], [by_catalog[duplicate] for duplicate in same[1:]]):
+                        print(command, file=planfd)
+    if planfd:
+        planfd.close()
+    print('%d groups of candidates in the catalog, %f MB could be saved' % (len(groups), wasted / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
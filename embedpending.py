@@ -2,48 +2,52 @@
 
 # Read the database and display all files which have Embed Pending flag
 # (ACDDBUPOFF non-zero)
-
-import sys
-import glob
+# The catalog is read from a snapshot (see acdsee/catalog.py) which is only
+# rebuilt from the .dbf files when they change, use --no-snapshot to
+# read the .dbf files every time.
+# Use --mirror catalog.sqlite to query the SQLite copy of the catalog made by
+#   python3 -m acdsee.mirror --catalog DIR --output catalog.sqlite
+# instead of reading the .dbf files.
+
+import argparse
 import os
-from dbfread2 import DBF, FieldParser
+from acdsee.catalog import Catalog, snapshot_file
 
 #catalogdir='/mnt/cifs/documents/Backup/ACDSee/170Ult/Default'
 catalogdir="c:\\Users\\arb\\AppData\\Local\\ACD Systems\\Catalogs\\170Ult\\Default"
 
-folder = dict()
-folder_parent = dict()
-
-def read_folders(folder_dbf_filename):
-    global folder, folder_parent
-    print('Reading %s' % folder_dbf_filename)
-    table = DBF(folder_dbf_filename, parser_class=TestFieldParser, encoding='cp437', ignore_missing_memo=True)
-    for record in table:
-        folder[record['FOLDER_ID']] = record['NAME']
-        folder_parent[record['FOLDER_ID']] = record['PRNT_ID']
-
-def folder_path(id):
-    path = ''
-    while id != '0.0':
-        if id in folder:
-            path = folder[id] + '\\' + path
-            id = folder_parent[id]
-        else:
-            break
-    return path
-
-class TestFieldParser(FieldParser):
-    def parse7(self, field, data):
-        #print(field.name, data)
-        return data
-
-read_folders(catalogdir + '/Folder.dbf')
-
-for dbffile in glob.glob(catalogdir + '/Asset.dbf'):
-    print('Extract %s' % (dbffile))
-    table = DBF(dbffile, parser_class=TestFieldParser, encoding='cp437', ignore_missing_memo=True)
-    for record in table:
-        if record['ACDDBUPOFF'] > 0:
-            #print('%s in %s rating %s' % (record['NAME'], record['FOLDER_ID'], record['RATING']))
-            print('%s%s flag %s rating %s' % (folder_path(record['FOLDER_ID']), record['NAME'],
-                record['ACDDBUPOFF'], record['RATING']))
+def print_pending(folders, records):
+    for record in records:
+        #print('%s in %s rating %s' % (record['NAME'], record['FOLDER_ID'], record['RATING']))
+        print('%s flag %s rating %s' % (folders.join(record['FOLDER_ID'], record['NAME']),
+            record['ACDDBUPOFF'], record['RATING']))
+
+def main():
+    parser = argparse.ArgumentParser(description='list the files flagged Embed Pending in the ACDSee catalog')
+    parser.add_argument('--catalog', action="store", default=catalogdir, help=f'directory containing the catalog .dbf files (default {catalogdir})')
+    parser.add_argument('--snapshot', action="store", default=snapshot_file, help=f'snapshot of the catalog (default {snapshot_file})')
+    parser.add_argument('--no-snapshot', action="store_const", const=None, dest='snapshot', help='read the .dbf files every time')
+    parser.add_argument('--jobs', action="store", default=os.cpu_count(), type=int, help='number of processes reading Asset.dbf when there\'s no up to date snapshot (default one per CPU)')
+    parser.add_argument('--mirror', action="store", help='query this SQLite copy of the catalog instead')
+    args = parser.parse_args()
+
+    columns = ['NAME', 'FOLDER_ID', 'ACDDBUPOFF', 'RATING']
+    where = [('ACDDBUPOFF', '>', 0)]
+    if args.mirror:
+        from acdsee.mirror import CatalogMirror
+        catalog = CatalogMirror(args.mirror)
+        folders = catalog.folder_tree()
+        records = catalog.records('Asset', columns, where=where)
+    else:
+        print('Reading %s' % args.catalog)
+        catalog = Catalog(args.catalog, snapshot=args.snapshot, jobs=args.jobs)
+        folders = catalog.folders
+        records = catalog.records(columns, where=where)
+    for problem in folders.problems():
+        print('WARNING: %s' % problem)
+    with catalog:
+        print_pending(folders, records)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,189 @@
 #!/usr/bin/env python3
 
-import sys
+# Export the tables of the ACDSee catalog to CSV, SQLite, Parquet or Arrow IPC
+# e.g.
+#   ./extract.py --tables Folder                  (Folder.dbf to Folder.dbf.csv)
+#   ./extract.py --format sqlite                  (every table to TABLE.dbf.sqlite)
+#   ./extract.py --tables Asset --format parquet --columns NAME,FOLDER_ID,RATING,FTMODIFIED
+# CSV has the dates as dd/mm/YYYY HH:MM:SS strings like the README.
+# The other formats keep the types: numbers, booleans, dates and
+# timestamps (UTC). Each table is read and written in chunks of records
+# so memory use doesn't depend on the size of the table, and several
+# tables can be exported at once in separate processes.
+# Parquet and Arrow need pyarrow (and numpy).
+
+import argparse
+import concurrent.futures
 import csv
 import glob
+import importlib.util
 import os
-from dbfread2 import DBF
+import sqlite3
+from acdsee.dbf import DBFTable, DateFieldParser, is_memo
+from acdsee.mirror import SQLiteFieldParser, sqlite_type
 
 rootdir='/mnt/cifs/documents/Backup/ACDSee/170Ult/Default'
+formats = ['csv', 'sqlite', 'parquet', 'arrow']
+chunk_size = 65536 # records read and written at a time
+
+
+def arrow_type(field):
+    """ Return the Arrow type for a DBF field """
+    import pyarrow
+    if field.type in 'CM':
+        return pyarrow.string()
+    if is_memo(field):
+        return pyarrow.binary()
+    if field.type == 'N' and field.decimals == 0:
+        return pyarrow.int64()
+    if field.type in 'I+':
+        return pyarrow.int32()
+    if field.type in 'NFOBY':
+        return pyarrow.float64()
+    if field.type == 'L':
+        return pyarrow.bool_()
+    if field.type == 'D':
+        return pyarrow.date32()
+    if field.type == '7' and field.length == 8:
+        return pyarrow.timestamp('ms', tz='UTC')
+    return pyarrow.binary()
+
+
+# ---------------------------------------------------------------------
+def export_csv(dbffile, columns, outfile):
+    """ Export to CSV with the dates as strings, like before """
+    with DBFTable(dbffile, parser_class=DateFieldParser) as table:
+        fields = table.fields if columns is None else [table.field_by_name[name] for name in columns]
+        with open(outfile, 'w', newline='') as csvfd:
+            writer = csv.writer(csvfd)
+            writer.writerow([field.name for field in fields])
+            count = 0
+            for start in range(0, len(table), chunk_size):
+                rows = [list(record.values()) for record in table.records(columns, start=start, stop=start+chunk_size)]
+                writer.writerows(rows)
+                count += len(rows)
+    return count
 
-from dbfread2 import DBF, FieldParser
+def export_sqlite(dbffile, columns, outfile):
+    """ Export to a table in a SQLite database, replacing it if it exists """
+    tablename = os.path.splitext(os.path.basename(dbffile))[0]
+    with DBFTable(dbffile, parser_class=SQLiteFieldParser) as table:
+        fields = table.fields if columns is None else [table.field_by_name[name] for name in columns]
+        conn = sqlite3.connect(outfile)
+        conn.execute('DROP TABLE IF EXISTS "%s"' % tablename)
+        conn.execute('CREATE TABLE "%s" (%s)' % (tablename,
+            ', '.join('"%s" %s' % (field.name, sqlite_type(field)) for field in fields)))
+        insert = 'INSERT INTO "%s" VALUES (%s)' % (tablename, ', '.join('?' * len(fields)))
+        count = 0
+        for start in range(0, len(table), chunk_size):
+            rows = [tuple(record.values()) for record in table.records(columns, start=start, stop=start+chunk_size)]
+            conn.executemany(insert, rows)
+            count += len(rows)
+        conn.commit()
+        conn.close()
+    return count
 
-class TestFieldParser_Simple(FieldParser):
-    def parse7(self, field, data):
-        #print(field.name, data)
-        return data
+def export_arrow(dbffile, columns, outfile, fmt):
+    """ Export to Parquet or Arrow IPC in record batches of chunk_size """
+    import pyarrow
+    import pyarrow.parquet
+    with DBFTable(dbffile) as table:
+        fields = table.fields if columns is None else [table.field_by_name[name] for name in columns]
+        schema = pyarrow.schema([(field.name, arrow_type(field)) for field in fields])
+        if fmt == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(outfile, schema)
+        else:
+            writer = pyarrow.ipc.new_file(outfile, schema)
+        count = 0
+        for start in range(0, len(table), chunk_size):
+            chunk = table.read_columns([field.name for field in fields], start=start, stop=start+chunk_size)
+            arrays = []
+            for field in fields:
+                values = chunk[field.name]
+                if is_memo(field):
+                    values = [memo.value() if memo else None for memo in values]
+                arrays.append(pyarrow.array(values, type=arrow_type(field), from_pandas=True))
+            batch = pyarrow.record_batch(arrays, schema=schema)
+            count += batch.num_rows
+            if fmt == 'parquet':
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+        writer.close()
+    return count
 
-from datetime import datetime, timedelta, timezone
+def export_table(dbffile, fmt, columns, outdir):
+    """ Export one table, only the given columns (those in this table, or
+    all if None) and return a tuple (dbffile, outfile, number of records) """
+    outfile = os.path.join(outdir, os.path.basename(dbffile) + '.' + fmt)
+    if columns is not None:
+        with DBFTable(dbffile) as table:
+            columns = [name for name in columns if name in table.field_by_name]
+        if not columns:
+            return dbffile, None, 0
+    if fmt == 'csv':
+        count = export_csv(dbffile, columns, outfile)
+    elif fmt == 'sqlite':
+        count = export_sqlite(dbffile, columns, outfile)
+    else:
+        count = export_arrow(dbffile, columns, outfile, fmt)
+    return dbffile, outfile, count
 
-class TestFieldParser(FieldParser):
-    def parse7(self, field, data):
-        b = bytearray(data)
+def test_export_table():
+    import tempfile
+    from acdsee.dbf import write_dbf, write_fpt, test_fields, test_records
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbffile = os.path.join(tmpdir, 'Asset.dbf')
+        write_dbf(dbffile, test_fields, test_records, deleted={3})
+        assert(export_table(dbffile, 'csv', ['NAME', 'FTMODIFIED', 'XXX'], tmpdir)[1:] == (dbffile + '.csv', 4))
+        with open(dbffile + '.csv') as fd:
+            assert(fd.readline().strip() == 'NAME,FTMODIFIED')
+            assert(fd.readline().strip() == 'café.jpg,15/10/2025 12:34:56')
+        assert(export_table(dbffile, 'sqlite', None, tmpdir)[2] == 4)
+        conn = sqlite3.connect(dbffile + '.sqlite')
+        assert(conn.execute('SELECT NAME, RATING, FTMODIFIED FROM Asset').fetchall()
+            == [('café.jpg', 3, '2025-10-15 12:34:56.789'), ('b.jpg', 0, None), ('c.jpg', 5, None), ('e.jpg', None, None)])
+        conn.close()
+        assert(export_table(dbffile, 'csv', ['XXX'], tmpdir)[1] == None)
+        if importlib.util.find_spec('pyarrow'):
+            import pyarrow.parquet
+            assert(export_table(dbffile, 'parquet', ['NAME', 'RATING'], tmpdir)[2] == 4)
+            # A B field other than 8 bytes is a binary memo
+            blocks = write_fpt(os.path.join(tmpdir, 'Asset.fpt'), [b'\x00\x01'])
+            write_dbf(dbffile, [('NAME', 'C', 10, 0), ('THUMB', 'B', 4, 0)], [['a.jpg', blocks[0]], ['b.jpg', 0]])
+            export_table(dbffile, 'parquet', None, tmpdir)
+            assert(pyarrow.parquet.read_table(dbffile + '.parquet').column('THUMB').to_pylist() == [b'\x00\x01', None])
 
-        # first 4 bytes is an integer Julian Date Number
-        jdn = int.from_bytes(bytearray.fromhex(b.hex()[:8]), byteorder='little', signed=False)
-        if jdn == 0: return ''  # prevent the csv filling up with 0 dates
 
-        # last 4 bytes is the number of milliseconds since the start of the day
-        msec = int.from_bytes(bytearray.fromhex(b.hex()[8:]), byteorder='little', signed=False)
+# ---------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='export the ACDSee catalog tables')
+    parser.add_argument('--catalog', action="store", default=rootdir, help=f'directory containing the catalog .dbf files (default {rootdir})')
+    parser.add_argument('--tables', action="store", help='comma-separated tables to export, e.g. Asset,Folder (default all)')
+    parser.add_argument('--columns', action="store", help='comma-separated columns to export (default all)')
+    parser.add_argument('--format', action="store", default='csv', choices=formats, help='output format (default csv)')
+    parser.add_argument('--output', action="store", default='.', help='directory to write the files (default current directory)')
+    parser.add_argument('--jobs', action="store", default=1, type=int, help='number of tables to export in parallel (default 1)')
+    args = parser.parse_args()
 
-        # use arbitrary offset to move date calculations into modern era
-        # https://stackoverflow.com/questions/64836743/julian-day-number-to-local-date-time-in-python
-        dt_Offset = 2400001.000 # 1858-11-17 12:00 (note: the 12 hour addition to align ADCsee date format)
-        dt = datetime(1858, 11, 17, tzinfo=timezone.utc) + timedelta(jdn-dt_Offset) + timedelta(seconds=msec // 1000)
+    if args.tables:
+        dbffiles = [os.path.join(args.catalog, table + '.dbf') for table in args.tables.split(',')]
+    else:
+        dbffiles = sorted(glob.glob(os.path.join(args.catalog, '*.dbf')))
+    columns = args.columns.split(',') if args.columns else None
 
-        dtString = dt.strftime('%d/%m/%Y %H:%M:%S') # convert to desired time format
-        #print(field.name, dtString)
-        return dtString
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = []
+        for dbffile in dbffiles:
+            print('Extract %s' % (dbffile))
+            futures.append(pool.submit(export_table, dbffile, args.format, columns, args.output))
+        for future in futures:
+            dbffile, outfile, count = future.result()
+            if outfile:
+                print('Extracted %d records from %s to %s' % (count, dbffile, outfile))
+            else:
+                print('Skipped %s, none of the columns' % dbffile)
 
 
-for dbffile in glob.glob(rootdir + '/Folder.dbf'):
-    csvfile = os.path.basename(dbffile) + '.csv'
-    print('Extract %s to %s' % (dbffile, csvfile))
-    table = DBF(dbffile, parser_class=TestFieldParser, encoding='cp437', ignore_missing_memo=True)
-    with open(csvfile, 'w') as csvfd:
-        writer = csv.writer(csvfd)
-        writer.writerow(table.field_names)
-        for record in table:
-            writer.writerow(list(record.values()))
+if __name__ == '__main__':
+    main()
@@ -6,133 +6,296 @@
 # If no longer on local disk, use same folder path but inside \\saucy2
 # and see if it exists there, so it could be restored and embedded,
 # but if not there then say NOT THERE
+# The catalog is read from a snapshot (see acdsee/catalog.py) which is only
+# rebuilt from the .dbf files when they change, use --no-snapshot to
+# read the .dbf files every time.
+# Use --mirror catalog.sqlite to query the SQLite copy of the catalog
+# (see acdsee/mirror.py) instead of reading the .dbf files.
 
 import argparse
-import sys
-import glob
+import array
+import concurrent.futures
 import os
 import shutil
-from dbfread2 import DBF, FieldParser
+import zlib
+from acdsee.assets import AssetStore
+from acdsee.catalog import Catalog, snapshot_file
+from acdsee.folders import FolderTree
 
 catalogdir="c:\\Users\\arb\\AppData\\Local\\ACD Systems\\Catalogs\\170Ult\\Default"
 archivedir="\\\\saucy2\\arb_pictures\\ixus"
 localdir="c:\\Users\\arb\\Pictures"
-localprefix="\\Users\\arb\\Pictures\\"
+localprefix="c:\\Users\\arb\\Pictures\\" # localdir as it starts the catalog folder paths
 do_copy = False
 logfile = 'restore.log'
 putback_file = 'restore_back.sh'
-
-folder = dict()
-folder_parent = dict()
-
-if len(sys.argv)>1:
-    if sys.argv[1] == '--copy':
-        do_copy = True
+listing_jobs = 16 # number of directories to list at once
+copy_jobs = 4 # number of files to restore at once
+catalog = None # the Catalog, or the CatalogMirror if --mirror
+ALREADY_EXISTS, RESTORE, MISSING, NOT_LOCAL = 'already exists', 'restore', 'missing', 'not local' # see plan_restore()
 
 def printv(str):
     print(str)
     with open(logfile, 'a') as fd:
         print(str, file=fd)
 
-def read_folders(folder_dbf_filename):
-    global folder, folder_parent
-    printv('Reading %s' % folder_dbf_filename)
-    table = DBF(folder_dbf_filename, parser_class=TestFieldParser, encoding='cp437', ignore_missing_memo=True)
-    for record in table:
-        folder[record['FOLDER_ID']] = record['NAME']
-        folder_parent[record['FOLDER_ID']] = record['PRNT_ID']
-
-def folder_path(id):
-    path = ''
-    while id != '0.0':
-        if id in folder:
-            path = os.path.join(folder[id], path)
-            id = folder_parent[id]
+def read_folders():
+    printv('Reading folders of %s' % catalogdir)
+    folders = catalog.folders if isinstance(catalog, Catalog) else catalog.folder_tree(sep=os.sep)
+    for problem in folders.problems():
+        printv('WARNING: %s' % problem)
+    return folders
+
+def archive_tree(folders):
+    """ The same folders but in the archive: those in localprefix (with
+    the drive, ignoring case) are moved into archivedir """
+    return folders.remapped(localprefix, archivedir.rstrip(folders.sep) + folders.sep)
+
+def test_archive_tree():
+    names = {1.0: 'C:', 2.0: 'Users', 3.0: 'arb', 4.0: 'Pictures', 5.0: '2020', 6.0: 'Documents'}
+    parents = {1.0: 0.0, 2.0: 1.0, 3.0: 2.0, 4.0: 3.0, 5.0: 4.0, 6.0: 3.0}
+    archive_folders = archive_tree(FolderTree(names, parents, sep='\\'))
+    assert(archive_folders.path(4.0) == archivedir and archive_folders.path(5.0) == archivedir + '\\2020')
+    assert(archive_folders.path(6.0) == 'C:\\Users\\arb\\Documents')
+
+def embed_pending_records():
+    """ Yield the NAME, FOLDER_ID, SIZE and CRC of the images which have > zero
+    Embed Pending flag (0 and -1 are special), ignoring files which don't have
+    a rating (maybe embed pending = faces) """
+    columns = ['NAME', 'FOLDER_ID', 'RATING', 'SIZE', 'CRC']
+    where = [('ACDDBUPOFF', '>', 0), ('RATING', '!=', 0)]
+    if isinstance(catalog, Catalog):
+        printv('Extract %s' % os.path.join(catalogdir, 'Asset.dbf'))
+        return catalog.records(columns, where=where)
+    return catalog.records('Asset', columns, where=where)
+
+def list_dir(dirpath):
+    """ Return the set of file names in dirpath, or None if it's not a directory.
+    Names are compared with os.path.normcase so case doesn't matter on Windows. """
+    try:
+        with os.scandir(dirpath) as it:
+            return {os.path.normcase(entry.name) for entry in it if entry.is_file()}
+    except OSError:
+        return None
+
+def list_dirs(dirpaths):
+    """ List each of the directories once, several at a time because each
+    one is a round trip to the server, and return a dict of the listings """
+    dirpaths = sorted(set(dirpaths))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=listing_jobs) as pool:
+        return dict(zip(dirpaths, pool.map(list_dir, dirpaths)))
+
+def file_exists(listings, dirpath, name):
+    """ Like os.path.isfile(os.path.join(dirpath, name)) but using the listings from list_dirs """
+    names = listings.get(dirpath)
+    return names is not None and os.path.normcase(name) in names
+
+def plan_restore(store, local_dirs, local_listings, archive_dirs, archive_listings=None):
+    """ Return a dict of the outcomes ALREADY_EXISTS, RESTORE and MISSING
+    (or NOT_LOCAL if there are no archive_listings yet) to an array of the
+    indexes in the AssetStore of the files with that outcome. local_dirs and
+    archive_dirs are the paths of the folders of the store. """
+    plan = {outcome: array.array('q') for outcome in (ALREADY_EXISTS, RESTORE, MISSING, NOT_LOCAL)}
+    for index in range(len(store)):
+        folder = store.folders[index]
+        name = store.name(index)
+        if file_exists(local_listings, local_dirs[folder], name):
+            plan[ALREADY_EXISTS].append(index)
+        elif archive_listings is None:
+            plan[NOT_LOCAL].append(index)
+        elif file_exists(archive_listings, archive_dirs[folder], name):
+            plan[RESTORE].append(index)
         else:
-            break
-    return path
-
-class TestFieldParser(FieldParser):
-    def parse7(self, field, data):
-        #printv(field.name, data)
-        return data
-
-if not os.path.isdir(catalogdir):
-    raise Exception("no %s" % catalogdir)
-if not os.path.isdir(archivedir):
-    raise Exception("no %s" % archivedir)
-if not os.path.isdir(localdir):
-    raise Exception("no %s" % localdir)
-
-read_folders(os.path.join(catalogdir, 'Folder.dbf'))
-
-files_already_exist = set()
-dirs_already_exist = set()
-dirs_created = set()
-files_restored = set()
-files_missing = set()
-
-for dbffile in glob.glob(os.path.join(catalogdir, 'Asset.dbf')):
-    printv('Extract %s' % (dbffile))
-    table = DBF(dbffile, parser_class=TestFieldParser, encoding='cp437', ignore_missing_memo=True)
-    for record in table:
-        # Only consider images which have > zero Embed Pending flag (0 and -1 are special)
-        if record['ACDDBUPOFF'] > 0:
-            # Ignore files which don't have a rating (maybe embed pending = faces)
-            if record['RATING'] == 0:
-                continue
-            #printv('%s %s rating %s' % (folder_path(record['FOLDER_ID']), record['NAME'], record['RATING']))
-            filepath = os.path.join(folder_path(record['FOLDER_ID']), record['NAME'])
-            if os.path.isfile(filepath):
-                files_already_exist.add(filepath)
-            else:
-                # Copy file from \\saucy2\arb_pictures, embed metadata, then move it back
-                archivepath = os.path.join(archivedir, filepath.replace(localprefix,''))
-                if os.path.isfile(archivepath):
-                    destdir = os.path.dirname(filepath)
-                    if os.path.isdir(destdir):
-                        dirs_already_exist.add(destdir)
-                    else:
-                        dirs_created.add(destdir)
-                    files_restored.add( (archivepath, filepath) )
-                else:
-                    files_missing.add(archivepath)
-
-
-for filepath in sorted(files_already_exist):
-    printv('ALREADY EXISTS!! %s' % filepath) # You can embed it yourself using ACDSee's menu
-
-for archivepath in sorted(files_missing):
-    printv('CANNOT COPY, MISSING %s' % archivepath)
-
-for archivepath,filepath in sorted(files_restored):
-    printv('RESTORE  %s  TO  %s' % (archivepath, filepath))
-
-if not files_restored:
-    printv('NOTHING TO RESTORE')
-
-for destdir in sorted(dirs_already_exist):
-    printv('RESTORE TO DIR ALREADY EXISTS: %s' % destdir)
-
-if not dirs_already_exist:
-    printv('NO DIRS ALREADY EXIST, ALL WILL BE CREATED:')
-
-for destdir in sorted(dirs_created):
-    printv('RESTORE TO NEW DIR %s' % destdir)
-
-if do_copy:
-    put_back = set()
-    for archivepath,filepath in sorted(files_restored):
-        printv('RESTORE  %s  TO  %s' % (archivepath, filepath))
-        put_back.add('mv  "%s"  "%s"' % (filepath, archivepath))
-        destdir = os.path.dirname(filepath)
-        os.makedirs(destdir, exist_ok=True)
-        shutil.copy2(archivepath, filepath)
-    # Write a bash script that can put the modified files back into the archive
-    with open(putback_file, 'w') as fd:
-        for cmd in put_back:
-            print(cmd, file=fd)
+            plan[MISSING].append(index)
+    return plan
+
+def test_plan_restore():
+    folders = FolderTree({1.0: 'pictures', 2.0: 'gone'}, {1.0: 0.0, 2.0: 1.0}, sep='/')
+    archive_folders = folders.remapped('pictures', 'archive')
+    store = AssetStore.from_records([{'FOLDER_ID': 1.0, 'NAME': 'here.jpg'}, {'FOLDER_ID': 2.0, 'NAME': 'a.JPG'},
+        {'FOLDER_ID': 2.0, 'NAME': 'lost.jpg'}, {'FOLDER_ID': 1.0, 'NAME': 'b.jpg'}])
+    local_dirs = [folders.path(id) for id in store.folder_ids]
+    archive_dirs = [archive_folders.path(id) for id in store.folder_ids]
+    local_listings = {'pictures': {os.path.normcase('here.jpg')}, 'pictures/gone': None}
+    archive_listings = {'archive': {'b.jpg'}, 'archive/gone': {os.path.normcase('a.JPG')}}
+    assert(plan_restore(store, local_dirs, local_listings, archive_dirs)[NOT_LOCAL].tolist() == [1, 2, 3])
+    plan = plan_restore(store, local_dirs, local_listings, archive_dirs, archive_listings)
+    assert({outcome: indexes.tolist() for outcome, indexes in plan.items()}
+        == {ALREADY_EXISTS: [0], RESTORE: [1, 3], MISSING: [2], NOT_LOCAL: []})
+    assert([store.path(index, archive_folders) for index in store.sorted(plan[RESTORE], archive_folders)]
+        == ['archive/b.jpg', 'archive/gone/a.JPG'])
+
+def copy_verified(src, dest, size, crc, strict=False):
+    """ Copy src to dest like shutil.copy2 but compute the CRC-32 while
+    copying, so the file is only read once, and return a tuple (restored,
+    list of the ways it doesn't match the SIZE and CRC in the catalog, 0 or
+    None meaning unknown). The copy is written to a temporary name beside
+    dest and renamed to dest once it's complete, even if it doesn't match
+    the catalog (unless strict), as the archive copy is the only one; a
+    short write is removed, so it can't be taken for a file which already
+    exists the next time. The CRC column is assumed to be the zlib CRC-32
+    (as in zip and PNG) of the whole file, stored signed; if it isn't,
+    every file is reported. """
+    tmpfile = dest + '.restoring'
+    actual_crc = 0
+    actual_size = 0
+    restored = False
+    try:
+        with open(src, 'rb') as fdin, open(tmpfile, 'wb') as fdout:
+            while True:
+                chunk = fdin.read(1024*1024)
+                if not chunk:
+                    break
+                actual_crc = zlib.crc32(chunk, actual_crc)
+                actual_size += len(chunk)
+                fdout.write(chunk)
+        shutil.copystat(src, tmpfile)
+        problems = []
+        if size and actual_size != size:
+            problems.append('size %d expected %d' % (actual_size, size))
+        if crc and actual_crc != int(crc) & 0xffffffff:
+            problems.append('CRC %08x expected %08x' % (actual_crc, int(crc) & 0xffffffff))
+        if os.path.getsize(tmpfile) != actual_size:
+            problems.append('only %d of %d bytes written' % (os.path.getsize(tmpfile), actual_size))
+        elif not (strict and problems):
+            os.replace(tmpfile, dest)
+            restored = True
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    return restored, problems
+
+def test_copy_verified():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src, dest = os.path.join(tmpdir, 'src.jpg'), os.path.join(tmpdir, 'dest.jpg')
+        with open(src, 'wb') as fd:
+            fd.write(b'x' * 1000)
+        crc = zlib.crc32(b'x' * 1000)
+        assert(copy_verified(src, dest, 1000, crc - (1 << 32) if crc >= (1 << 31) else crc) == (True, []))
+        assert(open(dest, 'rb').read() == b'x' * 1000)
+        os.remove(dest)
+        # Restored anyway, and reported
+        assert(copy_verified(src, dest, 1000, crc ^ 1) == (True, ['CRC %08x expected %08x' % (crc, crc ^ 1)]))
+        assert(open(dest, 'rb').read() == b'x' * 1000)
+        os.remove(dest)
+        assert(copy_verified(src, dest, 999, None, strict=True) == (False, ['size 1000 expected 999']))
+        assert(os.listdir(tmpdir) == ['src.jpg'])
+
+def main():
+    global catalogdir, do_copy, catalog
+    parser = argparse.ArgumentParser(description='restore the files flagged Embed Pending from the archive')
+    parser.add_argument('--copy', action="store_true", help='actually copy the files (default just report)')
+    parser.add_argument('--catalog', action="store", default=catalogdir, help=f'directory containing the catalog .dbf files (default {catalogdir})')
+    parser.add_argument('--snapshot', action="store", default=snapshot_file, help=f'snapshot of the catalog (default {snapshot_file})')
+    parser.add_argument('--no-snapshot', action="store_const", const=None, dest='snapshot', help='read the .dbf files every time')
+    parser.add_argument('--jobs', action="store", default=os.cpu_count(), type=int, help='number of processes reading Asset.dbf when there\'s no up to date snapshot (default one per CPU)')
+    parser.add_argument('--mirror', action="store", help='query this SQLite copy of the catalog instead')
+    parser.add_argument('--strict', action="store_true", help='don\'t restore files which don\'t match the SIZE and CRC in the catalog (default restore and report them)')
+    args = parser.parse_args()
+    catalogdir = args.catalog
+    do_copy = args.copy
+
+    if not os.path.isdir(catalogdir):
+        raise Exception("no %s" % catalogdir)
+    if not os.path.isdir(archivedir):
+        raise Exception("no %s" % archivedir)
+    if not os.path.isdir(localdir):
+        raise Exception("no %s" % localdir)
+
+    if args.mirror:
+        from acdsee.mirror import CatalogMirror
+        catalog = CatalogMirror(args.mirror)
+    else:
+        catalog = Catalog(catalogdir, snapshot=args.snapshot, sep=os.sep, jobs=args.jobs)
+    folders = read_folders()
+    archive_folders = archive_tree(folders)
+
+    # Only the folder and name (and SIZE and CRC) of each file are kept,
+    # the paths are made when they're printed
+    store = AssetStore.from_records(embed_pending_records(), ['SIZE', 'CRC'])
+    # List each directory once instead of checking each file (several round trips each)
+    local_dirs = [folders.path(id) for id in store.folder_ids]
+    archive_dirs = [archive_folders.path(id) for id in store.folder_ids]
+    printv('Listing %d local directories' % len(set(local_dirs)))
+    local_listings = list_dirs(local_dirs)
+    plan = plan_restore(store, local_dirs, local_listings, archive_dirs)
+    not_local_dirs = set(archive_dirs[store.folders[index]] for index in plan[NOT_LOCAL])
+    printv('Listing %d archive directories' % len(not_local_dirs))
+    archive_listings = list_dirs(not_local_dirs)
+    plan = plan_restore(store, local_dirs, local_listings, archive_dirs, archive_listings)
+    files_restored = store.sorted(plan[RESTORE], archive_folders)
+    # Copy file from \\saucy2\arb_pictures, embed metadata, then move it back
+    dirs_already_exist = set()
+    dirs_created = set()
+    for index in files_restored:
+        destdir = local_dirs[store.folders[index]]
+        if local_listings[destdir] is not None:
+            dirs_already_exist.add(destdir)
+        else:
+            dirs_created.add(destdir)
+
+    for index in store.sorted(plan[ALREADY_EXISTS], folders):
+        printv('ALREADY EXISTS!! %s' % store.path(index, folders)) # You can embed it yourself using ACDSee's menu
+
+    for index in store.sorted(plan[MISSING], archive_folders):
+        printv('CANNOT COPY, MISSING %s' % store.path(index, archive_folders))
+
+    for index in files_restored:
+        printv('RESTORE  %s  TO  %s' % (store.path(index, archive_folders), store.path(index, folders)))
+
+    if not files_restored:
+        printv('NOTHING TO RESTORE')
+
+    for destdir in sorted(dirs_already_exist):
+        printv('RESTORE TO DIR ALREADY EXISTS: %s' % destdir)
+
+    if not dirs_already_exist:
+        printv('NO DIRS ALREADY EXIST, ALL WILL BE CREATED:')
+
+    for destdir in sorted(dirs_created):
+        printv('RESTORE TO NEW DIR %s' % destdir)
+
+    if do_copy:
+        put_back = array.array('q') # indexes of the files restored
+        mismatches = {}
         for destdir in dirs_created:
-            print('rmdir "%s"' % destdir, file=fd)
-else:
-    printv('Use the --copy option to actually copy')
+            os.makedirs(destdir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=copy_jobs) as pool:
+            futures = {pool.submit(copy_verified, store.path(index, archive_folders), store.path(index, folders),
+                store.value('SIZE', index), store.value('CRC', index), args.strict): index for index in files_restored}
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                archivepath, filepath = store.path(index, archive_folders), store.path(index, folders)
+                try:
+                    restored, problems = future.result()
+                except OSError as e:
+                    restored, problems = False, ['copy failed: %s' % e]
+                if problems:
+                    printv('MISMATCH %s  TO  %s: %s' % (archivepath, filepath, ', '.join(problems)))
+                    mismatches[index] = problems
+                if restored:
+                    printv('RESTORED %s  TO  %s' % (archivepath, filepath))
+                    put_back.append(index)
+        # Files which differ from the catalog are still restored (unless
+        # --strict), as the archive copy is the only one, but listed for a
+        # human to look at
+        restored = set(put_back)
+        for index in store.sorted(mismatches, archive_folders):
+            printv('%s: %s (%s)' % ('RESTORED, NOT VERIFIED' if index in restored else 'NOT RESTORED',
+                store.path(index, archive_folders), ', '.join(mismatches[index])))
+        printv('Restored %d files, %d did not match the catalog, %d not restored'
+            % (len(put_back), len(mismatches), len(files_restored) - len(put_back)))
+        # Write a bash script that can put the modified files back into the archive
+        with open(putback_file, 'w') as fd:
+            for index in store.sorted(put_back, folders):
+                print('mv  "%s"  "%s"' % (store.path(index, folders), store.path(index, archive_folders)), file=fd)
+            for destdir in sorted(dirs_created):
+                print('rmdir "%s"' % destdir, file=fd)
+    else:
+        printv('Use the --copy option to actually copy')
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,24 +12,34 @@
 # Also the google photos backup loses the folder structure anyway.
 
 # TO DO!
-#  1. the check step should add up file sizes and
-#     ask before copying especially if multiple GB.
 #  2. check the file date and if it's newer than the last time
 #     its directory was copied then copy it (otherwise it would
 #     be ignored because it's directory was previously copied).
-# Write the CSV properly not just append to file.
-# Keep CSV sorted.
-# Use a database like sqlite not a CSV?
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import ctypes
+import ctypes.util
 from datetime import datetime
+import hashlib
+import io
 import os
 import re
+import select
 import shutil
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
 import time
+from acdsee.dates import acdsee_timestamp
+from acdsee.dbf import DBFTable, write_dbf
+from acdsee.folders import FolderTree
+from acdsee.stats import CountingFileIO, RunStats, profiled
 
 debug=False
 verbose=False
@@ -40,7 +50,21 @@ max_days=2000          # don't sync anything older than max_days
 min_size=1024          # probably not an image
 max_size=100*1024*1024 # 100MB is too large for an image
 dir_prefix=None        # Use 202 for 2020 onwards, or None to include all dirs and subdirs
-database="synced.csv"
+jobs=1                 # number of threads to stat and read files in parallel
+incremental=False      # skip directories unchanged since the last run, see --incremental
+copy_jobs=4            # number of files to copy in parallel
+confirm_size=1024*1024*1024 # ask before copying more than this (1GB)
+database="synced.sqlite"      # the ledger of files already copied
+legacy_database="synced.csv"  # imported into the ledger the first time
+cache_file="syncthing_cache.sqlite" # ratings of files already read
+cache_max_entries=1000000           # forget the least recently seen files beyond this
+catalogdir="/mnt/cifs/documents/Backup/ACDSee/170Ult/Default" # for --from-catalog
+catalog_prefix="\\\\saucy2\\arb_pictures\\ixus\\"  # srcdir as the catalog knows it
+catalog_prefix_laptop="c:\\Users\\arb\\Pictures\\"   # srcdir_laptop as the catalog knows it
+poll_interval=60       # seconds between polls with --watch when inotify can't be used
+settle_seconds=10      # with --watch, copy a file once it hasn't changed for this long
+remote_filesystems=('cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'fuse.sshfs') # inotify misses changes made by other machines
+stats=RunStats()       # time in each phase and why files were skipped, see --stats
 
 
 # ---------------------------------------------------------------------
@@ -51,27 +75,144 @@ def relative_dir_to_src(filename):
 def test_relative_dir_to_src():
     assert(relative_dir_to_src(os.path.join(srcdir, "me", "you", "file.jpg")) == 'me/you')
 
+def relative_path_to_src(filename):
+    """ Return filename but without the srcdir prefix """
+    return os.path.join(relative_dir_to_src(filename), os.path.basename(filename))
+
 
 # ---------------------------------------------------------------------
-def image_rating(filename):
-    rating = None
-    with open(filename, 'rb') as fd:
-        data = fd.read()
+# JPEG markers and XMP namespaces, see the XMP specification part 3
+jpeg_soi = b'\xff\xd8'
+jpeg_eoi = b'\xff\xd9'
+jpeg_sos = b'\xff\xda'
+jpeg_app1 = b'\xff\xe1'
+xmp_ns = b'http://ns.adobe.com/xap/1.0/\x00'
+xmp_ext_ns = b'http://ns.adobe.com/xmp/extension/\x00'
+xmp_chunk_size = 64*1024       # read XMP sidecars in chunks of this size
+xmp_max_bytes = 4*1024*1024    # give up looking for XMP after this many bytes
+
+def jpeg_xmp_segments(fd):
+    """ Walk the JPEG marker chain of the open file fd (positioned just
+    after the SOI marker) and yield a tuple (namespace, payload) for each
+    APP1 XMP segment. All other segments are skipped with a seek so only
+    the XMP bytes are actually read. Stops at the start of the image data.
+    """
+    while True:
+        marker = fd.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return # corrupt or truncated
+        while marker[1] == 0xff: # fill bytes
+            marker = b'\xff' + fd.read(1)
+            if len(marker) < 2:
+                return
+        if marker in (jpeg_sos, jpeg_eoi):
+            return
+        if 0xd0 <= marker[1] <= 0xd8 or marker[1] == 0x01:
+            continue # standalone markers have no length
+        length = fd.read(2)
+        if len(length) < 2:
+            return
+        length = int.from_bytes(length, 'big') - 2
+        if length < 0:
+            return
+        if marker != jpeg_app1:
+            fd.seek(length, os.SEEK_CUR)
+            continue
+        head = fd.read(min(length, len(xmp_ext_ns)))
+        if head.startswith(xmp_ns):
+            yield xmp_ns, head[len(xmp_ns):] + fd.read(length - len(head))
+        elif head == xmp_ext_ns:
+            yield xmp_ext_ns, fd.read(length - len(head))
+        else:
+            fd.seek(length - len(head), os.SEEK_CUR) # e.g. Exif
+
+def xmp_rating(xmp):
+    """ Return the ACDSee rating from the XMP packet (bytes), as an int,
+    or None if there is no rating. Handles both the old element-style
+    and the new attribute-style XMP. """
+    xmp_str = xmp.decode(errors='replace')
+    match = re.search('<acdsee:rating>(.)</acdsee:rating>', xmp_str) # old XMP format
+    if not match:
+        match = re.search('acdsee:rating="(.)"', xmp_str) # new XMP format
+    if not match:
+        return None
+    try:
+        return int(match.group(1))
+    except ValueError:
+        return None
+
+def jpeg_rating(fd):
+    """ Return the ACDSee rating from the XMP in the JPEG file fd, or None.
+    Only reads the ExtendedXMP segments if the rating is not in the
+    standard XMP and the standard XMP says there is an extension. """
+    guid = None
+    extended = {}
+    for namespace, payload in jpeg_xmp_segments(fd):
+        if namespace == xmp_ns:
+            rating = xmp_rating(payload)
+            if rating is not None:
+                return rating
+            match = re.search(rb'xmpNote:HasExtendedXMP(?:>|=")([0-9A-Fa-f]{32})', payload)
+            if not match:
+                return None
+            guid = match.group(1)
+        elif guid and payload[:32] == guid and len(payload) >= 40:
+            # GUID, full length, offset of this portion, then the data
+            offset = int.from_bytes(payload[36:40], 'big')
+            extended[offset] = payload[40:]
+    if not extended:
+        return None
+    return xmp_rating(b''.join(extended[offset] for offset in sorted(extended)))
+
+def read_xmp_packet(fd):
+    """ Return the first <x:xmpmeta> packet in fd (bytes), reading it in
+    chunks of xmp_chunk_size and giving up after xmp_max_bytes. """
+    data = b''
+    bytes_read = 0
+    while bytes_read < xmp_max_bytes:
+        chunk = fd.read(xmp_chunk_size)
+        if not chunk:
+            break
+        bytes_read += len(chunk)
+        data += chunk
         xmp_start = data.find(b'<x:xmpmeta')
+        if xmp_start < 0:
+            data = data[-len(b'<x:xmpmeta'):] # in case it spans two chunks
+            continue
+        data = data[xmp_start:]
         xmp_end = data.find(b'</x:xmpmeta')
-        xmp_str = data[xmp_start:xmp_end+12]
-        xmp_str = xmp_str.decode()
-        match = re.search('<acdsee:rating>(.)</acdsee:rating>', xmp_str) # old XMP format
-        if not match:
-            match = re.search('acdsee:rating="(.)"', xmp_str) # new XMP format
-        if match:
-            rating = match.group(1).replace('"', '')
-            try:
-                rating = int(rating)
-            except:
-                rating = None
+        if xmp_end >= 0:
+            return data[:xmp_end+12]
+    return b''
+
+def image_rating(filename):
+    """ Return the ACDSee rating of the JPEG or XMP sidecar file as an int,
+    or None if it's not rated. JPEG files are read segment by segment so
+    only the XMP is read, not the whole image. Other files are scanned in
+    chunks (for .mp4.xmp this reads the XMP file not the whole movie). """
+    raw = CountingFileIO(filename)
+    with io.BufferedReader(raw) as fd:
+        if fd.read(2) == jpeg_soi:
+            rating = jpeg_rating(fd)
+        else:
+            fd.seek(0)
+            rating = xmp_rating(read_xmp_packet(fd))
+    stats.count('bytes_read', raw.bytes_read)
     return rating
 
+def make_test_jpeg(xmp, extended=b'', guid=b'0'*32):
+    """ Return the bytes of a minimal JPEG with an Exif segment
+    and the given XMP, plus optional ExtendedXMP, for testing. """
+    def segment(marker, payload):
+        return marker + (len(payload)+2).to_bytes(2, 'big') + payload
+    data = jpeg_soi + segment(b'\xff\xe0', b'JFIF\x00' + b'\x00'*9)
+    data += segment(jpeg_app1, b'Exif\x00\x00' + b'\x00'*100)
+    data += segment(jpeg_app1, xmp_ns + xmp)
+    for offset in range(0, len(extended), 1000):
+        data += segment(jpeg_app1, xmp_ext_ns + guid + len(extended).to_bytes(4, 'big')
+            + offset.to_bytes(4, 'big') + extended[offset:offset+1000])
+    return data + jpeg_sos + b'\x00\x0c' + b'<acdsee:rating>5</acdsee:rating>' + jpeg_eoi
+
 def test_image_rating():
     assert(image_rating('/dev/null') == None)
     with tempfile.NamedTemporaryFile() as fd:
@@ -79,10 +220,103 @@ def test_image_rating():
         fd.flush()
         assert(image_rating(fd.name) == 3)
 
+def test_image_rating_jpeg():
+    old_style = b'<x:xmpmeta><acdsee:rating>3</acdsee:rating></x:xmpmeta>'
+    new_style = b'<x:xmpmeta acdsee:author="" acdsee:rating="4"></x:xmpmeta>'
+    unrated = b'<x:xmpmeta acdsee:author=""></x:xmpmeta>'
+    for xmp, rating in ((old_style, 3), (new_style, 4), (unrated, None)):
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.write(make_test_jpeg(xmp))
+            fd.flush()
+            assert(image_rating(fd.name) == rating)
+
+def test_image_rating_extended_xmp():
+    guid = b'5CFC0FC6E95C3D73662A2A2653F5E31A'
+    xmp = b'<x:xmpmeta xmpNote:HasExtendedXMP="' + guid + b'"></x:xmpmeta>'
+    extended = b'<x:xmpmeta>' + b' '*2500 + b'<acdsee:rating>2</acdsee:rating></x:xmpmeta>'
+    with tempfile.NamedTemporaryFile() as fd:
+        fd.write(make_test_jpeg(xmp, extended, guid))
+        fd.flush()
+        assert(image_rating(fd.name) == 2)
+
+def test_read_xmp_packet():
+    with tempfile.NamedTemporaryFile() as fd:
+        fd.write(b' ' * (xmp_chunk_size - 4) + b'<x:xmpmeta acdsee:rating="1"></x:xmpmeta> ')
+        fd.flush()
+        fd.seek(0)
+        assert(read_xmp_packet(fd) == b'<x:xmpmeta acdsee:rating="1"></x:xmpmeta>')
+
+
+# ---------------------------------------------------------------------
+class RatingCache:
+    """ An on-disk cache of the rating and file type of each file,
+    keyed by path and invalidated if the size, mtime or inode changes,
+    so that unchanged files don't have to be read again on the next run.
+    Files not seen for the longest time are evicted to keep at most
+    max_entries rows. Changes are only committed by close().
+    Can be shared by the threads of find_files_to_copy().
+    """
+    def __init__(self, filename, max_entries=cache_max_entries):
+        self.max_entries = max_entries
+        self.now = time.time()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS rating (path TEXT PRIMARY KEY,'
+            ' size INTEGER, mtime_ns INTEGER, inode INTEGER,'
+            ' filetype TEXT, rating INTEGER, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS rating_used ON rating (used)')
+
+    def lookup(self, path, filestat):
+        """ Return (filetype, rating) if path is cached and unchanged
+        since, otherwise None. """
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime_ns, inode, filetype, rating FROM rating WHERE path = ?',
+                (path,)).fetchone()
+            if not row or row[:3] != (filestat.st_size, filestat.st_mtime_ns, filestat.st_ino):
+                return None
+            self.conn.execute('UPDATE rating SET used = ? WHERE path = ?', (self.now, path))
+        return row[3], row[4]
+
+    def store(self, path, filestat, filetype, rating):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO rating VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, filestat.st_size, filestat.st_mtime_ns, filestat.st_ino, filetype, rating, self.now))
+
+    def close(self):
+        """ Evict the least recently used entries and commit. """
+        count = self.conn.execute('SELECT COUNT(*) FROM rating').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('DELETE FROM rating WHERE path IN'
+                ' (SELECT path FROM rating ORDER BY used LIMIT ?)', (count - self.max_entries,))
+        self.conn.commit()
+        self.conn.close()
+
+def test_rating_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'image.jpg')
+        with open(filename, 'w') as fd:
+            fd.write('data')
+        filestat = os.stat(filename)
+        cache = RatingCache(os.path.join(tmpdir, 'cache.sqlite'), max_entries=1)
+        assert(cache.lookup(filename, filestat) == None)
+        cache.store(filename, filestat, 'JPEG', 3)
+        cache.store(filename + '2', filestat, 'JPEG', None)
+        assert(cache.lookup(filename, filestat) == ('JPEG', 3))
+        assert(cache.lookup(filename + '2', filestat) == ('JPEG', None))
+        cache.now += 1
+        assert(cache.lookup(filename, filestat) == ('JPEG', 3))
+        cache.close()
+        cache = RatingCache(os.path.join(tmpdir, 'cache.sqlite'), max_entries=1)
+        assert(cache.lookup(filename + '2', filestat) == None) # evicted
+        with open(filename, 'a') as fd:
+            fd.write('more')
+        assert(cache.lookup(filename, os.stat(filename)) == None) # changed
+        cache.close()
+
 
 # ---------------------------------------------------------------------
 def read_database(database):
-    """ Read synced.csv to get updateddate,path into a dictionary
+    """ Read the old synced.csv to get updateddate,path into a dictionary
     indexed by the path and return the dict. """
     db = {}
     if not os.path.isfile(database):
@@ -96,97 +330,1117 @@ def read_database(database):
             # don't actually check the date, but we could).
             # The DB doesn't store the time so pretend it's the end of the day
             # so that files modified on the same day are ignored.
-            db[row['path']] = time.mktime(time.strptime(row['updateddate'], '%Y-%m-%d')) + (864399.0)
+            # Older versions wrote the header as directory not path.
+            path = row['path'] if 'path' in row else row['directory']
+            db[path] = time.mktime(time.strptime(row['updateddate'], '%Y-%m-%d')) + 86399.0
     return db
 
 def test_read_database():
     with tempfile.NamedTemporaryFile() as fd:
         fd.write('updateddate\tpath\n2020-02-02\tdir1/dir2\n'.encode())
         fd.flush()
-        assert(read_database(fd.name) == {'dir1/dir2': time.strptime('2020-02-02','%Y-%m-%d')})
+        assert(read_database(fd.name) == {'dir1/dir2': time.mktime(time.strptime('2020-02-02 23:59:59','%Y-%m-%d %H:%M:%S'))})
+    with tempfile.NamedTemporaryFile() as fd:
+        fd.write('updateddate\tdirectory\n2020-02-02\tdir1\n2020-03-03\tdir1\n'.encode())
+        fd.flush()
+        assert(list(read_database(fd.name)) == ['dir1'])
 
 
 # ---------------------------------------------------------------------
-def find_files_to_copy(db):
-    """ Recursively find files under 'srcdir' and return a tuple
-    (files_to_copy[path: str], bytes_to_copy[int]). Ignores
-    the [Originals] directory, files too small or too large,
-    files older than 'max_days', files not .jpg, files without an
-    ACDSee rating, and files in a directory which has already
-    been synced (passed in 'db') unless file has been modified
-    more recently than the previous sync date.
+def scan_options():
+    """ Return the options which decide whether a directory has anything
+    to copy (srcdir, --days, --prefix and the size limits) as a string,
+    so a directory found clean with other options is listed again """
+    return repr((srcdir, max_days, dir_prefix, min_size, max_size))
+
+class SyncLedger:
+    """ A SQLite database of the files which have been copied, with the
+    size, mtime and content hash of each file and a rollup per directory
+    of when it was last synced. Paths are relative to srcdir. Changes are
+    only saved by commit(), which is called after each file is copied, so
+    a rerun after an interruption doesn't copy them again, and with the
+    directories at the end, so an interrupted copy never marks a directory
+    as synced. Lookups can be made from the threads of find_files_to_copy().
+    It also records the mtime and number of files of each directory when
+    it was last listed by walk_files(), and whether it had nothing left to
+    copy (clean), so an unchanged directory doesn't have to be listed again.
     """
-    time_now = time.time()
+    def __init__(self, filename):
+        self.now = time.time()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS file (path TEXT PRIMARY KEY,'
+            ' dir TEXT, size INTEGER, mtime REAL, hash TEXT, synced REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS file_dir ON file (dir)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dir (path TEXT PRIMARY KEY,'
+            ' synced REAL, files INTEGER, bytes INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        if 'options' not in [row[1] for row in self.conn.execute('PRAGMA table_info(scan)')]:
+            self.conn.execute('DROP TABLE IF EXISTS scan') # from before options, only saves listing them again
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY,'
+            ' parent TEXT, mtime REAL, files INTEGER, clean INTEGER, scanned REAL, options TEXT)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scan_parent ON scan (parent)')
+        self.conn.commit()
 
-    files_to_copy=[]
-    bytes_to_copy = 0
+    def import_csv(self, filename):
+        """ Import the directories from the old synced.csv, only once. """
+        if self.conn.execute("SELECT value FROM meta WHERE key = 'imported_csv'").fetchone():
+            return
+        for dire, synced in read_database(filename).items():
+            self.conn.execute('INSERT OR IGNORE INTO dir VALUES (?, ?, NULL, NULL)', (dire, synced))
+        self.conn.execute("INSERT INTO meta VALUES ('imported_csv', ?)", (filename,))
+        self.conn.commit()
 
-    prevprinted=None
-    for root, dirs, files in os.walk(srcdir):
-        if dir_prefix and (root == srcdir):
-            dirs[:] = [d for d in dirs if d.startswith(dir_prefix)]
-        for name in files:
-            # Ignore if an ACDSee backup directory
-            if '[Originals]' in root:
+    def dir_synced(self, dire):
+        """ Return the time directory dire was last synced, or None. """
+        with self.lock:
+            row = self.conn.execute('SELECT synced FROM dir WHERE path = ?', (dire,)).fetchone()
+        return row[0] if row else None
+
+    def file_synced(self, path, filestat):
+        """ Return True if path has been copied and not changed since. """
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime FROM file WHERE path = ?', (path,)).fetchone()
+        return row == (filestat.st_size, filestat.st_mtime)
+
+    def dir_unchanged(self, dire, dirstat):
+        """ Return the number of files in directory dire if it was clean and
+        had the same mtime when it was last listed with the same
+        scan_options(), otherwise None. """
+        with self.lock:
+            row = self.conn.execute('SELECT mtime, files FROM scan WHERE path = ? AND clean AND options = ?',
+                (dire, scan_options())).fetchone()
+        return row[1] if row and row[0] == dirstat.st_mtime else None
+
+    def subdirs(self, dire):
+        """ Return the subdirectories of dire recorded by record_scans()
+        with the same scan_options(). """
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT path FROM scan WHERE parent = ? AND options = ?'
+                ' ORDER BY path', (dire, scan_options()))]
+
+    def record_scans(self, scanned, dirty=()):
+        """ Record the directories listed by walk_files(), a dict of path to
+        (parent, mtime, number of files), as clean unless they are in dirty
+        (i.e. have files which still need to be copied), with the current
+        scan_options() as clean depends on them. Saved by commit(). """
+        options = scan_options()
+        self.conn.executemany('INSERT OR REPLACE INTO scan VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(dire, parent, mtime, files, dire not in dirty, self.now, options)
+                for dire, (parent, mtime, files) in scanned.items()])
+
+    def add_file(self, path, filestat, digest):
+        """ Record path as copied. If digest is None (not hashed) the hash
+        already stored is kept, as long as the size and mtime are the same. """
+        self.conn.execute('INSERT OR REPLACE INTO file VALUES (?, ?, ?, ?, COALESCE(?, (SELECT hash FROM file'
+            ' WHERE path = ? AND size = ? AND mtime = ?)), ?)',
+            (path, os.path.dirname(path), filestat.st_size, filestat.st_mtime,
+                digest, path, filestat.st_size, filestat.st_mtime, self.now))
+
+    def commit(self, dirs=()):
+        """ Update the rollup for each of the directories and commit. """
+        for dire in dirs:
+            self.conn.execute('INSERT OR REPLACE INTO dir SELECT ?, ?, COUNT(*), SUM(size)'
+                ' FROM file WHERE dir = ?', (dire, self.now, dire))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close() # discards anything not committed
+
+def test_sync_ledger():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        csvfile = os.path.join(tmpdir, 'synced.csv')
+        with open(csvfile, 'w') as fd:
+            fd.write('updateddate\tdirectory\n2020-02-02\tdir1\n')
+        ledger = SyncLedger(os.path.join(tmpdir, 'synced.sqlite'))
+        ledger.import_csv(csvfile)
+        assert(ledger.dir_synced('dir1') == read_database(csvfile)['dir1'])
+        filestat = os.stat(csvfile)
+        ledger.add_file('dir2/file.jpg', filestat, 'abc')
+        ledger.close() # interrupted, not committed
+        with open(csvfile, 'a') as fd:
+            fd.write('2020-03-03\tdir3\n')
+        ledger = SyncLedger(os.path.join(tmpdir, 'synced.sqlite'))
+        ledger.import_csv(csvfile)
+        assert(ledger.dir_synced('dir3') == None) # only imported once
+        assert(not ledger.file_synced('dir2/file.jpg', filestat))
+        ledger.add_file('dir2/file.jpg', filestat, 'abc')
+        ledger.commit(['dir2'])
+        assert(ledger.file_synced('dir2/file.jpg', filestat))
+        assert(ledger.dir_synced('dir2') == ledger.now)
+        assert(ledger.conn.execute('SELECT files, bytes FROM dir WHERE path = ?', ('dir2',)).fetchone()
+            == (1, filestat.st_size))
+        gethash = lambda: ledger.conn.execute('SELECT hash FROM file WHERE path = ?', ('dir2/file.jpg',)).fetchone()[0]
+        ledger.add_file('dir2/file.jpg', filestat, None) # not hashed, keeps the hash
+        assert(gethash() == 'abc')
+        ledger.add_file('dir2/file.jpg', os.stat(tmpdir), None) # changed, the old hash is wrong
+        assert(gethash() == None)
+        ledger.close()
+
+
+# ---------------------------------------------------------------------
+def kernel_copy(fdin, fdout):
+    """ Copy the rest of the open file fdin to fdout inside the kernel,
+    using copy_file_range (which can be done by the server on CIFS/NFS)
+    or sendfile, falling back to reading and writing. """
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(fdin.fileno(), fdout.fileno(), 1024*1024*1024):
+                pass
+            return
+        except OSError:
+            pass # e.g. not supported between these filesystems, carry on from here
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while os.sendfile(fdout.fileno(), fdin.fileno(), None, 1024*1024*1024):
+                pass
+            return
+        except OSError:
+            pass
+    shutil.copyfileobj(fdin, fdout, 1024*1024)
+
+def copy_file(src, dest, hash=False):
+    """ Copy the file src to the file dest, with its permissions and times,
+    like shutil.copy2. The copy is written to a temporary file (which
+    syncthing ignores) and renamed, so dest is never a partial file.
+    Returns the SHA-256 of the content if hash, computed while copying so
+    the file only has to be read once, otherwise it's copied inside the
+    kernel if possible and None is returned. """
+    tmpfile = os.path.join(os.path.dirname(dest), '.syncthing.%s.tmp' % os.path.basename(dest))
+    digest = hashlib.sha256() if hash else None
+    try:
+        with open(src, 'rb') as fdin, open(tmpfile, 'wb') as fdout:
+            if digest:
+                while True:
+                    chunk = fdin.read(1024*1024)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    fdout.write(chunk)
+            else:
+                kernel_copy(fdin, fdout)
+        shutil.copystat(src, tmpfile)
+        os.replace(tmpfile, dest)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    return digest.hexdigest() if digest else None
+
+def same_file(src, dest, srcstat=None):
+    """ Return True if dest exists with the same size and mtime as src
+    (or srcstat if given), i.e. it was copied by copy_file and hasn't
+    changed since. """
+    try:
+        srcstat = srcstat or os.stat(src)
+        deststat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    return srcstat.st_size == deststat.st_size and abs(srcstat.st_mtime - deststat.st_mtime) < 1.0
+
+def copy_to_dest(src, hash=False):
+    """ Copy src to its directory in destdir, unless it's already there,
+    and return a tuple (copied, stat of src, digest, seconds taken). src is
+    stat'ed before it's copied, so if it changes while it's being copied
+    the ledger has the old mtime and it's copied again next time. """
+    dest = os.path.join(destdir, relative_dir_to_src(src), os.path.basename(src))
+    filestat = os.stat(src)
+    if same_file(src, dest, filestat):
+        return False, filestat, None, 0
+    start = time.time()
+    digest = copy_file(src, dest, hash)
+    return True, filestat, digest, time.time() - start
+
+def test_copy_file():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = os.path.join(tmpdir, 'src.jpg')
+        with open(src, 'wb') as fd:
+            fd.write(os.urandom(3*1024*1024+17))
+        os.utime(src, (1700000000, 1700000000))
+        for hash in (False, True):
+            dest = os.path.join(tmpdir, 'dest%s.jpg' % hash)
+            assert(not same_file(src, dest))
+            digest = copy_file(src, dest, hash)
+            assert(same_file(src, dest))
+            with open(src, 'rb') as fd1, open(dest, 'rb') as fd2:
+                data = fd1.read()
+                assert(data == fd2.read())
+            assert(digest == (hashlib.sha256(data).hexdigest() if hash else None))
+        assert(sorted(os.listdir(tmpdir)) == ['destFalse.jpg', 'destTrue.jpg', 'src.jpg'])
+
+
+def copy_files(files_to_copy, db, logfd, hash=False):
+    """ Copy the files to destdir using copy_jobs threads, recording each
+    one in the ledger db as it completes, and printing the progress.
+    Returns the set of directories (relative to srcdir) with files which
+    could not be copied. """
+    failed_dirs = set()
+    total_bytes = 0
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=copy_jobs) as pool:
+        futures = {pool.submit(copy_to_dest, file, hash): file for file in files_to_copy}
+        for count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            file = futures[future]
+            dire = os.path.join(destdir, relative_dir_to_src(file))
+            try:
+                copied, filestat, digest, seconds = future.result()
+            except OSError as e:
+                print('ERROR copying %s: %s' % (file, e))
+                print('ERROR copying %s: %s' % (file, e), file=logfd)
+                failed_dirs.add(relative_dir_to_src(file))
+                stats.count('copy_errors')
+                continue
+            if copied:
+                total_bytes += filestat.st_size
+                stats.add_time('copy', seconds)
+                stats.count('files_copied')
+                stats.count('bytes_copied', filestat.st_size)
+                rate = filestat.st_size / 1024 / 1024 / max(seconds, 0.001)
+                print('COPY %s -> %s  [%d/%d %.1f MB/s]' % (file, dire, count, len(futures), rate))
+                print('COPY %s -> %s' % (file,dire), file=logfd)
+            else:
+                stats.count('skip_identical')
+                print('SKIP_IDENTICAL %s  [%d/%d]' % (file, count, len(futures)))
+                print('SKIP_IDENTICAL %s' % file, file=logfd)
+            # Record it now so a rerun after an interruption doesn't copy it again
+            with stats.phase('ledger_write'):
+                db.add_file(relative_path_to_src(file), filestat, digest)
+                db.commit()
+    elapsed = max(time.time() - start, 0.001)
+    print('Copied %f MB in %.1f seconds, %.1f MB/s' % (total_bytes / 1024 / 1024, elapsed, total_bytes / 1024 / 1024 / elapsed))
+    print('Copied %f MB in %.1f seconds' % (total_bytes / 1024 / 1024, elapsed), file=logfd)
+    return failed_dirs
+
+def test_copy_files():
+    global srcdir, destdir
+    saved = srcdir, destdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = os.path.join(tmpdir, 'src')
+            destdir = os.path.join(tmpdir, 'dest')
+            os.makedirs(os.path.join(srcdir, '2025-01 a'))
+            os.makedirs(os.path.join(destdir, '2025-01 a'))
+            src = os.path.join(srcdir, '2025-01 a', 'a.jpg')
+            with open(src, 'wb') as fd:
+                fd.write(b'a' * 1000)
+            db = SyncLedger(':memory:')
+            gone = os.path.join(srcdir, '2025-01 a', 'gone.jpg')
+            with open(os.devnull, 'w') as logfd, contextlib.redirect_stdout(io.StringIO()):
+                assert(copy_files([src, gone], db, logfd, True) == set(['2025-01 a']))
+                assert(db.file_synced('2025-01 a/a.jpg', os.stat(src)))
+                assert(copy_files([src], db, logfd) == set()) # skipped, keeps the hash
+            assert(db.conn.execute('SELECT hash FROM file').fetchall() == [(hashlib.sha256(b'a' * 1000).hexdigest(),)])
+    finally:
+        srcdir, destdir = saved
+
+
+# ---------------------------------------------------------------------
+def file_type(name):
+    """ Return JPEG for a .jpg, MP4 for the .mp4.xmp of a movie, else NONE """
+    if name.endswith('.JPG') or name.endswith('.jpg'):
+        return 'JPEG'
+    if name.endswith('.mp4.xmp'):
+        return 'MP4'
+    return 'NONE'
+
+def prune_subdirs(root, subdirs):
+    """ Return the subdirectories of root to search, ignoring the ACDSee
+    backup directories, and at the top level those not starting with dir_prefix """
+    subdirs = [name for name in subdirs if name != '[Originals]']
+    if dir_prefix and (root == srcdir):
+        subdirs = [name for name in subdirs if name.startswith(dir_prefix)]
+    return subdirs
+
+def walk_files(scanned=None, ledger=None):
+    """ Recursively find files under 'srcdir' and yield a tuple
+    (root, name, filetype, rating, entry) for each .jpg or .mp4.xmp file,
+    pruning the [Originals] directories, and directories not starting with
+    dir_prefix at the top level. Only lists directories, doesn't stat files,
+    so the rating is None meaning it has to be read from the file, and entry
+    is the os.DirEntry, which can give the stat without another round trip
+    on some systems. If scanned (a dict) is given the parent, mtime and number
+    of files of each directory listed is added for SyncLedger.record_scans().
+    If ledger is given then a directory which was clean and had the same mtime
+    the last time is not listed again, only its subdirectories are checked,
+    so an unchanged tree costs a stat per directory rather than per file.
+    Note that changing a file in place doesn't change the directory mtime.
+    """
+    stack = [(srcdir, None)]
+    while stack:
+        root, parent = stack.pop()
+        dire = os.path.relpath(root, srcdir)
+        with stats.phase('walk'):
+            try:
+                dirstat = os.stat(root)
+                files = ledger.dir_unchanged(dire, dirstat) if ledger else None
+                if files is not None:
+                    subdirs = [os.path.basename(path) for path in ledger.subdirs(dire)]
+                    entries = []
+                else:
+                    entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+                    subdirs = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+            except OSError:
+                continue # e.g. deleted, like os.walk
+        if files is not None:
+            if debug: print(f'SKIP_UNCHANGED_DIR {root} ({files} files)')
+            stats.count('dirs_unchanged')
+            stats.count('files_unchanged', files)
+        else:
+            stats.count('dirs_listed')
+        subdirs = prune_subdirs(root, subdirs)
+        stack.extend((os.path.join(root, name), dire) for name in reversed(subdirs))
+        if files is not None:
+            continue
+        if scanned is not None:
+            scanned[dire] = (parent, dirstat.st_mtime, len(entries) - len(subdirs))
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
                 continue
-            # Determine file type
+            # Ignore if not a JPEG file or MP4 XMP file
+            filetype = file_type(entry.name)
+            if filetype == 'NONE':
+                continue
+            yield root, entry.name, filetype, None, entry
+
+
+def test_walk_files_incremental():
+    global srcdir, max_days
+    saved_srcdir = srcdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = tmpdir
+            for subdir in ('2025-01 a', '2025-01 a/sub', '2025-02 b', '2025-02 b/[Originals]'):
+                os.makedirs(os.path.join(tmpdir, subdir))
+                for name in ('img.jpg', 'v.mp4.xmp', 'notes.txt'):
+                    open(os.path.join(tmpdir, subdir, name), 'w').close()
+            scanned = {}
+            names = [os.path.relpath(os.path.join(root, name), tmpdir) for root, name, filetype, rating, entry in walk_files(scanned)]
+            assert(names == ['2025-01 a/img.jpg', '2025-01 a/v.mp4.xmp', '2025-01 a/sub/img.jpg', '2025-01 a/sub/v.mp4.xmp',
+                '2025-02 b/img.jpg', '2025-02 b/v.mp4.xmp'])
+            assert(scanned['2025-01 a'] == ('.', os.stat(os.path.join(tmpdir, '2025-01 a')).st_mtime, 3))
+            ledger = SyncLedger(':memory:')
+            ledger.record_scans(scanned, {'2025-01 a/sub'})
+            names = [name for root, name, filetype, rating, entry in walk_files(None, ledger)]
+            assert(names == ['img.jpg', 'v.mp4.xmp']) # only the dirty directory
+            open(os.path.join(tmpdir, '2025-02 b', 'new.jpg'), 'w').close()
+            os.utime(os.path.join(tmpdir, '2025-02 b'), (1, 1))
+            names = [name for root, name, filetype, rating, entry in walk_files(None, ledger)]
+            assert(names == ['img.jpg', 'v.mp4.xmp', 'img.jpg', 'new.jpg', 'v.mp4.xmp'])
+            saved_max_days = max_days
+            try:
+                max_days += 1 # older files might be copied now, so every directory is listed again
+                assert(len(list(walk_files(None, ledger))) == 7)
+            finally:
+                max_days = saved_max_days
+            # A scan table from before the options is replaced
+            conn = sqlite3.connect(os.path.join(tmpdir, 'synced.sqlite'))
+            conn.execute('CREATE TABLE scan (path TEXT PRIMARY KEY, parent TEXT, mtime REAL, files INTEGER, clean INTEGER, scanned REAL)')
+            conn.close()
+            ledger = SyncLedger(os.path.join(tmpdir, 'synced.sqlite'))
+            ledger.record_scans(scanned)
+            assert(ledger.subdirs('.') == ['2025-01 a', '2025-02 b'])
+            ledger.close()
+    finally:
+        srcdir = saved_srcdir
+
+
+def catalog_to_local(path):
+    """ Convert a Windows path from the catalog into a path inside srcdir,
+    or None if it's not inside catalog_prefix. """
+    if not path.lower().startswith(catalog_prefix.lower()):
+        return None
+    return os.path.join(srcdir, *path[len(catalog_prefix):].strip('\\').split('\\'))
+
+def test_catalog_to_local():
+    assert(catalog_to_local(catalog_prefix.upper() + '2025-01-01 x\\y\\') == os.path.join(srcdir, '2025-01-01 x', 'y'))
+    assert(catalog_to_local('d:\\elsewhere\\') == None)
+
+
+def catalog_files(catalogdir, verify_pending=False):
+    """ Yield a tuple (root, name, filetype, rating, None) like walk_files() but
+    for the rated files in the ACDSee catalog, i.e. Asset.dbf joined to the
+    folder paths from Folder.dbf, which are new enough and the right size.
+    Nothing in srcdir is read, only the needed columns of the two DBF files.
+    If verify_pending then the rating of JPEGs flagged Embed Pending
+    (ACDDBUPOFF) is None so it will be read from the file, as the catalog
+    and the file disagree until embedded.
+    Sorted by path so the order doesn't depend on the catalog.
+    """
+    time_now = time.time()
+    folders = FolderTree.from_dbf(os.path.join(catalogdir, 'Folder.dbf'))
+    folder_local = dict() # FOLDER_ID to local path, or None if not in srcdir
+
+    def local_folder(id):
+        if id not in folder_local:
+            folder_local[id] = catalog_to_local(folders.path(id) + '\\')
+        return folder_local[id]
+
+    candidates = []
+    start = time.perf_counter()
+    with DBFTable(os.path.join(catalogdir, 'Asset.dbf')) as table:
+        for record in table.records(['NAME', 'FOLDER_ID', 'SIZE', 'RATING', 'FTMODIFIED', 'ACDDBUPOFF'],
+                where=[('RATING', '>', 0)]):
+            name = record['NAME']
             if name.endswith('.JPG') or name.endswith('.jpg'):
                 filetype = 'JPEG'
-            elif name.endswith('.mp4.xmp'):
+            elif name.endswith('.mp4'):
                 filetype = 'MP4'
             else:
-                filetype = 'NONE'
-            # Ignore if not a JPEG file or MP4 XMP file
-            if filetype == 'NONE':
                 continue
-            # Ignore if too old (for XMP applies to the XMP not the MP4)
-            fullpath = os.path.join(root, name)
-            filestat = os.stat(fullpath)
-            if (time_now - filestat.st_mtime) > (86400 * max_days):
-                if debug: print(f'IGNORE_TOO_OLD {fullpath}')
+            # A blank SIZE is checked by check_file() from the stat instead
+            if filetype == 'JPEG' and record['SIZE'] is not None and not (min_size <= record['SIZE'] <= max_size):
                 continue
-            # Ignore if this directory has already been copied,
-            # unless the file has been modified since the directory was last copied.
-            dire = relative_dir_to_src(fullpath)
-            if (dire in db) and (filestat.st_mtime < db[dire]):
-                if debug:
-                    print(f'IGNORE_ALREADY_SYNCED {fullpath} on {db[dire]} via {dire}')
-                    print('  FILE %s' % datetime.fromtimestamp(filestat.st_mtime).strftime("%Y-%m-%d %H:%M:%S"))
-                    print('  DB   %s' % datetime.fromtimestamp(db[dire]).strftime("%Y-%m-%d %H:%M:%S"))
+            modified = acdsee_timestamp(record['FTMODIFIED'])
+            if modified and (time_now - modified) > (86400 * max_days):
                 continue
-            # Ignore if too small or too large (only applies to JPEG)
-            if (filetype == 'JPEG') and (filestat.st_size < min_size):
-                if debug: print(f'IGNORE_TOO_SMALL ({filestat.st_size}) {fullpath}')
+            root = local_folder(record['FOLDER_ID'])
+            if not root or '[Originals]' in root:
                 continue
-            if (filetype == 'JPEG') and (filestat.st_size > max_size):
-                if debug: print(f'IGNORE_TOO_LARGE ({filestat.st_size}) {fullpath}')
+            if dir_prefix and not os.path.relpath(root, srcdir).startswith(dir_prefix):
                 continue
-            # Ignore if not rated 1..5 in ACDSee
-            # This check is last because it involves reading the whole file.
-            # For MP4 this reads the XMP file not the whole movie.
+            rating = record['RATING']
+            if verify_pending and filetype == 'JPEG' and (record['ACDDBUPOFF'] or 0) > 0: # blank is not pending
+                rating = None
+            candidates.append((root, name, filetype, rating, None))
+    stats.add_time('catalog_read', time.perf_counter() - start)
+    yield from sorted(candidates)
+
+def test_catalog_files():
+    now = (int(time.time()) // 86400 + 2440588).to_bytes(4, 'little') + bytes(4)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        write_dbf(os.path.join(tmpdir, 'Folder.dbf'),
+            [('NAME', 'C', 60, 0), ('PRNT_ID', 'B', 8, 0), ('FOLDER_ID', 'B', 8, 0)],
+            [[catalog_prefix.rstrip('\\'), 0.0, 1.0], ['2025-01-01 x', 1.0, 2.0], ['[Originals]', 2.0, 3.0]])
+        write_dbf(os.path.join(tmpdir, 'Asset.dbf'),
+            [('NAME', 'C', 20, 0), ('FOLDER_ID', 'B', 8, 0), ('SIZE', 'N', 10, 0),
+             ('RATING', 'N', 3, 0), ('FTMODIFIED', '7', 8, 0), ('ACDDBUPOFF', 'N', 3, 0)],
+            [['b.jpg', 2.0, 5000, 3, now, 0], ['a.JPG', 2.0, 5000, 1, now, 1], ['c.jpg', 2.0, 5000, 0, now, 0],
+             ['d.jpg', 2.0, 10, 2, now, 0], ['e.jpg', 3.0, 5000, 2, now, 0], ['f.mp4', 2.0, 10, 2, now, 0],
+             ['g.jpg', 2.0, 5000, 2, bytes(8), 0], ['h.jpg', 2.0, None, 2, now, None]])
+        root = os.path.join(srcdir, '2025-01-01 x')
+        assert(list(catalog_files(tmpdir)) == [(root, 'a.JPG', 'JPEG', 1, None), (root, 'b.jpg', 'JPEG', 3, None),
+            (root, 'f.mp4', 'MP4', 2, None), (root, 'g.jpg', 'JPEG', 2, None), (root, 'h.jpg', 'JPEG', 2, None)])
+        assert(list(catalog_files(tmpdir, verify_pending=True))[0] == (root, 'a.JPG', 'JPEG', None, None))
+        assert(list(catalog_files(tmpdir, verify_pending=True))[-1] == (root, 'h.jpg', 'JPEG', 2, None))
+
+
+def check_file(root, name, filetype, rating, entry, db, cache, time_now):
+    """ Check whether a file found by walk_files() should be copied and
+    return a tuple (fullpath, size, messages) where fullpath is None if
+    the file is to be ignored, and messages is a list of debug messages
+    (returned rather than printed so they stay in order when run in
+    parallel by checked_files()). The file is only read if the rating
+    is None (not already known from the catalog). If entry (an os.DirEntry)
+    is given its stat is used.
+    """
+    messages = []
+    stats.count('files_checked')
+    # Ignore if too old (for XMP applies to the XMP not the MP4)
+    fullpath = os.path.join(root, name)
+    with stats.phase('stat'):
+        filestat = entry.stat() if entry else os.stat(fullpath)
+    if (time_now - filestat.st_mtime) > (86400 * max_days):
+        stats.count('ignore_too_old')
+        if debug: messages.append(f'IGNORE_TOO_OLD {fullpath}')
+        return None, 0, messages
+    # Ignore if this directory has already been copied,
+    # unless the file has been modified since the directory was last copied.
+    dire = relative_dir_to_src(fullpath)
+    with stats.phase('ledger_lookup'):
+        dir_synced = db.dir_synced(dire)
+    if dir_synced and (filestat.st_mtime < dir_synced):
+        stats.count('ignore_dir_synced')
+        if debug:
+            messages.append(f'IGNORE_ALREADY_SYNCED {fullpath} on {dir_synced} via {dire}')
+            messages.append('  FILE %s' % datetime.fromtimestamp(filestat.st_mtime).strftime("%Y-%m-%d %H:%M:%S"))
+            messages.append('  DB   %s' % datetime.fromtimestamp(dir_synced).strftime("%Y-%m-%d %H:%M:%S"))
+        return None, 0, messages
+    # Ignore if too small or too large (only applies to JPEG)
+    if (filetype == 'JPEG') and (filestat.st_size < min_size):
+        stats.count('ignore_too_small')
+        if debug: messages.append(f'IGNORE_TOO_SMALL ({filestat.st_size}) {fullpath}')
+        return None, 0, messages
+    if (filetype == 'JPEG') and (filestat.st_size > max_size):
+        stats.count('ignore_too_large')
+        if debug: messages.append(f'IGNORE_TOO_LARGE ({filestat.st_size}) {fullpath}')
+        return None, 0, messages
+    # Ignore if this JPEG has already been copied and not changed since,
+    # before reading the rating so a synced file isn't read again
+    if filetype == 'JPEG' and file_already_synced(fullpath, filestat, db, messages):
+        return None, 0, messages
+    # Ignore if not rated 1..5 in ACDSee
+    # This check is last because it involves reading the file
+    # (but only the XMP segments, not the whole image).
+    # For MP4 this reads the XMP file not the whole movie.
+    cached = cache.lookup(fullpath, filestat) if cache and rating is None else None
+    if cached:
+        filetype, rating = cached
+        stats.count('rating_cache_hits')
+    elif rating is None:
+        with stats.phase('rating'):
             rating = image_rating(fullpath)
-            if not rating:
-                if debug: print(f'IGNORE_NOT_RATED {fullpath}')
-                continue
-            # For MP4 we now want the actual movie filename
-            if filetype == 'MP4':
-                fullpath = fullpath.replace('.xmp', '')
-                filestat = os.stat(fullpath)
-            # Add to list
-            files_to_copy += [fullpath]
-            bytes_to_copy += filestat.st_size
-            if debug: print(f'ADD_FILE {fullpath}')
-            # Display directory if not already displayed
-            if dire != prevprinted:
-                print('ADD_DIR %s' % os.path.dirname(fullpath)+'   ')
-                prevprinted = dire
+        stats.count('ratings_read')
+        if cache: cache.store(fullpath, filestat, filetype, rating)
+    if not rating:
+        stats.count('ignore_not_rated')
+        if debug: messages.append(f'IGNORE_NOT_RATED {fullpath}')
+        return None, 0, messages
+    # For MP4 we now want the actual movie filename, and the ledger
+    # applies to the MP4 because only that is copied
+    if filetype == 'MP4':
+        fullpath = fullpath.replace('.xmp', '')
+        with stats.phase('stat'):
+            filestat = os.stat(fullpath)
+        if file_already_synced(fullpath, filestat, db, messages):
+            return None, 0, messages
+    return fullpath, filestat.st_size, messages
+
+def file_already_synced(fullpath, filestat, db, messages):
+    """ Return True if the file has been copied and not changed since,
+    counting and explaining it for check_file() """
+    with stats.phase('ledger_lookup'):
+        file_synced = db.file_synced(relative_path_to_src(fullpath), filestat)
+    if file_synced:
+        stats.count('ignore_file_synced')
+        if debug: messages.append(f'IGNORE_ALREADY_SYNCED {fullpath}')
+    return file_synced
+
+
+def test_check_file_synced_not_read():
+    global srcdir, image_rating
+    saved = srcdir, image_rating
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = tmpdir
+            os.makedirs(os.path.join(tmpdir, '2025-01 a'))
+            fullpath = os.path.join(tmpdir, '2025-01 a', 'img.jpg')
+            with open(fullpath, 'wb') as fd:
+                fd.write(make_test_jpeg(b'<x:xmpmeta acdsee:rating="3"></x:xmpmeta>') + b' ' * min_size)
+            db = SyncLedger(':memory:')
+            assert(check_file(os.path.dirname(fullpath), 'img.jpg', 'JPEG', None, None, db, None, time.time())[0] == fullpath)
+            db.add_file('2025-01 a/img.jpg', os.stat(fullpath), None)
+            image_rating = None # not called for a file already synced
+            assert(check_file(os.path.dirname(fullpath), 'img.jpg', 'JPEG', None, None, db, None, time.time())[0] == None)
+    finally:
+        srcdir, image_rating = saved
+
+def timed_check_file(root, name, filetype, rating, entry, db, cache, time_now):
+    """ check_file() adding the time taken to its directory in stats """
+    start = time.perf_counter()
+    try:
+        return check_file(root, name, filetype, rating, entry, db, cache, time_now)
+    finally:
+        stats.add_dir_time(root, time.perf_counter() - start)
+
+def checked_files(db, cache, time_now, jobs=1, candidates=None):
+    """ Yield the check_file() result for every file from walk_files(),
+    or the given candidates, in the same order as the walk. If jobs > 1
+    then the directory walk feeds a pool of that many threads which do
+    the stat and XMP reading, with at most a few files per thread queued
+    ahead of the results.
+    """
+    if candidates is None:
+        candidates = walk_files()
+    if jobs <= 1:
+        for root, name, filetype, rating, entry in candidates:
+            yield timed_check_file(root, name, filetype, rating, entry, db, cache, time_now)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        for root, name, filetype, rating, entry in candidates:
+            pending.append(pool.submit(timed_check_file, root, name, filetype, rating, entry, db, cache, time_now))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def find_files_to_copy(db, cache=None, jobs=1, candidates=None):
+    """ Recursively find files under 'srcdir' and return a tuple
+    (files_to_copy[path: str], bytes_to_copy[int]). Ignores
+    the [Originals] directory, files too small or too large,
+    files older than 'max_days', files not .jpg, files without an
+    ACDSee rating, and files in a directory which has already
+    been synced (passed in 'db', a SyncLedger) unless file has been
+    modified more recently than the previous sync date, and files
+    which have already been copied and not changed since.
+    If a RatingCache is given then unchanged files are not read again.
+    The files are checked using 'jobs' threads but the result is the
+    same as checking them one at a time. Instead of searching srcdir
+    the candidates can be given, e.g. from catalog_files().
+    """
+    time_now = time.time()
+
+    files_to_copy=[]
+    bytes_to_copy = 0
+
+    prevprinted=None
+    for fullpath, size, messages in checked_files(db, cache, time_now, jobs, candidates):
+        for message in messages:
+            print(message)
+        if not fullpath:
+            continue
+        # Add to list
+        files_to_copy += [fullpath]
+        bytes_to_copy += size
+        stats.count('files_to_copy')
+        if debug: print(f'ADD_FILE {fullpath}')
+        # Display directory if not already displayed
+        dire = relative_dir_to_src(fullpath)
+        if dire != prevprinted:
+            print('ADD_DIR %s' % os.path.dirname(fullpath)+'   ')
+            prevprinted = dire
     return files_to_copy, bytes_to_copy
 
+def test_find_files_to_copy_jobs():
+    global srcdir, stats
+    saved = srcdir, stats
+    try:
+        stats = RunStats()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = tmpdir
+            for i in range(40):
+                subdir = os.path.join(tmpdir, '2025-%02d' % (i % 7), 'sub' if i % 3 else '')
+                os.makedirs(subdir, exist_ok=True)
+                xmp = b'<x:xmpmeta acdsee:rating="%d"></x:xmpmeta>' % (i % 4)
+                with open(os.path.join(subdir, 'img%02d.jpg' % i), 'wb') as fd:
+                    fd.write(make_test_jpeg(xmp) + b' ' * min_size)
+            results = []
+            for jobs in (1, 8):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    result = find_files_to_copy(SyncLedger(':memory:'), jobs=jobs)
+                results.append((result, output.getvalue()))
+        assert(results[0] == results[1])
+        assert(len(results[0][0][0]) == 30)
+        assert(stats.counters['files_checked'] == 80 and stats.counters['ignore_not_rated'] == 20)
+        assert(stats.counters['bytes_read'] > 0 and len(stats.dirs) == 14)
+    finally:
+        srcdir, stats = saved
+
+
+# ---------------------------------------------------------------------
+# Watching srcdir (--watch) rather than searching it on a schedule
+
+def filesystem_type(path):
+    """ Return the type of the filesystem containing path, e.g. 'cifs',
+    from /proc/mounts, or None if it's not known """
+    path = os.path.realpath(path)
+    mountpoint, fstype = '', None
+    try:
+        with open('/proc/mounts') as fd:
+            for line in fd:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(mountpoint):
+                    mountpoint, fstype = mount, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+def watched_dirs(top):
+    """ Yield top and the directories under it which walk_files() would search """
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as it:
+                subdirs = sorted(entry.name for entry in it if entry.is_dir(follow_symlinks=False))
+        except OSError:
+            continue
+        yield root
+        stack.extend(os.path.join(root, name) for name in reversed(prune_subdirs(root, subdirs)))
+
+
+class InotifyWatcher:
+    """ Report the files written or moved into srcdir, or any directory
+    under it which walk_files() would search, using inotify (Linux only,
+    through ctypes). New directories are watched as they appear. Raises
+    OSError if inotify can't be used, e.g. if there are more directories
+    than fs.inotify.max_user_watches. If the kernel's queue of events
+    overflows then overflowed is set, as changes have been missed, and if
+    a new directory can't be watched then error is set to the OSError,
+    as changes in it would be missed from then on.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self, top):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        self.dirs = {} # watch descriptor: directory
+        self.overflowed = False
+        self.error = None
+        try:
+            for root in watched_dirs(top):
+                self._add_watch(root)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _add_watch(self, root):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 2: # ENOENT, gone already
+                return
+            raise OSError(errno, 'inotify_add_watch: ' + os.strerror(errno), root)
+        self.dirs[wd] = root
+
+    def changes(self, timeout=None):
+        """ Wait up to timeout seconds (for ever if None) for changes and
+        return the paths of the files changed """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64*1024)
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset+16:offset+16+length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            root = self.dirs.get(wd)
+            if root is None:
+                continue
+            if not mask & self.IN_ISDIR:
+                if mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    changed.append(os.path.join(root, name))
+            elif prune_subdirs(root, [name]):
+                # Files may have been written before the watch was added
+                for dirpath in watched_dirs(os.path.join(root, name)):
+                    try:
+                        self._add_watch(dirpath)
+                    except OSError as e:
+                        self.error = e # e.g. out of watches
+                        break
+                    try:
+                        with os.scandir(dirpath) as it:
+                            changed.extend(entry.path for entry in it if not entry.is_dir(follow_symlinks=False))
+                    except OSError:
+                        pass # e.g. removed already
+        return changed
+
+
+class DirectoryPoller:
+    """ Report the files created or changed under srcdir by checking, every
+    interval seconds, the mtime of each directory walk_files() would search
+    and only listing those which have changed, comparing the mtime and size
+    of their files with the last time. For filesystems where inotify doesn't
+    see changes made by other machines, such as CIFS. An unchanged tree
+    costs one stat per directory. Like --incremental it relies on the
+    directory mtime changing, which it does when ACDSee replaces a file
+    but not when a file is written in place.
+    """
+    overflowed = False # never misses changes, unlike InotifyWatcher
+    error = None
+
+    def __init__(self, top, interval):
+        self.top = top
+        self.interval = interval
+        self.dirs = {} # path: (mtime, {name: (mtime, size)}, [subdir names])
+        self.poll() # the first poll only finds what's there
+        self.next_poll = time.time() + interval
+
+    def close(self):
+        pass
+
+    def poll(self):
+        """ List the directories which have changed and return the paths
+        of the files created or changed since the last poll """
+        first = not self.dirs
+        changed = []
+        dirs = {}
+        stack = [self.top]
+        while stack:
+            root = stack.pop()
+            try:
+                mtime = os.stat(root).st_mtime
+                previous = self.dirs.get(root)
+                if previous and previous[0] == mtime:
+                    files, subdirs = previous[1], previous[2]
+                else:
+                    stats.count('dirs_listed')
+                    files = {}
+                    subdirs = []
+                    with os.scandir(root) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                            elif file_type(entry.name) != 'NONE':
+                                filestat = entry.stat()
+                                files[entry.name] = (filestat.st_mtime, filestat.st_size)
+                    if not first:
+                        before = previous[1] if previous else {}
+                        changed.extend(os.path.join(root, name) for name, stamp in files.items() if before.get(name) != stamp)
+            except OSError:
+                continue # e.g. deleted
+            dirs[root] = (mtime, files, subdirs)
+            stack.extend(os.path.join(root, name) for name in prune_subdirs(root, subdirs))
+        self.dirs = dirs
+        return sorted(changed)
+
+    def changes(self, timeout=None):
+        """ Wait for the next poll, or timeout seconds if that's sooner,
+        and return the paths of the files changed """
+        wait = self.next_poll - time.time()
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(wait, 0))
+        self.next_poll = time.time() + self.interval
+        return self.poll()
+
+
+class ChangeQueue:
+    """ The changed files, each ready once it hasn't changed for settle
+    seconds, so the several writes ACDSee makes when it embeds the
+    metadata in a file become one change """
+    def __init__(self, settle):
+        self.settle = settle
+        self.changed = {} # path: time of the last change
+
+    def __len__(self):
+        return len(self.changed)
+
+    def add(self, paths, now):
+        for path in paths:
+            self.changed[path] = now
+
+    def next_ready(self):
+        """ Return the time the next file will be ready, or None if there are none """
+        return min(self.changed.values()) + self.settle if self.changed else None
+
+    def ready(self, now):
+        """ Remove and return the files which haven't changed for settle seconds """
+        paths = sorted(path for path, when in self.changed.items() if now - when >= self.settle)
+        for path in paths:
+            del self.changed[path]
+        return paths
+
+
+def test_change_queue():
+    queue = ChangeQueue(10)
+    queue.add(['/a.jpg', '/b.jpg'], 100)
+    queue.add(['/a.jpg'], 105) # written again
+    assert(queue.next_ready() == 110)
+    assert(queue.ready(110) == ['/b.jpg'])
+    assert(queue.ready(114) == [])
+    assert(queue.ready(115) == ['/a.jpg'] and len(queue) == 0 and queue.next_ready() == None)
+
+def test_directory_poller():
+    global srcdir
+    saved_srcdir = srcdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = tmpdir
+            os.makedirs(os.path.join(tmpdir, '2025-01 a', '[Originals]'))
+            for name in ('2025-01 a/img.jpg', '2025-01 a/[Originals]/img.jpg'):
+                open(os.path.join(tmpdir, name), 'w').close()
+            poller = DirectoryPoller(tmpdir, 60)
+            assert(poller.poll() == [])
+            os.makedirs(os.path.join(tmpdir, '2025-02 b'))
+            for name in ('2025-02 b/new.jpg', '2025-01 a/[Originals]/new.jpg', '2025-01 a/notes.txt'):
+                open(os.path.join(tmpdir, name), 'w').close()
+            # Replaced like ACDSee does when it embeds the rating
+            with open(os.path.join(tmpdir, '2025-01 a', 'img.tmp'), 'w') as fd:
+                fd.write('rated')
+            os.replace(os.path.join(tmpdir, '2025-01 a', 'img.tmp'), os.path.join(tmpdir, '2025-01 a', 'img.jpg'))
+            assert(poller.poll() == [os.path.join(tmpdir, '2025-01 a', 'img.jpg'), os.path.join(tmpdir, '2025-02 b', 'new.jpg')])
+            assert(poller.poll() == [])
+    finally:
+        srcdir = saved_srcdir
+
+def test_inotify_watcher():
+    global srcdir
+    saved_srcdir = srcdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = tmpdir
+            os.makedirs(os.path.join(tmpdir, '2025-01 a'))
+            try:
+                watcher = InotifyWatcher(tmpdir)
+            except OSError:
+                return # not Linux
+            assert(watcher.changes(0) == [])
+            with open(os.path.join(tmpdir, '2025-01 a', 'img.jpg'), 'w') as fd:
+                fd.write('rated')
+            os.makedirs(os.path.join(tmpdir, '2025-02 b', '[Originals]'))
+            open(os.path.join(tmpdir, '2025-02 b', 'new.jpg'), 'w').close()
+            changed = []
+            while len(changed) < 2:
+                more = watcher.changes(1)
+                assert(more)
+                changed.extend(more)
+            open(os.path.join(tmpdir, '2025-02 b', '[Originals]', 'img.jpg'), 'w').close()
+            open(os.path.join(tmpdir, '2025-02 b', 'later.jpg'), 'w').close()
+            changed.extend(watcher.changes(1))
+            assert(sorted(set(changed)) == [os.path.join(tmpdir, '2025-01 a', 'img.jpg'),
+                os.path.join(tmpdir, '2025-02 b', 'later.jpg'), os.path.join(tmpdir, '2025-02 b', 'new.jpg')])
+            # A new directory which can't be watched, e.g. out of watches
+            def add_watch(root):
+                raise OSError(28, 'inotify_add_watch: No space left on device', root)
+            watcher._add_watch = add_watch
+            os.makedirs(os.path.join(tmpdir, '2025-03 c'))
+            while watcher.error is None:
+                assert(watcher.changes(1) == [])
+            assert(watcher.error.errno == 28)
+            watcher.close()
+            watcher.close()
+    finally:
+        srcdir = saved_srcdir
+
+
+def changed_candidates(paths):
+    """ Yield a tuple (root, name, filetype, rating, entry) like walk_files()
+    for each of the changed files which is a JPEG or MP4 XMP file and still exists """
+    for path in paths:
+        root, name = os.path.split(path)
+        filetype = file_type(name)
+        if filetype == 'NONE':
+            continue
+        if not os.path.exists(path):
+            stats.count('ignore_vanished')
+            continue
+        yield root, name, filetype, None, None
+
+def sync_changed(paths, db, cache, logfd, args):
+    """ Check the changed files, or search all of srcdir if paths is None,
+    and (with --copy) copy those which should be synced. Returns the
+    number of files copied. """
+    if paths is None:
+        candidates = walk_files(None, db if incremental else None)
+    else:
+        candidates = changed_candidates(paths)
+    with stats.phase('find_files'):
+        files_to_copy, bytes_to_copy = find_files_to_copy(db, cache, jobs, candidates)
+    if not files_to_copy:
+        return 0
+    if not args.copy:
+        for file in sorted(files_to_copy):
+            print('NOT COPYING %s, run with --copy' % file)
+        return 0
+    dirs_to_copy = sorted(set(relative_dir_to_src(file) for file in files_to_copy))
+    for dire in dirs_to_copy:
+        print('MKDIR %s' % os.path.join(destdir, dire), file=logfd)
+        os.makedirs(os.path.join(destdir, dire), exist_ok=True)
+    with stats.phase('copy_files'):
+        failed_dirs = copy_files(sorted(files_to_copy), db, logfd, args.hash)
+    with stats.phase('ledger_write'):
+        db.commit([dire for dire in dirs_to_copy if dire not in failed_dirs])
+    logfd.flush()
+    return len(files_to_copy)
+
+def test_sync_changed():
+    global srcdir, destdir
+    saved = srcdir, destdir
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            srcdir = os.path.join(tmpdir, 'src')
+            destdir = os.path.join(tmpdir, 'dest')
+            os.makedirs(os.path.join(srcdir, '2025-01 a'))
+            for name, rating in (('rated.jpg', 3), ('unrated.jpg', 0)):
+                with open(os.path.join(srcdir, '2025-01 a', name), 'wb') as fd:
+                    fd.write(make_test_jpeg(b'<x:xmpmeta acdsee:rating="%d"></x:xmpmeta>' % rating) + b' ' * min_size)
+            changed = [os.path.join(srcdir, '2025-01 a', name) for name in ('rated.jpg', 'unrated.jpg', 'gone.jpg', 'notes.txt')]
+            args = argparse.Namespace(copy=True, hash=False)
+            db = SyncLedger(':memory:')
+            with open(os.devnull, 'w') as logfd, contextlib.redirect_stdout(io.StringIO()):
+                assert(sync_changed(changed, db, None, logfd, args) == 1)
+                assert(sync_changed(changed, db, None, logfd, args) == 0) # already synced
+            assert(os.listdir(os.path.join(destdir, '2025-01 a')) == ['rated.jpg'])
+    finally:
+        srcdir, destdir = saved
+
+
+def start_watcher(args):
+    """ Start watching srcdir, with inotify if the filesystem supports it,
+    otherwise by polling, and return the watcher for watch(). It's started
+    before the first sync() so the changes made while that runs are
+    reported (queued by the kernel, or found by the next poll) rather than
+    missed. """
+    fstype = filesystem_type(srcdir)
+    if not args.poll and fstype not in remote_filesystems:
+        try:
+            watcher = InotifyWatcher(srcdir)
+            print('WATCHING %s (%d directories) with inotify' % (srcdir, len(watcher.dirs)))
+            return watcher
+        except OSError as e:
+            print('Cannot use inotify (%s), polling instead' % e)
+    interval = args.poll or poll_interval
+    watcher = DirectoryPoller(srcdir, interval)
+    print('POLLING %s (%s, %d directories) every %d seconds' % (srcdir, fstype, len(watcher.dirs), interval))
+    return watcher
+
+def watch(args, logfd, watcher):
+    """ Sync the files the watcher from start_watcher() reports once they
+    have settled, until interrupted. If inotify can't watch a new directory
+    it switches to polling, after checking all of srcdir. """
+    db = SyncLedger(database)
+    cache = None if args.no_cache else RatingCache(args.cache)
+    queue = ChangeQueue(args.settle)
+    try:
+        while True:
+            next_ready = queue.next_ready()
+            changed = watcher.changes(None if next_ready is None else max(next_ready - time.time(), 0))
+            changed = [path for path in changed if file_type(os.path.basename(path)) != 'NONE']
+            stats.count('changes_seen', len(changed))
+            queue.add(changed, time.time())
+            if watcher.error:
+                print('Cannot watch all of %s with inotify (%s), polling instead' % (srcdir, watcher.error))
+                watcher.close()
+                watcher = DirectoryPoller(srcdir, args.poll or poll_interval)
+                watcher.overflowed = True # changes since the error were missed
+            if watcher.overflowed:
+                print('Missed some changes, checking all of %s' % srcdir)
+                watcher.overflowed = False
+                paths = None
+            else:
+                paths = queue.ready(time.time())
+                if not paths:
+                    continue
+            timenow = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+            print('%s Checking %s changed files' % (timenow, 'all' if paths is None else len(paths)))
+            copied = sync_changed(paths, db, cache, logfd, args)
+            if copied:
+                print('%s Copied %d files' % (datetime.today().strftime('%Y-%m-%d %H:%M:%S'), copied))
+            if args.prometheus:
+                stats.write_prometheus(args.prometheus, 'syncthing')
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        watcher.close()
+        if cache: cache.close()
+        db.close()
+
 
 # ---------------------------------------------------------------------
 def main():
     global debug, verbose
-    global srcdir, max_days, dir_prefix
+    global srcdir, max_days, dir_prefix, jobs, copy_jobs, catalog_prefix, incremental
 
     parser = argparse.ArgumentParser(description='syncthing wrapper')
     parser.add_argument('-d', '--debug', action="store_true", help='debug (very detailed, explain each file)')
@@ -196,6 +1450,23 @@ def main():
     parser.add_argument('--laptop', action="store_true", help='copy from laptop backup instead of file server')
     parser.add_argument('--days', action="store", help=f'only copy files modified within this many days (default {max_days})')
     parser.add_argument('--prefix', action="store", help=f'only copy inside directories with this prefix, e.g. 2021 (default {dir_prefix})')
+    parser.add_argument('--jobs', action="store", help=f'number of files to check in parallel (default {jobs})')
+    parser.add_argument('--incremental', action="store_true", help='skip directories which haven\'t changed since the last run (without it every directory is checked again)')
+    parser.add_argument('--cache', action="store", default=cache_file, help=f'cache the ratings of files in this file (default {cache_file})')
+    parser.add_argument('--no-cache', action="store_true", help='read the rating from every file, don\'t use the cache')
+    parser.add_argument('--from-catalog', action="store_true", help='find rated files from the ACDSee catalog instead of reading every file')
+    parser.add_argument('--catalog', action="store", default=catalogdir, help=f'directory containing the ACDSee catalog Asset.dbf and Folder.dbf (default {catalogdir})')
+    parser.add_argument('--copy-jobs', action="store", help=f'number of files to copy in parallel (default {copy_jobs})')
+    parser.add_argument('--hash', action="store_true", help='record the SHA-256 of each file copied (reads it rather than copying inside the kernel)')
+    parser.add_argument('--yes', action="store_true", help=f'don\'t ask before copying more than {confirm_size // 1024 // 1024} MB')
+    parser.add_argument('--verify-pending', action="store_true", help='with --from-catalog, read the rating from files flagged Embed Pending')
+    parser.add_argument('--watch', action="store_true", help='after the first sync keep running, syncing the files which change (with inotify if possible, otherwise polling)')
+    parser.add_argument('--poll', action="store", type=int, help=f'with --watch, poll every this many seconds rather than use inotify (default {poll_interval} if inotify can\'t be used)')
+    parser.add_argument('--settle', action="store", type=float, default=settle_seconds, help=f'with --watch, sync a file once it hasn\'t changed for this many seconds (default {settle_seconds})')
+    parser.add_argument('--stats', action="store", help='write the time taken by each phase and the number of files skipped for each reason to this JSON file (- for stdout)')
+    parser.add_argument('--prometheus', action="store", help='write the same as a Prometheus textfile, e.g. /var/lib/node_exporter/syncthing.prom')
+    parser.add_argument('--profile', action="store", help='run under cProfile, saving the profile to this file')
+    parser.add_argument('--tracemalloc', action="store_true", help='trace memory allocations and print the largest')
     args = parser.parse_args()
 
     if args.debug: debug=True
@@ -203,25 +1474,60 @@ def main():
 
     if args.laptop:
         srcdir = srcdir_laptop
+        catalog_prefix = catalog_prefix_laptop
     if args.days:
         max_days = int(args.days)
     if args.prefix:
         dir_prefix = args.prefix
+    if args.jobs:
+        jobs = int(args.jobs)
+    if args.copy_jobs:
+        copy_jobs = int(args.copy_jobs)
+    if args.incremental:
+        incremental = True
 
     if args.log:
         logfd = open(args.log, 'a')
     else:
         logfd = open('/dev/null', 'w')
 
+    with profiled(args.profile, args.tracemalloc):
+        watcher = start_watcher(args) if args.watch else None
+        try:
+            sync(args, logfd)
+            if watcher:
+                watch(args, logfd, watcher)
+        finally:
+            if watcher:
+                watcher.close()
+    if args.stats:
+        stats.write_json(args.stats)
+    if args.prometheus:
+        stats.write_prometheus(args.prometheus, 'syncthing')
+
+
+def sync(args, logfd):
+    """ Find the files to copy and copy them, with the options set by main() """
     timenow = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
     print('%s Starting' % timenow)
 
     print('READING DATABASE')
     print('LOAD %s' % database, file=logfd)
-    db = read_database(database)
+    with stats.phase('ledger_load'):
+        db = SyncLedger(database)
+        db.import_csv(legacy_database)
 
     print('FIND FILES TO COPY')
-    files_to_copy, bytes_to_copy = find_files_to_copy(db)
+    cache = None if args.no_cache else RatingCache(args.cache)
+    scanned = {}
+    if args.from_catalog:
+        print('READING CATALOG %s' % args.catalog, file=logfd)
+        candidates = catalog_files(args.catalog, args.verify_pending)
+    else:
+        candidates = walk_files(scanned, db if incremental else None)
+    with stats.phase('find_files'):
+        files_to_copy, bytes_to_copy = find_files_to_copy(db, cache, jobs, candidates)
+    if cache: cache.close()
     files_to_copy = sorted(files_to_copy)
 
     print()
@@ -230,6 +1536,10 @@ def main():
         dire = relative_dir_to_src(file)
         dirs_to_copy.add(dire)
     dirs_to_copy = sorted(dirs_to_copy) # now a list
+    # Directories with nothing to copy don't need to be listed next time
+    pending_dirs = set(os.path.relpath(os.path.dirname(file), srcdir) for file in files_to_copy)
+    db.record_scans(scanned, pending_dirs)
+    db.commit()
 
 
     for dire in dirs_to_copy:
@@ -242,7 +1552,13 @@ def main():
         timenow = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
         print('%s Finished' % timenow)
         print('Run with --copy next time')
-        sys.exit(0)
+        return
+
+    if bytes_to_copy > confirm_size and not args.yes and sys.stdin.isatty():
+        answer = input('Copy %.1f GB? [y/N] ' % (bytes_to_copy / 1024 / 1024 / 1024))
+        if answer.lower() not in ('y', 'yes'):
+            print('Not copying')
+            return
 
     print('CREATE DIRECTORIES')
     for dire in dirs_to_copy:
@@ -251,23 +1567,17 @@ def main():
         os.makedirs(os.path.join(destdir, dire), exist_ok=True)
 
     print('COPY')
-    for file in files_to_copy:
-        dire = relative_dir_to_src(file)
-        dire = os.path.join(destdir, dire)
-        print('COPY %s -> %s' % (file,dire))
-        print('COPY %s -> %s' % (file,dire), file=logfd)
-        shutil.copy2(file, dire)
+    with stats.phase('copy_files'):
+        failed_dirs = copy_files(files_to_copy, db, logfd, args.hash)
 
     print('UPDATE DATABASE')
     print('UPDATE %s' % database, file=logfd)
-    write_header = False if os.path.isfile(database) else True
-    now = datetime.today().strftime('%Y-%m-%d')
-    with open(database, 'a') as fd:
-        if write_header:
-            print('updateddate\tdirectory', file=fd)
-        csvw = csv.writer(fd, delimiter='\t')
-        for dire in dirs_to_copy:
-            csvw.writerow( [now, dire] )
+    # Directories with failures are not marked as synced so they're retried
+    with stats.phase('ledger_write'):
+        db.record_scans({dire: scan for dire, scan in scanned.items() if dire in pending_dirs},
+            set(os.path.relpath(os.path.join(srcdir, dire), srcdir) for dire in failed_dirs))
+        db.commit([dire for dire in dirs_to_copy if dire not in failed_dirs])
+    db.close()
 
     timenow = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
     print('%s Finished' % timenow)